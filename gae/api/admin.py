@@ -26,6 +26,7 @@ from shared import responses
 from shared import task_util
 from shared.config import config
 from shared.datastore.club import Club
+from shared.datastore.series import Series
 from shared.datastore.service import Service
 from shared.services.strava.club_worker import ClubWorker as StravaClubWorker
 from shared.services.withings.client import create_client as withings_create_client
@@ -95,8 +96,24 @@ class ProcessEventsResource(Resource):
         auth_util.get_bot(flask.request)
 
         sub_events_query = ds_util.client.query(kind='SubscriptionEvent')
-        for sub_event in sub_events_query.fetch():
-            task_util.process_event(sub_event.key)
+        with task_util.TaskBatch():
+            for sub_event in sub_events_query.fetch():
+                task_util.process_event(sub_event.key.parent, sub_event)
+        return responses.OK
+
+
+@api.route('/migrate_series')
+class MigrateSeriesResource(Resource):
+    def post(self):
+        auth_util.get_bot(flask.request)
+
+        series_query = ds_util.client.query(kind='Series')
+        series_query.keys_only()
+        migrated = 0
+        for series in series_query.fetch():
+            if Series.migrate(series.key.parent):
+                migrated += 1
+        logging.info('Migrated %s series', migrated)
         return responses.OK
 
 
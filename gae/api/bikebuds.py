@@ -22,14 +22,17 @@ from flask_restx import Namespace, Resource
 
 from shared import auth_util
 from shared import ds_util
+from shared import series_util
 from shared import task_util
 
 from shared.datastore.athlete import Athlete
+from shared.datastore.backfill_job import BackfillJob
 from shared.datastore.bot import Bot
 from shared.datastore.client_state import ClientState
 from shared.datastore.club import Club
 from shared.datastore.service import Service
 from shared.datastore.series import Series
+from shared.datastore.weight_trend import DEFAULT_LOOKBACK_DAYS, WeightTrendSnapshot
 
 from models import (
     activity_entity_model,
@@ -39,7 +42,7 @@ from models import (
     client_state_model,
     club_entity_model,
     connect_userpass_model,
-    filter_parser,
+    days_parser,
     get_arg,
     measure_model,
     preferences_model,
@@ -48,8 +51,10 @@ from models import (
     segment_entity_model,
     segments_parser,
     series_entity_model,
+    series_parser,
     service_entity_model,
     sync_model,
+    weight_trend_model,
     WrapEntity,
 )
 
@@ -226,25 +231,68 @@ class SegmentsCompareResource(Resource):
 
 
 @api.route('/series')
-@api.expect(filter_parser)
+@api.expect(series_parser)
 class SeriesResource(Resource):
     @api.doc('get_series')
     @api.marshal_with(series_entity_model, skip_none=True)
     def get(self):
         user = auth_util.get_user(flask.request)
+        args = series_parser.parse_args()
         service_name = user['preferences']['weight_service'].lower()
         series = Series.get(
-            ds_util.client.key('Service', service_name, parent=user.key)
+            ds_util.client.key('Service', service_name, parent=user.key),
+            start=args['start'],
+            end=args['end'],
+            # Filtering and downsampling change what the limit counts.
+            limit=None if args['filter'] or args['resolution'] else args['limit'],
         )
         if series is None:
             return WrapEntity(None)
 
-        filter_arg = get_arg('filter')
-        if filter_arg:
-            series['measures'] = [m for m in series['measures'] if filter_arg in m]
+        measures = series['measures']
+        if args['filter']:
+            measures = [m for m in measures if args['filter'] in m]
+        if args['resolution']:
+            measures = series_util.downsample(
+                measures,
+                args['resolution'],
+                fields=args['fields'] or series_util.DEFAULT_FIELDS,
+            )
+        elif args['fields']:
+            measures = series_util.project(measures, args['fields'])
+        if args['limit']:
+            measures = measures[-args['limit'] :]
+        series['measures'] = measures
         return WrapEntity(series)
 
 
+@api.route('/weight_trend')
+@api.expect(days_parser)
+class WeightTrendResource(Resource):
+    @api.doc('get_weight_trend')
+    @api.marshal_with(weight_trend_model, skip_none=True)
+    def get(self):
+        user = auth_util.get_user(flask.request)
+        service_name = user['preferences']['weight_service'].lower()
+        snapshot = WeightTrendSnapshot.get_or_rebuild(
+            ds_util.client.key('Service', service_name, parent=user.key)
+        )
+
+        today = datetime.datetime.now(datetime.timezone.utc).date()
+        lookbacks = []
+        for days in get_arg('days') or DEFAULT_LOOKBACK_DAYS:
+            measure = WeightTrendSnapshot.lookback(snapshot, days, today)
+            if measure is not None:
+                lookbacks.append(dict(measure, days=days))
+        return {
+            'date': today,
+            'latest': WeightTrendSnapshot.lookback(snapshot, 0, today),
+            'ema': WeightTrendSnapshot.ema(snapshot, today),
+            'ema_days': snapshot['ema_days'],
+            'lookbacks': lookbacks,
+        }
+
+
 @api.route('/service/<name>')
 class ServiceResource(Resource):
     @api.doc('get_service')
@@ -297,8 +345,9 @@ class SyncResource(Resource):
     def post(self, name):
         user = auth_util.get_user(flask.request)
         force = api.payload.get('force', False)
+        deep = api.payload.get('deep', False)
         service = Service.get(name, parent=user.key)
-        task_util.sync_service(service, force=force)
+        task_util.sync_service(service, force=force, deep=deep)
         return WrapEntity(service)
 
 
@@ -328,9 +377,33 @@ class BackfillResource(Resource):
         dest = Service.get(backfill['dest'], parent=user.key)
         start = datetime.datetime.fromisoformat(backfill.get('start'))
         end = datetime.datetime.fromisoformat(backfill.get('end'))
-        task_util.xsync_tasks_backfill(source.key, dest.key, start, end)
+
+        job = BackfillJob.start(source.key, dest.key, start, end)
+        if job is None:
+            # Already running, so this returns its progress instead.
+            job = BackfillJob.get(source.key, dest.key)
+        else:
+            # A resumed job keeps its own range.
+            task_util.xsync_tasks_backfill(
+                source.key, dest.key, job['start'], job['end']
+            )
         # TODO: pre-check there are credentials.
-        return backfill
+        return dict(job, source=backfill['source'], dest=backfill['dest'])
+
+
+@api.route('/backfill/<source>/<dest>')
+class BackfillProgressResource(Resource):
+    @api.doc('get_backfill')
+    @api.marshal_with(backfill_model, skip_none=True)
+    def get(self, source, dest):
+        user = auth_util.get_user(flask.request)
+        job = BackfillJob.get(
+            ds_util.client.key('Service', source, parent=user.key),
+            ds_util.client.key('Service', dest, parent=user.key),
+        )
+        if job is None:
+            flask.abort(404)
+        return dict(job, source=source, dest=dest)
 
 
 @api.route('/auth')
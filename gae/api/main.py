@@ -17,6 +17,7 @@ from flask import Flask
 from flask_cors import CORS
 from flask_restx import Api
 
+from shared import ds_util
 from shared import logging_util
 from shared import responses
 from shared.config import config
@@ -69,6 +70,7 @@ def warmup():
 @app.before_request
 def before():
     logging_util.before()
+    ds_util.client.begin_scope()
 
 
 @app.after_request
@@ -76,6 +78,11 @@ def after(response):
     return logging_util.after(response)
 
 
+@app.teardown_request
+def teardown(exception):
+    ds_util.client.end_scope()
+
+
 if __name__ == '__main__':
     host, port = config.api_url[7:].split(':')
     app.run(host='localhost', port=port, debug=True)
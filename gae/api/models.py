@@ -13,9 +13,10 @@
 # limitations under the License.
 
 
+import datetime
 import logging
 
-from flask_restx import Namespace, fields, reqparse
+from flask_restx import Namespace, fields, inputs, reqparse
 
 
 api = Namespace('models')
@@ -34,6 +35,18 @@ def EntityModel(nested_model):
     )
 
 
+def end_from_iso8601(value):
+    """Parses an ISO 8601 datetime, where a date alone means its last moment."""
+    try:
+        day = datetime.date.fromisoformat(value)
+    except ValueError:
+        return inputs.datetime_from_iso8601(value)
+    return datetime.datetime.combine(day, datetime.time.max)
+
+
+end_from_iso8601.__schema__ = inputs.datetime_from_iso8601.__schema__
+
+
 class CredentialsField(fields.Raw):
     def format(self, value):
         return value is not None
@@ -59,6 +72,7 @@ sync_state_model = api.model(
         'enqueued_at': fields.DateTime,
         'started_at': fields.DateTime,
         'updated_at': fields.DateTime,
+        'api_calls_saved': fields.Integer,
     },
 )
 
@@ -103,6 +117,15 @@ measure_model = api.model(
         # 'temperature': fields.Float,
         'weight': fields.Float,
         'weight_error': fields.List(fields.Float),
+        # Downsampled measures aggregate count measures into a bucket
+        # starting at date, with the mean as the field itself.
+        'count': fields.Integer,
+        'fat_ratio_min': fields.Float,
+        'fat_ratio_max': fields.Float,
+        'fat_ratio_last': fields.Float,
+        'weight_min': fields.Float,
+        'weight_max': fields.Float,
+        'weight_last': fields.Float,
     },
 )
 
@@ -116,6 +139,28 @@ series_model = api.model(
 )
 series_entity_model = EntityModel(series_model)
 
+weight_lookback_model = api.model(
+    'WeightLookback',
+    {
+        'days': fields.Integer,
+        'date': fields.DateTime,
+        'weight': fields.Float,
+    },
+)
+
+weight_trend_model = api.model(
+    'WeightTrend',
+    {
+        'date': fields.Date,
+        'latest': fields.Nested(measure_model, skip_none=True),
+        'ema': fields.Float,
+        'ema_days': fields.Integer,
+        'lookbacks': fields.List(
+            fields.Nested(weight_lookback_model, skip_none=True), default=tuple()
+        ),
+    },
+)
+
 geo_point_model = api.model(
     'GeoPoint',
     {
@@ -458,7 +503,11 @@ segment_effort_model = api.model(
 
 sync_model = api.model(
     'Sync',
-    {'force': fields.Boolean},
+    {
+        'force': fields.Boolean,
+        # Walks back through the service's whole history; only Garmin.
+        'deep': fields.Boolean,
+    },
 )
 
 connect_userpass_model = api.model(
@@ -476,6 +525,15 @@ backfill_model = api.model(
         'dest': fields.String,
         'start': fields.DateTime,
         'end': fields.DateTime,
+        # Progress, from the BackfillJob.
+        'cursor': fields.DateTime,
+        'total': fields.Integer,
+        'uploaded': fields.Integer,
+        'skipped': fields.Integer,
+        'done': fields.Boolean,
+        'error': fields.String,
+        'started_at': fields.DateTime,
+        'updated_at': fields.DateTime,
     },
 )
 
@@ -488,6 +546,48 @@ filter_parser.add_argument(
     'filter', location='args', help='A filter for measures in a series.'
 )
 
+series_parser = filter_parser.copy()
+series_parser.add_argument(
+    'start',
+    type=inputs.datetime_from_iso8601,
+    location='args',
+    help='The earliest measure date, inclusive.',
+)
+series_parser.add_argument(
+    'end',
+    type=end_from_iso8601,
+    location='args',
+    help='The latest measure date, inclusive; a date includes all of that day.',
+)
+series_parser.add_argument(
+    'limit',
+    type=inputs.positive,
+    location='args',
+    help='At most this many of the most recent measures.',
+)
+series_parser.add_argument(
+    'fields',
+    action='split',
+    location='args',
+    help='The measure fields to return, with the date.',
+)
+series_parser.add_argument(
+    'resolution',
+    choices=('day', 'week', 'month'),
+    location='args',
+    help='Downsamples measures, aggregating each day, week or month.',
+)
+
+
+days_parser = reqparse.RequestParser()
+days_parser.add_argument(
+    'days',
+    action='split',
+    type=int,
+    help='Sequence of lookbacks, in days',
+    location='args',
+)
+
 
 segments_parser = reqparse.RequestParser()
 segments_parser.add_argument(
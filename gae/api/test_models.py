@@ -0,0 +1,34 @@
+# Copyright 2019 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import datetime
+import unittest
+
+from models import end_from_iso8601
+
+
+class EndFromIso8601Test(unittest.TestCase):
+    def test_date(self):
+        self.assertEqual(
+            datetime.datetime(2021, 2, 3, 23, 59, 59, 999999),
+            end_from_iso8601('2021-02-03'),
+        )
+
+    def test_datetime(self):
+        self.assertEqual(
+            datetime.datetime(2021, 2, 3, 10, 30),
+            end_from_iso8601('2021-02-03T10:30:00'),
+        )
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, end_from_iso8601, 'yesterday')
@@ -21,6 +21,7 @@ from google.cloud.datastore.entity import Entity
 from shared import ds_util
 from shared import logging_util
 from shared import responses
+from shared import task_executor
 from shared import task_util
 from shared.config import config
 from shared.datastore.service import Service
@@ -46,6 +47,11 @@ app.register_blueprint(slack.module, url_prefix='/services/slack')
 
 logging_util.setup_logging(app)
 
+if config.is_dev and getattr(config, 'in_process_tasks', False):
+    # Run tasks queued by the backend in this process, rather than posting
+    # them back to ourselves over http.
+    task_util.set_executor(task_executor.InProcessTaskExecutor({'backend': app}))
+
 
 @app.route('/tasks/cleanup', methods=['GET'])
 def cleanup_task():
@@ -94,6 +100,7 @@ def unittest():
 @app.before_request
 def before():
     logging_util.before()
+    ds_util.client.begin_scope()
 
 
 @app.after_request
@@ -101,6 +108,11 @@ def after(response):
     return logging_util.after(response)
 
 
+@app.teardown_request
+def teardown(exception):
+    ds_util.client.end_scope()
+
+
 if __name__ == '__main__':
     host, port = config.backend_url[7:].split(':')
     app.run(host='localhost', port=port, debug=True)
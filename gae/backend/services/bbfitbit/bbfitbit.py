@@ -23,6 +23,7 @@ from shared import task_util
 from shared.config import config
 from shared.datastore.series import Series
 from shared.datastore.service import Service
+from shared.datastore.weight_trend import WeightTrendSnapshot
 from shared.exceptions import SyncException
 
 import sync_helper
@@ -61,7 +62,8 @@ class Worker(object):
         measures = self.client.time_series('body/weight', period='max')
 
         series = Series.to_entity(measures['body-weight'], parent=self.service.key)
-        ds_util.client.put(series)
+        Series.put(series)
+        WeightTrendSnapshot.rebuild(self.service.key, series['measures'])
 
 
 def create_client(service):
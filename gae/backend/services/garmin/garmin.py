@@ -17,6 +17,7 @@ import json
 import logging
 import re
 
+from google.api_core.exceptions import AlreadyExists
 from google.cloud.datastore.entity import Entity
 import dateutil.parser
 import flask
@@ -25,9 +26,12 @@ import requests
 from shared import ds_util
 from shared import responses
 from shared import task_util
+from shared import track_util
+from shared.datastore.garmin.converters import GarminConverters
 from shared.datastore.series import Series
 from shared.datastore.service import Service
-from shared.datastore.track import Track
+from shared.datastore.track import Track, TrackPoints
+from shared.datastore.weight_trend import WeightTrendSnapshot
 from shared.exceptions import SyncException
 from shared.services.garmin import client as garmin_client
 
@@ -41,6 +45,24 @@ LIVETRACK_INFO_URL = 'https://livetrack.garmin.com/services/session/%(session)s/
 LIVETRACK_TRACKPOINTS_FIRST_URL = 'https://livetrack.garmin.com/services/session/%(session)s/trackpoints?requestTime=%(requestTime)s'
 LIVETRACK_TRACKPOINTS_URL = 'https://livetrack.garmin.com/services/session/%(session)s/trackpoints?requestTime=%(requestTime)s&from=%(from)s'
 
+# LiveTrack polls come this often while points are arriving, backing off to
+# the max while they aren't. Polling stops once none have come for the idle
+# timeout.
+LIVETRACK_POLL_MIN_INTERVAL = datetime.timedelta(seconds=30)
+LIVETRACK_POLL_MAX_INTERVAL = datetime.timedelta(minutes=5)
+LIVETRACK_IDLE_TIMEOUT = datetime.timedelta(hours=1)
+
+# The first sync fetches this many days of body composition.
+INITIAL_SYNC_DAYS = 365
+
+# Later syncs refetch this many days before the latest stored measure, in
+# case Garmin was slow to record some.
+SYNC_OVERLAP_DAYS = 7
+
+# A deep sync walks back a year at a time, until a year has no measures.
+HISTORY_WINDOW_DAYS = 365
+MAX_HISTORY_WINDOWS = 20
+
 
 @module.route('/tasks/livetrack', methods=['POST'])
 def tasks_livetrack():
@@ -56,6 +78,19 @@ def tasks_livetrack():
     return responses.OK
 
 
+@module.route('/tasks/livetrack_poll', methods=['POST'])
+def tasks_livetrack_poll():
+    params = task_util.get_payload(flask.request)
+    url = params['url']
+    logging.info('process/livetrack_poll: %s', url)
+
+    try:
+        sync_helper.do(LiveTrackPoller(url=url), work_key=url)
+    except SyncException:
+        return responses.OK_SYNC_EXCEPTION
+    return responses.OK
+
+
 @module.route('/tasks/sync', methods=['POST'])
 def sync():
     logging.debug('Syncing: garmin')
@@ -69,7 +104,9 @@ def sync():
 
     try:
         Service.set_sync_started(service)
-        sync_helper.do(Worker(service), work_key=service.key)
+        sync_helper.do(
+            Worker(service, deep=params.get('deep', False)), work_key=service.key
+        )
         Service.set_sync_finished(service)
         return responses.OK
     except SyncException as e:
@@ -78,29 +115,80 @@ def sync():
 
 
 class Worker(object):
-    def __init__(self, service):
+    """Syncs body composition, incrementally.
+
+    Each sync fetches from a little before the latest stored measure and
+    upserts what it finds; a deep sync also walks back through the
+    account's history, a year at a time, from before the earliest.
+    """
+
+    def __init__(self, service, deep=False):
         self.service = service
+        self.deep = deep
         self.client = garmin_client.create(service)
 
     def sync(self):
         self.sync_user()
         self.sync_measures()
+        garmin_client.sessions.log_stats()
 
     def sync_user(self):
         logging.debug('sync_user: %s', self.client.profile)
 
     def sync_measures(self):
+        # A legacy series holds measures in the API's order, with naive dates;
+        # rewrite it sorted before splicing anything into it.
+        migrated = Series.migrate(self.service.key)
         end_date = datetime.datetime.now(tz=datetime.timezone.utc).date()
-        start_date = end_date - datetime.timedelta(days=365)
+        bounds = Series.bounds(self.service.key)
+        if bounds is None:
+            start_date = end_date - datetime.timedelta(days=INITIAL_SYNC_DAYS)
+        else:
+            start_date = bounds[1].date() - datetime.timedelta(days=SYNC_OVERLAP_DAYS)
+
+        changes = [self._sync_window(start_date, end_date)]
+        if self.deep:
+            oldest = bounds[0].date() if bounds is not None else start_date
+            changes.extend(self._sync_history(min(oldest, start_date)))
+
+        changes = [change for change in changes if change is not None]
+        if migrated:
+            series = Series.get(self.service.key)
+            WeightTrendSnapshot.rebuild(self.service.key, series['measures'])
+        elif changes:
+            WeightTrendSnapshot.update(
+                self.service.key, min(changes, key=lambda change: change.start)
+            )
 
-        # stats = self.client.get_stats(end_date.isoformat())
+    def _sync_history(self, before):
+        """Syncs a year at a time before before, until one has no measures."""
+        changes = []
+        for _ in range(MAX_HISTORY_WINDOWS):
+            end_date = before - datetime.timedelta(days=1)
+            start_date = before - datetime.timedelta(days=HISTORY_WINDOW_DAYS)
+            measures = self._fetch(start_date, end_date)
+            if not measures:
+                logging.info('Garmin history ends before: %s', before)
+                break
+            changes.append(Series.upsert(self.service.key, measures))
+            before = start_date
+        return changes
+
+    def _sync_window(self, start_date, end_date):
+        return Series.upsert(self.service.key, self._fetch(start_date, end_date))
+
+    def _fetch(self, start_date, end_date):
         body_comp = self.client.get_body_comp(
             start_date.isoformat(), end_date.isoformat()
         )
-
-        series = Series.to_entity(body_comp['dateWeightList'], parent=self.service.key)
-
-        ds_util.client.put(series)
+        measures = [
+            GarminConverters.Measure.to_entity(item, parent=self.service.key)
+            for item in (body_comp or {}).get('dateWeightList', [])
+        ]
+        logging.debug(
+            'Fetched %s measures from %s to %s', len(measures), start_date, end_date
+        )
+        return measures
 
 
 class TrackWorker(object):
@@ -119,8 +207,16 @@ class TrackWorker(object):
             )
             return responses.OK_INVALID_LIVETRACK
 
-        track_entity = _process_livetrack(self.url, url_info)
-        ds_util.client.put(track_entity)
+        fetched = _process_livetrack(self.url, url_info)
+        with ds_util.client.transaction():
+            track_entity = ds_util.client.get(fetched.key)
+            if track_entity is None:
+                track_entity = fetched
+            else:
+                # The same email can be seen again, e.g., by a full Gmail sync,
+                # so merge into the stored track, keeping what's been polled.
+                _merge_track(track_entity, fetched)
+            ds_util.client.put(track_entity)
         if track_entity.get('status', Track.STATUS_UNKNOWN) <= 0:
             logging.warning('Sync failed: %s', track_entity)
             return responses.OK_INVALID_LIVETRACK
@@ -129,9 +225,143 @@ class TrackWorker(object):
             # Ship the track off to slack to get posted.
             task_util.slack_tasks_livetrack(track_entity)
 
+        if track_entity['status'] in LiveTrackPoller.ACTIVE and not track_entity.get(
+            'polls'
+        ):
+            try:
+                task_util.garmin_tasks_livetrack_poll(self.url, 0)
+            except AlreadyExists:
+                logging.debug('LiveTrack: Already polling: %s', self.url)
+
         return responses.OK
 
 
+class LiveTrackPoller(object):
+    """Polls an active LiveTrack for new points, until its session ends.
+
+    Each poll fetches only the points after the latest stored, using from=,
+    and appends them to the track as a TrackPoints chunk. The next poll is
+    queued soon while points are arriving, and later and later while they
+    aren't. Polling stops when the session ends, or when it's been idle
+    for LIVETRACK_IDLE_TIMEOUT.
+    """
+
+    ACTIVE = (Track.STATUS_INFO, Track.STATUS_STARTED)
+
+    def __init__(self, url: str):
+        self.url = url
+
+    def sync(self):
+        track = ds_util.client.get(ds_util.client.key('Track', self.url))
+        if track is None or track['status'] not in self.ACTIVE:
+            logging.debug('LiveTrack: Not polling inactive track: %s', self.url)
+            return track
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        session = requests.Session()
+        last_millis = track.get('last_point_millis')
+        points = [
+            point
+            for point in self._fetch_points(session, track, now)
+            if last_millis is None or track_util.millis(point) > last_millis
+        ]
+
+        entities = [track]
+        track.setdefault('poll_started_at', now)
+        track['polls'] = track.get('polls', 0) + 1
+        track['polled_at'] = now
+        if points:
+            track['points_chunks'] = track.get('points_chunks', 0) + 1
+            entities.append(
+                TrackPoints.to_entity(track.key, track['points_chunks'], points)
+            )
+            track['points_count'] = track.get('points_count', 0) + len(points)
+            positions = track_util.positions(points)
+            if positions:
+                track['polyline'] = track.get('polyline', '') + (
+                    track_util.encode_polyline(positions, track.get('polyline_end'))
+                )
+                track['polyline_end'] = list(positions[-1])
+            track['last_point_millis'] = track_util.millis(points[-1])
+            track['last_point_at'] = now
+            track['poll_interval'] = int(LIVETRACK_POLL_MIN_INTERVAL.total_seconds())
+            track['status'] = Track.STATUS_STARTED
+        else:
+            interval = track.get('poll_interval') or 0
+            track['poll_interval'] = int(
+                min(
+                    max(2 * interval, LIVETRACK_POLL_MIN_INTERVAL.total_seconds()),
+                    LIVETRACK_POLL_MAX_INTERVAL.total_seconds(),
+                )
+            )
+            self._check_ended(session, track, now)
+
+        idle_since = track.get('last_point_at') or track['poll_started_at']
+        if track['status'] in self.ACTIVE and now - idle_since > LIVETRACK_IDLE_TIMEOUT:
+            logging.info('LiveTrack: Idle since %s: %s', idle_since, self.url)
+            track['status'] = Track.STATUS_FINISHED
+        ds_util.client.put_multi(entities)
+
+        logging.info(
+            'LiveTrack: Poll %s found %s points, %s in all: %s',
+            track['polls'],
+            len(points),
+            track.get('points_count', 0),
+            self.url,
+        )
+        if track['status'] in self.ACTIVE:
+            task_util.garmin_tasks_livetrack_poll(
+                self.url,
+                track['polls'],
+                delay_timedelta=datetime.timedelta(seconds=track['poll_interval']),
+            )
+        return track
+
+    def _fetch_points(self, session, track, now):
+        url_info = dict(track['url_info'], requestTime=int(now.timestamp() * 1000))
+        if track.get('last_point_millis') is None:
+            url = LIVETRACK_TRACKPOINTS_FIRST_URL % url_info
+        else:
+            url = LIVETRACK_TRACKPOINTS_URL % dict(
+                url_info, **{'from': track['last_point_millis']}
+            )
+        response = session.get(url)
+        if response.status_code != 200:
+            logging.warning(
+                'LiveTrack: http %s fetching points: %s', response.status_code, url
+            )
+            return []
+        return (response.json() or {}).get('trackPoints') or []
+
+    def _check_ended(self, session, track, now):
+        """Refreshes the session's info, to see whether it has ended."""
+        request_time_millis = int(now.timestamp() * 1000)
+        response = session.get(
+            LIVETRACK_INFO_URL
+            % dict(**track['url_info'], **{'requestTime': request_time_millis})
+        )
+        if response.status_code != 200:
+            return
+        info = response.json()
+        if info.get('statusCode', 200) != 200:
+            return
+        track['info'] = info
+        if 'end' in info['session']:
+            track['end'] = dateutil.parser.parse(info['session']['end'])
+            track['status'] = Track.STATUS_FINISHED
+
+
+def _merge_track(track: Entity, fetched: Entity):
+    """Updates a stored track with newly fetched info, if there is any."""
+    if fetched['status'] <= Track.STATUS_UNKNOWN:
+        return
+    for name in ('info', 'start', 'end'):
+        if name in fetched:
+            track[name] = fetched[name]
+    # A finished track stays finished, even if the poller gave up on it.
+    track['status'] = max(track.get('status', Track.STATUS_UNKNOWN), fetched['status'])
+
+
 def _process_livetrack(url: str, url_info: dict) -> Entity:
     """Now we know enough to fetch livetrack info."""
     track = {'url': url, 'url_info': url_info}
@@ -180,38 +410,5 @@ def _process_livetrack(url: str, url_info: dict) -> Entity:
             )
         return Track.to_entity(track)
 
-    # Gets some coures info, like perhaps, where they currently are.
-    response = session.get(
-        LIVETRACK_TRACKPOINTS_FIRST_URL
-        % dict(**track['url_info'], **{'requestTime': request_time_millis})
-    )
-    if response.status_code != 200:
-        logging.debug('Invalid LiveTrack: %s http failed fetching points', url)
-        track['status'] = Track.STATUS_FAILED
-        return Track.to_entity(track)
-
-    response_json = response.json
-    logging.debug('Ended Track: %s', json.dumps(response_json))
-    logging.debug('Trackpoints Response json: %s', json.dumps(response_json))
-    track['trackpoints'] = response_json
-    track['status'] = Track.STATUS_TRACKPOINTS
-
-    if not 'trackPoints' not in track:
-        logging.debug('Invalid LiveTrack: %s (0 points)', url)
-    logging.debug(
-        'Found livetrack points: %s -> %s',
-        url,
-        len(track['trackPoints']),
-    )
-    most_recent_millis = (
-        dateutil.parser.parse(track['trackPoints'][-1]['dateTime']).timestamp() * 1000
-    )
-    # I can use most_recent_millis to get only the latest points from livetracks, if i wanted.
-    logging.debug(
-        'Found most recent livetrack points: %s: %s %s',
-        url,
-        response.url,
-        most_recent_millis,
-    )
-    track['status'] = Track.SUCCESS
+    # LiveTrackPoller fetches the points, as they come.
     return Track.to_entity(track)
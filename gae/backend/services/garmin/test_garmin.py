@@ -12,16 +12,25 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
+import datetime
 import json
 import mock
 import unittest
 
 import flask
+from google.api_core.exceptions import AlreadyExists
+from google.cloud.datastore.entity import Entity
 from requests import Session, Response
 
+from shared import ds_util
 from shared import responses
 from shared import task_util
-from shared.datastore.track import Track
+from shared import testing_util
+from shared import track_util
+from shared.datastore.series import Series
+from shared.datastore.track import Track, TrackPoints
+from shared.datastore.weight_trend import WeightTrendSnapshot
 
 from services.garmin import garmin
 
@@ -60,9 +69,13 @@ class TrackWorkerTest(unittest.TestCase):
         responses.assertResponse(self, responses.OK_INVALID_LIVETRACK, r)
 
     @mock.patch('shared.task_util._queue_task')
+    @mock.patch('shared.ds_util.client.transaction')
+    @mock.patch('shared.ds_util.client.get', return_value=None)
     @mock.patch('shared.ds_util.client.put')
     @mock.patch.object(Session, 'get')
-    def test_failed_info_url(self, mock_session_get, mock_put, mock_queue_task):
+    def test_failed_info_url(
+        self, mock_session_get, mock_put, mock_get, mock_transaction, mock_queue_task
+    ):
         instance = mock.MagicMock(Response)
         instance.status_code = 500
         mock_session_get.return_value = instance
@@ -78,9 +91,13 @@ class TrackWorkerTest(unittest.TestCase):
         self.assertEqual(track.get('status'), Track.STATUS_FAILED)
 
     @mock.patch('shared.task_util._queue_task')
+    @mock.patch('shared.ds_util.client.transaction')
+    @mock.patch('shared.ds_util.client.get', return_value=None)
     @mock.patch('shared.ds_util.client.put')
     @mock.patch.object(Session, 'get')
-    def test_finished(self, mock_session_get, mock_put, mock_queue_task):
+    def test_finished(
+        self, mock_session_get, mock_put, mock_get, mock_transaction, mock_queue_task
+    ):
         instance = mock.MagicMock(Response)
         instance.status_code = 200
         instance.json.return_value = INFO_URL_RESPONSE
@@ -97,9 +114,13 @@ class TrackWorkerTest(unittest.TestCase):
         self.assertEqual(track.get('status'), Track.STATUS_FINISHED)
 
     @mock.patch('shared.task_util._queue_task')
+    @mock.patch('shared.ds_util.client.transaction')
+    @mock.patch('shared.ds_util.client.get', return_value=None)
     @mock.patch('shared.ds_util.client.put')
     @mock.patch.object(Session, 'get')
-    def test_404(self, mock_session_get, mock_put, mock_queue_task):
+    def test_404(
+        self, mock_session_get, mock_put, mock_get, mock_transaction, mock_queue_task
+    ):
         """Test that a 200 http response, for a track that is unavailable with an in-json status code, is handled."""
         instance = mock.MagicMock(Response)
         instance.status_code = 200
@@ -117,6 +138,163 @@ class TrackWorkerTest(unittest.TestCase):
         self.assertEqual(track.get('status'), Track.STATUS_FAILED)
 
 
+class LiveTrackPollerTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = testing_util.fake_datastore(self)
+        self.stored = self.fake.stored
+        patchers = [
+            mock.patch('shared.task_util.garmin_tasks_livetrack_poll'),
+            mock.patch('shared.task_util.slack_tasks_livetrack'),
+            mock.patch.object(Session, 'get'),
+        ]
+        self.poll_mock, _, session_get_mock = [p.start() for p in patchers]
+        for patcher in patchers:
+            self.addCleanup(patcher.stop)
+        session_get_mock.side_effect = self._get
+
+        self.info = copy.deepcopy(INFO_URL_RESPONSE)
+        del self.info['session']['end']
+        self.points = []
+        self.requested = []
+
+    def _get(self, url):
+        self.requested.append(url)
+        response = mock.MagicMock(Response)
+        response.status_code = 200
+        if '/trackpoints' in url:
+            from_millis = int(url.split('from=')[1]) if 'from=' in url else 0
+            response.json.return_value = {
+                'trackPoints': [
+                    p
+                    for p in self.points
+                    if track_util.millis(p) >= from_millis  # from= is inclusive.
+                ]
+            }
+        else:
+            response.json.return_value = self.info
+        return response
+
+    def _add_points(self, count):
+        start = len(self.points)
+        self.points.extend(
+            {
+                'dateTime': '2021-04-11T15:%02d:00.000Z' % (i,),
+                'position': {'lat': 37.7 + i / 1000, 'lon': -122.4},
+                'altitude': 50.0,
+                'speed': 6.2,
+                'fitnessPointData': {'heartRateBeatsPerMin': 140 + i},
+            }
+            for i in range(start, start + count)
+        )
+
+    def _track(self):
+        return self.stored[ds_util.client.key('Track', INFO_URL_EXAMPLE['url'])]
+
+    def _poll(self):
+        return garmin.LiveTrackPoller(INFO_URL_EXAMPLE['url']).sync()
+
+    def test_polls_deltas(self):
+        garmin.TrackWorker(url=INFO_URL_EXAMPLE['url']).sync()
+        self.poll_mock.assert_called_once_with(INFO_URL_EXAMPLE['url'], 0)
+
+        self._add_points(3)
+        self._poll()
+        self.assertNotIn('from=', self.requested[-1])
+        self._add_points(2)
+        track = self._poll()
+        self.assertIn(
+            'from=%s' % (track_util.millis(self.points[2]),), self.requested[-1]
+        )
+
+        self.assertEqual(Track.STATUS_STARTED, track['status'])
+        self.assertEqual(5, track['points_count'])
+        self.assertEqual(2, track['points_chunks'])
+        self.assertEqual(
+            [p['fitnessPointData'] for p in self.points],
+            [p['fitnessPointData'] for p in TrackPoints.get_all(self._track())],
+        )
+        self.poll_mock.assert_called_with(
+            INFO_URL_EXAMPLE['url'],
+            2,
+            delay_timedelta=garmin.LIVETRACK_POLL_MIN_INTERVAL,
+        )
+
+    @mock.patch('shared.ds_util.MAX_LOOKUP_KEYS', 2)
+    def test_points_read_in_batches(self):
+        garmin.TrackWorker(url=INFO_URL_EXAMPLE['url']).sync()
+        for _ in range(5):
+            self._add_points(1)
+            self._poll()
+
+        points = TrackPoints.get_all(self._track())
+
+        self.assertEqual(
+            [p['fitnessPointData'] for p in self.points],
+            [p['fitnessPointData'] for p in points],
+        )
+        self.assertEqual(
+            [2, 2, 1],
+            [len(c.args[0]) for c in self.fake.mocks['get_multi'].call_args_list],
+        )
+
+    def test_backs_off_then_stops_when_ended(self):
+        garmin.TrackWorker(url=INFO_URL_EXAMPLE['url']).sync()
+        self._add_points(1)
+        self._poll()
+
+        self.assertEqual(60, self._poll()['poll_interval'])
+        self.assertEqual(120, self._poll()['poll_interval'])
+
+        self.info['session']['end'] = '2021-04-11T20:28:36.000Z'
+        track = self._poll()
+        self.assertEqual(Track.STATUS_FINISHED, track['status'])
+        self.assertEqual(3, self.poll_mock.call_count - 1)
+
+        # Nothing is polled once it's finished.
+        requests = len(self.requested)
+        self._poll()
+        self.assertEqual(requests, len(self.requested))
+
+    def test_stops_when_idle(self):
+        garmin.TrackWorker(url=INFO_URL_EXAMPLE['url']).sync()
+        self._add_points(1)
+        self._poll()
+        track = self._track()
+        track['last_point_at'] -= garmin.LIVETRACK_IDLE_TIMEOUT * 2
+        self.stored[track.key] = track
+
+        self.assertEqual(Track.STATUS_FINISHED, self._poll()['status'])
+
+    def test_resync_keeps_points(self):
+        garmin.TrackWorker(url=INFO_URL_EXAMPLE['url']).sync()
+        self._add_points(3)
+        self._poll()
+
+        # A full Gmail sync sees the email again.
+        garmin.TrackWorker(url=INFO_URL_EXAMPLE['url']).sync()
+        self.poll_mock.assert_called_with(
+            INFO_URL_EXAMPLE['url'],
+            1,
+            delay_timedelta=garmin.LIVETRACK_POLL_MIN_INTERVAL,
+        )
+        self.assertEqual(1, self._track()['points_chunks'])
+
+        self.info['session']['end'] = '2021-04-11T20:28:36.000Z'
+        garmin.TrackWorker(url=INFO_URL_EXAMPLE['url']).sync()
+        track = self._track()
+        self.assertEqual(Track.STATUS_FINISHED, track['status'])
+        self.assertEqual(3, track['points_count'])
+        self.assertEqual(3, len(TrackPoints.get_all(track)))
+        self.assertEqual(2, self.poll_mock.call_count)
+
+    def test_already_polling(self):
+        self.poll_mock.side_effect = AlreadyExists('Task already exists')
+
+        r = garmin.TrackWorker(url=INFO_URL_EXAMPLE['url']).sync()
+
+        responses.assertResponse(self, responses.OK, r)
+
+
 INFO_URL_EXAMPLE = {
     'session': 'session-session',
     'token': 'TOKENTOKEN',
@@ -219,3 +397,113 @@ INFO_URL_RESPONSE_NOT_FOUND = json.loads(
 }
 """
 )
+
+
+class WorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.stored = testing_util.fake_datastore(self).stored
+        patcher = mock.patch('shared.services.garmin.client.create')
+        create_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.service = Entity(ds_util.client.key('Service', 'garmin'))
+        self.today = datetime.datetime.now(tz=datetime.timezone.utc).date()
+        # A weight every 30 days, for three and a half years.
+        self.weights = [
+            _weight(self.today - datetime.timedelta(days=days), 70000 + days)
+            for days in range(1260, -1, -30)
+        ]
+        self.client = create_mock.return_value
+        self.client.get_body_comp.side_effect = self._get_body_comp
+
+    def _get_body_comp(self, start_date, end_date):
+        start = datetime.date.fromisoformat(start_date)
+        end = datetime.date.fromisoformat(end_date)
+        return {
+            'dateWeightList': [
+                w for w in self.weights if start <= _date(w).date() <= end
+            ]
+        }
+
+    def _measures(self):
+        return Series.get(self.service.key)['measures']
+
+    def test_sync_measures_incremental(self):
+        garmin.Worker(self.service).sync_measures()
+
+        year_ago = self.today - datetime.timedelta(days=garmin.INITIAL_SYNC_DAYS)
+        self.client.get_body_comp.assert_called_once_with(
+            year_ago.isoformat(), self.today.isoformat()
+        )
+        self.assertEqual(13, len(self._measures()))
+
+        self.weights.append(_weight(self.today, 80000))
+        self.weights[-2]['weight'] = 79000
+        garmin.Worker(self.service).sync_measures()
+
+        overlap = self.today - datetime.timedelta(days=garmin.SYNC_OVERLAP_DAYS)
+        self.client.get_body_comp.assert_called_with(
+            overlap.isoformat(), self.today.isoformat()
+        )
+        measures = self._measures()
+        self.assertEqual(13, len(measures))
+        self.assertEqual(80.0, measures[-1]['weight'])
+        self.assertEqual(70.03, measures[-2]['weight'])
+
+    def test_sync_measures_deep(self):
+        garmin.Worker(self.service, deep=True).sync_measures()
+
+        self.assertEqual(len(self.weights), len(self._measures()))
+        # The first window, then four years back, the last of them empty.
+        self.assertEqual(5, self.client.get_body_comp.call_count)
+
+    def test_sync_measures_legacy_series(self):
+        # Stored as the API returned them, newest first, with naive dates and
+        # keys without ids.
+        series = Entity(Series.key(self.service.key))
+        series['measures'] = []
+        for weight in reversed(self.weights[-13:]):
+            measure = Entity(ds_util.client.key('Measure', parent=self.service.key))
+            measure.update(
+                {
+                    'date': _date(weight).replace(tzinfo=None),
+                    'weight': weight['weight'] / 1000,
+                }
+            )
+            series['measures'].append(measure)
+        self.stored[series.key] = series
+
+        self.weights[-1]['weight'] = 80000
+        garmin.Worker(self.service).sync_measures()
+
+        measures = self._measures()
+        self.assertTrue(Series.is_sharded(self.stored[series.key]))
+        # Today's measure was replaced, not added alongside the naive one.
+        self.assertEqual(13, len(measures))
+        self.assertEqual(
+            sorted(m['date'] for m in measures), [m['date'] for m in measures]
+        )
+        self.assertEqual(80.0, measures[-1]['weight'])
+        snapshot = self.stored[WeightTrendSnapshot.key(self.service.key)]
+        self.assertEqual(
+            80.0, WeightTrendSnapshot.lookback(snapshot, 0, self.today)['weight']
+        )
+
+    def test_measure_keys(self):
+        measure = Series.to_entity(self.weights[:1], self.service.key)['measures'][0]
+
+        self.assertEqual(self.weights[0]['timestampGMT'] // 1000, measure.key.id)
+        self.assertEqual(_date(self.weights[0]), measure['date'])
+
+
+def _weight(date, weight):
+    timestamp = datetime.datetime.combine(
+        date, datetime.time(7, 13), tzinfo=datetime.timezone.utc
+    ).timestamp()
+    return {'timestampGMT': int(timestamp * 1000), 'weight': weight, 'bodyFat': 20.0}
+
+
+def _date(weight):
+    return datetime.datetime.fromtimestamp(
+        weight['timestampGMT'] / 1000, tz=datetime.timezone.utc
+    )
@@ -0,0 +1,196 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares finding LiveTrack links in full messages with the two stages.
+
+"legacy" is what the Gmail workers used to do: fetch every message in full,
+then decode the body of each one from Garmin and parse it with
+BeautifulSoup. "two-stage" fetches only From and Subject for every message,
+and then fetches in full and regex-scans the text/html part of only those
+from Garmin. Bytes are of the JSON responses, and messages per second
+include decoding them, as the Gmail client does.
+
+The corpus is built from templates shaped like Garmin's LiveTrack emails
+and the newsletters and notifications around them in an inbox.
+
+Usage, from gae/backend:
+    python -m services.google.benchmark_garmin_email --messages 1000
+"""
+
+import argparse
+import base64
+import json
+import re
+import time
+
+from bs4 import BeautifulSoup
+
+from services.google import google
+
+
+_GARMIN_HTML = """<!DOCTYPE html><html><head><meta charset="utf-8">
+<style>td {{ font-family: Helvetica, Arial, sans-serif; }}</style></head>
+<body style="margin:0;padding:0;background-color:#f4f4f4">
+<table role="presentation" width="100%" cellpadding="0" cellspacing="0">
+{rows}
+<tr><td align="center" style="padding:24px">
+<a class="button" style="background:#11a9ed;color:#fff;padding:12px 24px"
+ href="https://livetrack.garmin.com/session/{session}/token/{token}">Watch
+ {name}'s live activity now</a></td></tr>
+<tr><td style="font-size:11px;color:#777">
+<a href="https://www.garmin.com/en-US/privacy/">Privacy</a> |
+<a href="https://www.garmin.com/en-US/legal/">Legal</a></td></tr>
+</table></body></html>"""
+
+_NEWSLETTER_HTML = """<!DOCTYPE html><html><head><meta charset="utf-8"></head>
+<body><table width="100%" cellpadding="0" cellspacing="0">
+{rows}
+<tr><td><a href="https://example.com/unsubscribe?u={session}">Unsubscribe</a>
+</td></tr></table></body></html>"""
+
+_ROW = (
+    '<tr><td style="padding:8px 24px;font-size:14px;line-height:20px;'
+    'color:#333333">Paragraph {i} of the email, with a'
+    ' <a href="https://example.com/{i}?utm_source=email&amp;utm_medium={i}">'
+    'link</a> and some more words to fill it out.</td></tr>'
+)
+
+
+def _message(i, garmin):
+    name = 'Rider %s' % (i,)
+    if garmin:
+        sender = google.GARMIN_FROM
+        subject = "Watch %s's live activity now!" % (name,)
+        template, rows = _GARMIN_HTML, 20
+    else:
+        sender = 'News <news@example.com>'
+        subject = 'Your weekly digest, issue %s' % (i,)
+        template, rows = _NEWSLETTER_HTML, 60
+    body = template.format(
+        rows='\n'.join(_ROW.format(i=r) for r in range(rows)),
+        session='%08x' % (i,),
+        token='%032x' % (i,),
+        name=name,
+    )
+    headers = [
+        {'name': 'Delivered-To', 'value': 'rides@example.com'},
+        {'name': 'Received', 'value': 'from mail.example.com by mx.google.com'},
+        {'name': 'From', 'value': sender},
+        {'name': 'To', 'value': 'rides@example.com'},
+        {'name': 'Subject', 'value': subject},
+        {'name': 'Content-Type', 'value': 'multipart/alternative'},
+    ]
+    return {
+        'id': '%016x' % (i,),
+        'historyId': str(1000 + i),
+        'snippet': subject,
+        'payload': {
+            'mimeType': 'multipart/alternative',
+            'headers': headers,
+            'body': {'size': 0},
+            'parts': [
+                {
+                    'mimeType': 'text/plain',
+                    'body': {'data': _encode(re.sub('<[^>]+>', '', body))},
+                },
+                {'mimeType': 'text/html', 'body': {'data': _encode(body)}},
+            ],
+        },
+    }
+
+
+def _metadata(message):
+    """The message as a metadata-format get returns it."""
+    return {
+        'id': message['id'],
+        'historyId': message['historyId'],
+        'snippet': message['snippet'],
+        'payload': {
+            'mimeType': message['payload']['mimeType'],
+            'headers': [
+                h
+                for h in message['payload']['headers']
+                if h['name'] in google.METADATA_HEADERS
+            ],
+        },
+    }
+
+
+def _encode(text):
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ASCII')
+
+
+def _legacy(corpus):
+    urls, transferred = [], 0
+    for message_id, full, _ in corpus:
+        transferred += len(full)
+        message = json.loads(full)
+        if not google._is_garmin_message(message_id, message):
+            continue
+        body = google._html_body(message['payload'])
+        soup = BeautifulSoup(body, features='html.parser')
+        links = soup.findAll('a', href=re.compile('livetrack.garmin.com'))
+        if len(links) == 1:
+            urls.append(links[0]['href'])
+    return urls, transferred
+
+
+def _two_stage(corpus):
+    urls, transferred = [], 0
+    for message_id, full, metadata in corpus:
+        transferred += len(metadata)
+        if not google._is_garmin_message(message_id, json.loads(metadata)):
+            continue
+        transferred += len(full)
+        url = google._extract_garmin_url(message_id, json.loads(full))
+        if url is not None:
+            urls.append(url)
+    return urls, transferred
+
+
+def main(messages, garmin_every, iterations):
+    corpus = []
+    for i in range(messages):
+        message = _message(i, garmin=i % garmin_every == 0)
+        corpus.append(
+            (message['id'], json.dumps(message), json.dumps(_metadata(message)))
+        )
+    garmin = sum(1 for i in range(messages) if i % garmin_every == 0)
+    print('%d messages, %d from Garmin' % (messages, garmin))
+
+    print('%-10s %8s %12s %14s' % ('approach', 'links', 'bytes', 'messages/s'))
+    expected = None
+    for name, run in (('legacy', _legacy), ('two-stage', _two_stage)):
+        best = None
+        for _ in range(iterations):
+            start = time.perf_counter()
+            urls, transferred = run(corpus)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        if expected is None:
+            expected = urls
+        assert urls == expected, name
+        print('%-10s %8d %12d %14.0f' % (name, len(urls), transferred, messages / best))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument(
+        '--garmin-every', type=int, default=10, help='One in this many is Garmin.'
+    )
+    parser.add_argument('--iterations', type=int, default=3)
+    args = parser.parse_args()
+
+    main(args.messages, args.garmin_every, args.iterations)
@@ -13,14 +13,17 @@
 # limitations under the License.
 
 import base64
+import collections
+import html
+import itertools
 import json
 import logging
 import re
 
 import flask
-from bs4 import BeautifulSoup
 
 from google.cloud.datastore.entity import Entity
+from googleapiclient.errors import HttpError
 
 from shared import auth_util
 from shared import ds_util
@@ -39,6 +42,28 @@ import sync_helper
 module = flask.Blueprint('google', __name__)
 
 SUBJECT_REGEX = re.compile(r"Watch (?P<name>.*)'s live activity now!")
+GARMIN_FROM = 'Garmin <noreply@garmin.com>'
+
+# Links, quoted or not, to livetrack.garmin.com.
+LIVETRACK_HREF_REGEX = re.compile(
+    r"""<a\s[^>]*?href\s*=\s*(?:"([^"]*livetrack\.garmin\.com[^"]*)"|"""
+    r"""'([^']*livetrack\.garmin\.com[^']*)'|([^\s"'>]*livetrack\.garmin\.com[^\s>]*))""",
+    re.IGNORECASE,
+)
+
+# The headers fetched for every message, to pick out those from Garmin.
+METADATA_HEADERS = ('From', 'Subject')
+
+# Messages are listed, and fetched, this many at a time; Gmail batches hold
+# at most 100 requests.
+BATCH_SIZE = 100
+
+# A full sync, with no history to go from, only looks at the latest messages.
+FULL_SYNC_MESSAGES = 100
+
+# A message that fails to fetch is retried by the next syncs, until it has
+# failed this many times.
+MAX_MESSAGE_ATTEMPTS = 3
 
 
 @module.route('/tasks/sync', methods=['POST'])
@@ -138,47 +163,14 @@ class Worker(object):
             return responses.OK
 
     def _full_sync(self):
-        def process_message(request_id, response, exception):
-            message_history_id = int(response['historyId'])
-            synced_history_id = self.service['settings'].get('synced_history_id', 0)
-            if message_history_id > synced_history_id:
-                self.service['settings']['synced_history_id'] = message_history_id
-                ds_util.client.put(self.service)
-
-            garmin_url = _extract_garmin_url(request_id, response)
-            if garmin_url is not None:
-                task_util.garmin_tasks_livetrack(garmin_url, publish=False)
-
-        logging.debug('Fetching the latest 100 messages')
-        request = (
-            self.client.users()
-            .messages()
-            .list(
-                userId='me',
-                labelIds=['INBOX'],
-                maxResults=100,  # Also the default, but being explicit.
+        logging.debug('Fetching the latest %s messages', FULL_SYNC_MESSAGES)
+        pipeline = MessagePipeline(self.service, self.client, publish=False)
+        pipeline.run(
+            itertools.islice(
+                _message_ids(self.client.users().messages(), _list_messages),
+                FULL_SYNC_MESSAGES,
             )
         )
-        batch_message_ids = []
-        while request is not None:
-            response = request.execute()
-            batch_message_ids += [
-                message['id'] for message in response.get('messages', [])
-            ]
-            if len(batch_message_ids) >= 100:
-                break
-            request = self.client.users().messages().list_next(request, response)
-
-        batch = self.client.new_batch_http_request(callback=process_message)
-        for message_id in list(dict.fromkeys(batch_message_ids))[:100]:
-            batch.add(
-                self.client.users()
-                .messages()
-                .get(userId='me', id=message_id, format='full'),
-                request_id=message_id,
-            )
-        batch.execute()
-
         return responses.OK
 
 
@@ -190,81 +182,206 @@ class PubsubWorker(object):
 
     def sync(self):
         logging.info('PubsubWorker: sync')
+        synced_history_id = self.service['settings'].get('synced_history_id')
+        logging.debug(f"Fetching messages after {synced_history_id}")
 
-        def process_message(request_id, response, exception):
-            message_history_id = int(response['historyId'])
-            synced_history_id = self.service['settings'].get('synced_history_id', 0)
-            if message_history_id > synced_history_id:
-                self.service['settings']['synced_history_id'] = message_history_id
-                ds_util.client.put(self.service)
-
-            garmin_url = _extract_garmin_url(request_id, response)
-            if garmin_url is not None:
-                task_util.garmin_tasks_livetrack(garmin_url, publish=True)
-
-        logging.debug(
-            f"Fetching messages after {self.service['settings']['synced_history_id']}"
-        )
-        request = (
-            self.client.users()
-            .history()
-            .list(
+        def list_history(history):
+            return history.list(
                 userId='me',
                 labelId='INBOX',
-                startHistoryId=self.service['settings'].get('synced_history_id'),
-                maxResults=100,  # Also the default, but being explicit.
+                startHistoryId=synced_history_id,
+                historyTypes=['messageAdded'],
+                maxResults=BATCH_SIZE,
+            )
+
+        pipeline = MessagePipeline(self.service, self.client, publish=True)
+        pipeline.run(_message_ids(self.client.users().history(), list_history))
+        return responses.OK
+
+
+class MessagePipeline(object):
+    """Streams messages through a metadata fetch, then a full one if needed.
+
+    Message ids are deduped, then fetched BATCH_SIZE at a time with only
+    their From and Subject headers; only those from Garmin are fetched in
+    full, for their LiveTrack links. The service's synced_history_id is
+    written once per batch, after it has been processed, so the next sync
+    starts after it and nothing is published twice.
+
+    Messages that fail to fetch are recorded in the service's
+    failed_messages, by id, with the number of times they have, and are
+    retried first by the next syncs, until MAX_MESSAGE_ATTEMPTS.
+    """
+
+    def __init__(self, service: Entity, client, publish: bool):
+        self.service = service
+        self.client = client
+        self.publish = publish
+        self.stats = collections.Counter()
+        self._seen = set()
+        self._failed = dict(service['settings'].get('failed_messages', {}))
+        self._batch_failed = set()
+
+    def run(self, message_ids):
+        retries = list(self._failed)
+        if retries:
+            logging.info('MessagePipeline: Retrying failed messages: %s', retries)
+        batch = []
+        for message_id in itertools.chain(retries, message_ids):
+            self.stats['listed'] += 1
+            if message_id in self._seen:
+                self.stats['duplicates'] += 1
+                continue
+            self._seen.add(message_id)
+            batch.append(message_id)
+            if len(batch) == BATCH_SIZE:
+                self._process(batch)
+                batch = []
+        if batch:
+            self._process(batch)
+        if self._failed:
+            logging.warning(
+                'MessagePipeline: Failed messages, to retry: %s', self._failed
             )
+        logging.info('MessagePipeline: %s: %s', self.service.key, dict(self.stats))
+
+    def _process(self, message_ids):
+        self._batch_failed = set()
+        messages = self._fetch(
+            message_ids, 'metadata', metadataHeaders=list(METADATA_HEADERS)
         )
-        batch_message_ids = []
-        while request is not None:
-            response = request.execute()
-            for history in response.get('history', []):
-                batch_message_ids += [
-                    message['id'] for message in history.get('messages', [])
-                ]
-            if len(batch_message_ids) >= 100:
-                break
-            request = self.client.users().history().list_next(request, response)
-
-        batch = self.client.new_batch_http_request(callback=process_message)
-        for message_id in list(dict.fromkeys(batch_message_ids))[:100]:
+        garmin_ids = [
+            message_id
+            for message_id, message in messages.items()
+            if _is_garmin_message(message_id, message)
+        ]
+        for message_id, message in self._fetch(garmin_ids, 'full').items():
+            garmin_url = _extract_garmin_url(message_id, message)
+            if garmin_url is not None:
+                self.stats['livetracks'] += 1
+                task_util.garmin_tasks_livetrack(garmin_url, publish=self.publish)
+        for message_id in message_ids:
+            if message_id in self._batch_failed:
+                continue
+            if self._failed.pop(message_id, None) is not None:
+                self.stats['recovered'] += 1
+        self._checkpoint(messages.values())
+
+    def _fetch(self, message_ids, message_format, **kwargs):
+        """Batch gets message_ids, returning the messages fetched by id."""
+        if not message_ids:
+            return {}
+        messages = {}
+
+        def callback(request_id, response, exception):
+            if isinstance(exception, HttpError) and exception.resp.status == 404:
+                # Deleted since it was listed; there's nothing to retry.
+                logging.debug('Message not found: %s', request_id)
+                self.stats['not_found'] += 1
+                return
+            if exception is not None:
+                logging.warning(
+                    'Failed to fetch message: %s: %s', request_id, exception
+                )
+                self.stats['errors'] += 1
+                self._fail(request_id)
+                return
+            messages[request_id] = response
+            self.stats[message_format + '_fetches'] += 1
+            self.stats[message_format + '_bytes'] += len(json.dumps(response))
+
+        batch = self.client.new_batch_http_request(callback=callback)
+        for message_id in message_ids:
             batch.add(
                 self.client.users()
                 .messages()
-                .get(userId='me', id=message_id, format='full'),
+                .get(userId='me', id=message_id, format=message_format, **kwargs),
                 request_id=message_id,
             )
         batch.execute()
+        return messages
+
+    def _fail(self, message_id):
+        self._batch_failed.add(message_id)
+        attempts = self._failed.pop(message_id, 0) + 1
+        if attempts < MAX_MESSAGE_ATTEMPTS:
+            self._failed[message_id] = attempts
+            return
+        logging.error(
+            'MessagePipeline: Giving up on message after %s attempts: %s',
+            attempts,
+            message_id,
+        )
+        self.stats['abandoned'] += 1
+
+    def _checkpoint(self, messages):
+        settings = self.service['settings']
+        history_id = max((int(m['historyId']) for m in messages), default=0)
+        advanced = history_id > settings.get('synced_history_id', 0)
+        if advanced:
+            settings['synced_history_id'] = history_id
+        if advanced or self._failed != settings.get('failed_messages', {}):
+            settings['failed_messages'] = dict(self._failed)
+            ds_util.client.put(self.service)
+            self.stats['checkpoints'] += 1
+
+
+def _list_messages(messages):
+    return messages.list(userId='me', labelIds=['INBOX'], maxResults=BATCH_SIZE)
+
+
+def _message_ids(resource, list_fn):
+    """Yields the ids of messages listed by resource, page by page.
+
+    Works for both messages, whose pages list them, and history, whose
+    pages list records of them.
+    """
+    request = list_fn(resource)
+    while request is not None:
+        response = request.execute()
+        for message in response.get('messages', []):
+            yield message['id']
+        for history in response.get('history', []):
+            for message in history.get('messages', []):
+                yield message['id']
+        request = resource.list_next(request, response)
+
+
+def _is_garmin_message(request_id, message):
+    headers = _headers(message)
+    if headers.get('From') != GARMIN_FROM:
+        logging.debug('Not a garmin email: %s (Wrong From)', request_id)
+        return False
+    if not SUBJECT_REGEX.match(headers.get('Subject', '')):
+        logging.debug('Not a garmin email: %s (Wrong Subject)', request_id)
+        return False
+    return True
 
-        return responses.OK
+
+def _headers(message):
+    return dict(
+        (header['name'], header['value'])
+        for header in message['payload']['headers']
+        if header['name'] in METADATA_HEADERS
+    )
 
 
 def _extract_garmin_url(request_id, response):
+    """Returns the LiveTrack URL in a full message, if it's from Garmin.
+
+    Only the text/html part is decoded, and its links are found with a
+    regex rather than by parsing the whole document.
+    """
     logging.debug('Extracting Garmin URL: %s', request_id)
-    headers = dict(
-        [
-            (header['name'], header['value'])
-            for header in response['payload']['headers']
-            if header['name'] in ('From', 'To', 'Subject')
-        ]
-    )
-    logging.debug('Fetched message: %s', request_id)
-    if headers.get('From') != 'Garmin <noreply@garmin.com>':
-        logging.debug('Not a garmin email: %s (Wrong From)', request_id)
-        return
-    subject = SUBJECT_REGEX.match(headers.get('Subject', ''))
-    name = subject.groupdict().get('name', None) if subject else None
-    if name is None:
-        logging.debug('Not a garmin email: %s (Wrong Subject)', request_id)
+    if not _is_garmin_message(request_id, response):
         return
 
-    body = base64.urlsafe_b64decode(
-        response['payload']['body']['data'].encode('ASCII')
-    ).decode('utf-8')
-    soup = BeautifulSoup(body, features='html.parser')
+    body = _html_body(response['payload'])
+    if body is None:
+        logging.debug('Invalid Garmin email: %s (No HTML)', request_id)
+        return
     livetrack_urls = [
-        link['href']
-        for link in soup.findAll('a', href=re.compile('livetrack.garmin.com'))
+        html.unescape(''.join(groups)) for groups in LIVETRACK_HREF_REGEX.findall(body)
     ]
     if not livetrack_urls:
         logging.debug('Invalid Garmin email: %s (Unparsable)', request_id)
@@ -278,3 +395,20 @@ def _extract_garmin_url(request_id, response):
         return
 
     return livetrack_urls[0]
+
+
+def _html_body(payload):
+    """Decodes the text/html part of payload, or its body if it has no parts."""
+    parts = [payload]
+    while parts:
+        part = parts.pop(0)
+        data = part.get('body', {}).get('data')
+        if part.get('mimeType') == 'text/html' and data:
+            return _decode(data)
+        parts.extend(part.get('parts', []))
+    data = payload.get('body', {}).get('data')
+    return _decode(data) if data else None
+
+
+def _decode(data):
+    return base64.urlsafe_b64decode(data.encode('ASCII')).decode('utf-8')
@@ -0,0 +1,312 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import mock
+import unittest
+
+import httplib2
+from google.cloud.datastore.entity import Entity
+from googleapiclient.errors import HttpError
+
+from shared import ds_util
+
+from services.google import google
+from services.google.google import PubsubWorker
+
+
+class PubsubWorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.service = Entity(ds_util.client.key('Service', 'google'))
+        self.service['settings'] = {'synced_history_id': 10}
+
+    @mock.patch('shared.task_util.garmin_tasks_livetrack')
+    @mock.patch('shared.ds_util.client.put')
+    def test_sync(self, put_mock, livetrack_mock):
+        messages = {
+            'a': _message('a', 11, 'Someone <someone@example.com>', 'Hello'),
+            'b': _message(
+                'b',
+                12,
+                google.GARMIN_FROM,
+                "Watch Rider's live activity now!",
+                'https://livetrack.garmin.com/session/b/token/c',
+            ),
+        }
+        messages.update(
+            (str(i), _message(str(i), 20 + i, 'Other <other@example.com>', 'Hi'))
+            for i in range(google.BATCH_SIZE)
+        )
+        # The same message can be listed by more than one history record.
+        pages = [
+            {'history': [{'messages': [{'id': 'a'}]}, {'messages': [{'id': 'b'}]}]},
+            {'history': [{'messages': [{'id': 'a'}]}]},
+            {'history': [{'messages': [{'id': str(i)}]} for i in range(100)]},
+        ]
+        client = _FakeGmail(pages, messages)
+
+        PubsubWorker(self.service, {}, client).sync()
+
+        # Every message's headers, but only Garmin's in full.
+        self.assertEqual(
+            len(messages), sum(1 for _, f in client.fetched if f == 'metadata')
+        )
+        self.assertEqual([('b', 'full')], [f for f in client.fetched if f[1] == 'full'])
+        livetrack_mock.assert_called_once_with(
+            'https://livetrack.garmin.com/session/b/token/c', publish=True
+        )
+        # A single write per batch, of the latest history id.
+        self.assertEqual(2, put_mock.call_count)
+        self.assertEqual(
+            20 + google.BATCH_SIZE - 1,
+            self.service['settings']['synced_history_id'],
+        )
+
+    @mock.patch('shared.task_util.garmin_tasks_livetrack')
+    @mock.patch('shared.ds_util.client.put')
+    def test_sync_nothing_new(self, put_mock, livetrack_mock):
+        messages = {'a': _message('a', 9, 'Someone <someone@example.com>', 'Hello')}
+        client = _FakeGmail([{'history': [{'messages': [{'id': 'a'}]}]}], messages)
+
+        PubsubWorker(self.service, {}, client).sync()
+
+        put_mock.assert_not_called()
+        livetrack_mock.assert_not_called()
+
+    @mock.patch('shared.task_util.garmin_tasks_livetrack')
+    @mock.patch('shared.ds_util.client.put')
+    def test_sync_failed_fetch(self, put_mock, livetrack_mock):
+        garmin = (google.GARMIN_FROM, "Watch Rider's live activity now!")
+        messages = {
+            'a': _message('a', 200, *garmin, 'https://livetrack.garmin.com/session/a'),
+            'b': _message('b', 201, *garmin, 'https://livetrack.garmin.com/session/b'),
+        }
+        messages.update(
+            (str(i), _message(str(i), 20 + i, 'Other <other@example.com>', 'Hi'))
+            for i in range(google.BATCH_SIZE)
+        )
+        pages = [
+            {'history': [{'messages': [{'id': str(i)}]} for i in range(100)]},
+            {'history': [{'messages': [{'id': 'a'}]}, {'messages': [{'id': 'b'}]}]},
+            {'history': [{'messages': [{'id': 'gone'}]}]},
+        ]
+        client = _FakeGmail(pages, messages)
+        client.errors[('a', 'full')] = _http_error(500)
+        client.errors[('gone', 'metadata')] = _http_error(404)
+
+        PubsubWorker(self.service, {}, client).sync()
+
+        livetrack_mock.assert_called_once_with(
+            'https://livetrack.garmin.com/session/b', publish=True
+        )
+        # Checkpointed past a's failed fetch, so b isn't published again, with
+        # a recorded to be retried.
+        self.assertEqual(2, put_mock.call_count)
+        self.assertEqual(201, self.service['settings']['synced_history_id'])
+        self.assertEqual({'a': 1}, self.service['settings']['failed_messages'])
+
+    @mock.patch('shared.task_util.garmin_tasks_livetrack')
+    @mock.patch('shared.ds_util.client.put')
+    def test_sync_retries_failed(self, put_mock, livetrack_mock):
+        garmin = (google.GARMIN_FROM, "Watch Rider's live activity now!")
+        messages = {
+            'a': _message('a', 9, *garmin, 'https://livetrack.garmin.com/session/a'),
+            'b': _message('b', 11, 'Someone <someone@example.com>', 'Hello'),
+        }
+        self.service['settings']['failed_messages'] = {'a': 1}
+        client = _FakeGmail([{'history': [{'messages': [{'id': 'b'}]}]}], messages)
+
+        PubsubWorker(self.service, {}, client).sync()
+
+        self.assertEqual(('a', 'metadata'), client.fetched[0])
+        livetrack_mock.assert_called_once_with(
+            'https://livetrack.garmin.com/session/a', publish=True
+        )
+        put_mock.assert_called_once()
+        self.assertEqual(11, self.service['settings']['synced_history_id'])
+        self.assertEqual({}, self.service['settings']['failed_messages'])
+
+    @mock.patch('shared.task_util.garmin_tasks_livetrack')
+    @mock.patch('shared.ds_util.client.put')
+    def test_sync_gives_up_on_failed(self, put_mock, livetrack_mock):
+        messages = {'a': _message('a', 9, 'Someone <someone@example.com>', 'Hello')}
+        self.service['settings']['failed_messages'] = {
+            'a': google.MAX_MESSAGE_ATTEMPTS - 1
+        }
+        client = _FakeGmail([{'history': []}], messages)
+        client.errors[('a', 'metadata')] = _http_error(403)
+
+        PubsubWorker(self.service, {}, client).sync()
+
+        livetrack_mock.assert_not_called()
+        put_mock.assert_called_once()
+        self.assertEqual(10, self.service['settings']['synced_history_id'])
+        self.assertEqual({}, self.service['settings']['failed_messages'])
+
+    @mock.patch('shared.task_util.garmin_tasks_livetrack')
+    @mock.patch('shared.ds_util.client.put')
+    def test_sync_not_found(self, put_mock, livetrack_mock):
+        messages = {'a': _message('a', 11, 'Someone <someone@example.com>', 'Hello')}
+        pages = [
+            {'history': [{'messages': [{'id': 'gone'}]}, {'messages': [{'id': 'a'}]}]}
+        ]
+        client = _FakeGmail(pages, messages)
+        client.errors[('gone', 'metadata')] = _http_error(404)
+
+        PubsubWorker(self.service, {}, client).sync()
+
+        # A message deleted since it was listed doesn't hold the sync back.
+        self.assertEqual(11, self.service['settings']['synced_history_id'])
+
+
+class ExtractGarminUrlTest(unittest.TestCase):
+    def test_multipart(self):
+        message = _message(
+            'a', 1, google.GARMIN_FROM, "Watch Rider's live activity now!"
+        )
+        message['payload']['parts'] = [
+            {'mimeType': 'text/plain', 'body': {'data': _encode('Plain text')}},
+            {
+                'mimeType': 'text/html',
+                'body': {
+                    'data': _encode(
+                        '<a class="button"\n href="https://livetrack.garmin.com'
+                        '/session/s/token/t?a=1&amp;b=2">Watch</a>'
+                        '<a href="https://www.garmin.com">Garmin</a>'
+                    )
+                },
+            },
+        ]
+
+        self.assertEqual(
+            'https://livetrack.garmin.com/session/s/token/t?a=1&b=2',
+            google._extract_garmin_url('a', message),
+        )
+
+    def test_not_garmin(self):
+        message = _message(
+            'a',
+            1,
+            'Someone <someone@example.com>',
+            "Watch Rider's live activity now!",
+            'https://livetrack.garmin.com/session/s/token/t',
+        )
+
+        self.assertIsNone(google._extract_garmin_url('a', message))
+
+    def test_too_many_links(self):
+        message = _message(
+            'a',
+            1,
+            google.GARMIN_FROM,
+            "Watch Rider's live activity now!",
+            'https://livetrack.garmin.com/session/s/token/t',
+        )
+        message['payload']['body']['data'] = _encode(
+            "<a href='https://livetrack.garmin.com/session/s/token/t'>1</a>"
+            '<A HREF=https://livetrack.garmin.com/session/u/token/v>2</A>'
+        )
+
+        self.assertIsNone(google._extract_garmin_url('a', message))
+
+
+class _FakeGmail(object):
+    """Just enough of the Gmail client to list history and get messages."""
+
+    def __init__(self, pages, messages):
+        self.pages = pages
+        self.stored = messages
+        self.errors = {}
+        self.fetched = []
+
+    def users(self):
+        return self
+
+    def history(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def list(self, **kwargs):
+        return _Request(lambda: self.pages[0], page=0)
+
+    def list_next(self, request, response):
+        page = request.page + 1
+        if page >= len(self.pages):
+            return None
+        return _Request(lambda: self.pages[page], page=page)
+
+    def get(self, userId, id, format, **kwargs):
+        def execute():
+            self.fetched.append((id, format))
+            if (id, format) in self.errors:
+                raise self.errors[(id, format)]
+            message = dict(self.stored[id])
+            if format != 'full':
+                message['payload'] = {'headers': message['payload']['headers']}
+            return message
+
+        return _Request(execute)
+
+    def new_batch_http_request(self, callback):
+        return _Batch(callback)
+
+
+class _Request(object):
+    def __init__(self, execute, page=None):
+        self.execute = execute
+        self.page = page
+
+
+class _Batch(object):
+    def __init__(self, callback):
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        assert len(self.requests) <= google.BATCH_SIZE
+        for request_id, request in self.requests:
+            try:
+                response = request.execute()
+            except HttpError as e:
+                self.callback(request_id, None, e)
+            else:
+                self.callback(request_id, response, None)
+
+
+def _message(message_id, history_id, sender, subject, url=None):
+    body = '<a href="%s">Watch</a>' % (url,) if url else ''
+    return {
+        'id': message_id,
+        'historyId': str(history_id),
+        'payload': {
+            'headers': [
+                {'name': 'From', 'value': sender},
+                {'name': 'Subject', 'value': subject},
+            ],
+            'body': {'data': _encode(body)},
+        },
+    }
+
+
+def _http_error(status):
+    return HttpError(httplib2.Response({'status': status}), b'')
+
+
+def _encode(body):
+    return base64.urlsafe_b64encode(body.encode()).decode()
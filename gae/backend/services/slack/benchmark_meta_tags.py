@@ -0,0 +1,118 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares reading a Strava page's meta tags with BeautifulSoup and meta_tags.
+
+"beautifulsoup" is what _fetch_parse_activity_url used to do: read the
+whole response and parse it into a tree to find the meta tags.
+"meta_tags" is meta_tags.read_meta_tags, which reads only up to </head>.
+
+The page is the saved Strava activity head in testing_util, followed by a
+body of --body-kb of markup and inline script, as activity pages have.
+
+Usage, from gae/backend:
+    python -m services.slack.benchmark_meta_tags --body-kb 0 100 500
+"""
+
+import argparse
+import io
+import time
+
+from bs4 import BeautifulSoup
+
+from services.slack import meta_tags
+from services.slack.testing_util import MOCK_STRAVA_ACTIVITY_LINK_CONTENTS
+
+
+_BODY_ROW = (
+    '<div class="row"><div class="spans8"><a href="/athletes/%(i)s"'
+    ' class="minimal">Athlete %(i)s</a><span class="timestamp">Feb 22</span>'
+    '</div></div>\n'
+    '<script>pageView.segments().push({"id": %(i)s, "name": "Segment %(i)s",'
+    ' "elapsed_time": 312, "distance": 1200.5});</script>\n'
+)
+
+
+class CountingStream(object):
+    """Counts the bytes read from a response, as urlopen would return it."""
+
+    def __init__(self, contents):
+        self._stream = io.BytesIO(contents)
+        self.read_bytes = 0
+
+    def read(self, size=-1):
+        chunk = self._stream.read(size)
+        self.read_bytes += len(chunk)
+        return chunk
+
+
+def _page(body_kb):
+    head = MOCK_STRAVA_ACTIVITY_LINK_CONTENTS[
+        : MOCK_STRAVA_ACTIVITY_LINK_CONTENTS.index('</head>') + len('</head>')
+    ]
+    rows = []
+    size = 0
+    i = 0
+    while size < body_kb * 1024:
+        row = _BODY_ROW % {'i': i}
+        rows.append(row)
+        size += len(row)
+        i += 1
+    return (head + '\n<body>\n' + ''.join(rows) + '</body>\n</html>\n').encode()
+
+
+def _beautifulsoup(stream):
+    soup = BeautifulSoup(stream.read(), 'html.parser')
+    metas = soup.find_all('meta', property=True, content=True)
+    return dict((meta['property'], meta['content']) for meta in metas)
+
+
+def _meta_tags(stream):
+    return meta_tags.read_meta_tags(stream)
+
+
+def main(body_kbs, iterations):
+    print(
+        '%8s %-14s %10s %10s %14s' % ('body kb', 'approach', 'page', 'read', 'cpu (ms)')
+    )
+    for body_kb in body_kbs:
+        page = _page(body_kb)
+        expected = None
+        for name, parse_fn in (
+            ('beautifulsoup', _beautifulsoup),
+            ('meta_tags', _meta_tags),
+        ):
+            best = None
+            for _ in range(iterations):
+                stream = CountingStream(page)
+                start = time.process_time()
+                metas = parse_fn(stream)
+                elapsed = time.process_time() - start
+                best = elapsed if best is None else min(best, elapsed)
+            if expected is None:
+                expected = metas
+            assert metas == expected, name
+            print(
+                '%8d %-14s %10d %10d %14.2f'
+                % (body_kb, name, len(page), stream.read_bytes, best * 1000)
+            )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--body-kb', type=int, nargs='+', default=[0, 100, 500])
+    parser.add_argument('--iterations', type=int, default=5)
+    args = parser.parse_args()
+
+    main(args.body_kb, args.iterations)
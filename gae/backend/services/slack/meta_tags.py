@@ -0,0 +1,65 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Reads the <meta property=... content=...> tags from a page's <head>."""
+
+import codecs
+import html.parser
+
+
+# Bytes read from the page at a time.
+CHUNK_SIZE = 8 * 1024
+
+# Stop reading a page whose head runs on for longer than this.
+MAX_HEAD_BYTES = 512 * 1024
+
+
+def read_meta_tags(stream, chunk_size=CHUNK_SIZE, max_bytes=MAX_HEAD_BYTES):
+    """Returns each meta tag's property and content, in stream's <head>.
+
+    stream is read a chunk at a time, e.g., an http response, and only
+    until the head ends; the body, usually most of a page, is never read.
+    A property repeated later in the head replaces the earlier content.
+    """
+    parser = _HeadParser()
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    read = 0
+    while not parser.done and read < max_bytes:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        read += len(chunk)
+        parser.feed(decoder.decode(chunk))
+    return parser.metas
+
+
+class _HeadParser(html.parser.HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.metas = {}
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        if tag == 'meta':
+            attrs = dict(attrs)
+            if attrs.get('property') is not None and attrs.get('content') is not None:
+                self.metas[attrs['property']] = attrs['content']
+        elif tag == 'body':
+            self.done = True
+
+    def handle_endtag(self, tag):
+        if tag == 'head':
+            self.done = True
@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import concurrent.futures
 import logging
 import re
 import urllib
@@ -32,7 +33,12 @@ from shared.services.slack.installation_store import DatastoreInstallationStore
 from shared.services.strava.client import ClientWrapper
 
 from services.slack.track_blocks import create_track_blocks
-from services.slack.unfurl_activity import unfurl_activity
+from services.slack.unfurl_activity import (
+    FETCH_TIMEOUT_SECONDS,
+    page_cache,
+    unfurl_activity,
+)
+from services.slack.unfurl_cache import AppLinkCache
 from services.slack.unfurl_route import unfurl_route
 from shared import ds_util
 from shared.config import config
@@ -43,6 +49,12 @@ _TRACKS_CHANNEL_ID = 'C020755FX3L'
 _DEV_TRACKS_TEAM_ID = 'T01U4PCGSQM'
 _DEV_TRACKS_CHANNEL_ID = 'C01U82F2STD'
 
+# Links in a message are unfurled this many at a time...
+UNFURL_MAX_WORKERS = 4
+
+# ...and those that take longer than this are left out.
+UNFURL_TIMEOUT_SECONDS = 15
+
 
 module = flask.Blueprint('slack', __name__)
 
@@ -60,11 +72,25 @@ def tasks_event():
 @module.route('/tasks/livetrack', methods=['POST'])
 def tasks_livetrack():
     params = task_util.get_payload(flask.request)
-    track = params['track']
+    if 'track_key' in params:
+        track = ds_util.client.get(params['track_key'])
+    else:
+        # Tasks queued before track_key carry the whole track.
+        track = params['track']
     logging.info('process/livetrack: %s', track)
+    if track is None:
+        return responses.OK_INVALID_LIVETRACK
     return _process_track(track)
 
 
+@module.route('/tasks/unfurl_refresh', methods=['POST'])
+def tasks_unfurl_refresh():
+    params = task_util.get_payload(flask.request)
+    logging.info('UnfurlCache: Refreshing: %s', params['url'])
+    page_cache.refresh(params['url'])
+    return responses.OK
+
+
 def _process_link_shared(event):
     slack_client = _create_slack_client(event)
     unfurls = _create_unfurls(event)
@@ -117,38 +143,77 @@ def _create_slack_client_for_team(team_id):
 
 
 def _create_unfurls(event):
+    """Unfurls the event's links in parallel, leaving out any that fail.
+
+    Links still unfurling after UNFURL_TIMEOUT_SECONDS are left out, too, so
+    one slow page doesn't hold up the rest past Slack's patience.
+    """
     strava = Service.get('strava', parent=Bot.key())
     strava_client = ClientWrapper(strava)
 
+    links = list(dict((link['url'], link) for link in event['event']['links']).values())
     unfurls = {}
-    for link in event['event']['links']:
-        alt_url = _resolve_rewrite_link(link)
-        unfurl = _unfurl(strava_client, link, alt_url)
-        if unfurl:
-            unfurls[link['url']] = unfurl
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(UNFURL_MAX_WORKERS, len(links) or 1)
+    )
+    try:
+        futures = {
+            executor.submit(_resolve_unfurl, strava_client, link): link
+            for link in links
+        }
+        done, not_done = concurrent.futures.wait(
+            futures, timeout=UNFURL_TIMEOUT_SECONDS
+        )
+        for future in done:
+            link = futures[future]
+            if future.exception() is not None:
+                logging.error(
+                    '_create_unfurls: failed: %s: %s', link['url'], future.exception()
+                )
+                continue
+            if future.result():
+                unfurls[link['url']] = future.result()
+        for future in not_done:
+            logging.warning('_create_unfurls: timed out: %s', futures[future]['url'])
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
     logging.warning(f'_create_unfurls: {unfurls}')
+    page_cache.log_stats()
+    app_links.log_stats()
     return unfurls
 
 
+def _resolve_unfurl(strava_client, link):
+    alt_url = _resolve_rewrite_link(link)
+    return _unfurl(strava_client, link, alt_url)
+
+
 def _resolve_rewrite_link(link):
     if 'strava.app.link' not in link['url']:
         return
+    return app_links.resolve(link['url'])
+
+
+def _fetch_app_link(url):
     try:
-        logging.info('_resolve_rewrite_link: fetching: %s', link['url'])
-        with urllib.request.urlopen(link['url']) as response:
+        logging.info('_resolve_rewrite_link: fetching: %s', url)
+        with urllib.request.urlopen(url, timeout=FETCH_TIMEOUT_SECONDS) as response:
             contents = response.read()
-        logging.debug('_resolve_rewrite_link: fetched: %s', link['url'])
-    except urllib.request.HTTPError:
-        logging.exception('Could not fetch %s', link['url'])
+        logging.debug('_resolve_rewrite_link: fetched: %s', url)
+    except OSError:  # Including HTTPError, URLError and timeouts.
+        logging.exception('Could not fetch %s', url)
         return
     match = _STRAVA_APP_LINK_REGEX.search(str(contents))
     if match is None:
-        logging.warning('Could not resolve %s', link['url'])
+        logging.warning('Could not resolve %s', url)
         return
     resolved_url = match.group()
     return resolved_url
 
 
+app_links = AppLinkCache(_fetch_app_link)
+
+
 def _unfurl(strava_client, link, alt_url=None):
     url = alt_url if alt_url else link['url']
     if '/routes/' in url:
@@ -0,0 +1,58 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import unittest
+
+from bs4 import BeautifulSoup
+
+from services.slack import meta_tags
+from services.slack.testing_util import MOCK_STRAVA_ACTIVITY_LINK_CONTENTS
+
+
+class ReadMetaTagsTest(unittest.TestCase):
+    def test_matches_beautifulsoup(self):
+        contents = MOCK_STRAVA_ACTIVITY_LINK_CONTENTS.encode()
+        soup = BeautifulSoup(contents, 'html.parser')
+        expected = dict(
+            (meta['property'], meta['content'])
+            for meta in soup.find_all('meta', property=True, content=True)
+        )
+
+        # Small chunks split tags across reads.
+        metas = meta_tags.read_meta_tags(io.BytesIO(contents), chunk_size=7)
+
+        self.assertEqual(expected, metas)
+        self.assertIn('og:title', metas)
+
+    def test_stops_at_head(self):
+        head = (
+            '<html><head><meta property="og:title" content="Caf&eacute; ☕">'
+            '<meta name="viewport" content="width=device-width">'
+            '<meta property="og:description" content=\'Ride\'/></head>'
+        )
+        body = '<body><meta property="og:title" content="Body">' + 'x' * 10000
+        stream = io.BytesIO((head + body).encode())
+
+        # The first chunk ends mid-character.
+        metas = meta_tags.read_meta_tags(stream, chunk_size=60)
+
+        self.assertEqual({'og:title': 'Café ☕', 'og:description': 'Ride'}, metas)
+        self.assertLess(stream.tell(), len(head.encode()) + 60)
+
+    def test_max_bytes(self):
+        stream = io.BytesIO(b'<html><head>' + b'<script>x</script>' * 1000)
+
+        self.assertEqual({}, meta_tags.read_meta_tags(stream, max_bytes=1024))
+        self.assertLessEqual(stream.tell(), 1024 + meta_tags.CHUNK_SIZE)
@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import mock
+import threading
 import unittest
 
 import flask
@@ -22,6 +23,7 @@ from google.cloud.datastore.entity import Entity
 from shared import ds_util
 from shared import responses
 from shared import task_util
+from shared import testing_util
 
 from services.slack import slack
 
@@ -88,6 +90,75 @@ class SlackTest(unittest.TestCase):
         responses.assertResponse(self, responses.OK_NO_UNFURLS, r)
 
 
+@mock.patch('main.slack.ClientWrapper')
+@mock.patch('main.slack.Service.get')
+class CreateUnfurlsTest(unittest.TestCase):
+    def setUp(self):
+        testing_util.fake_datastore(self)
+        slack.app_links._lru.clear()
+        self.addCleanup(slack.app_links._lru.clear)
+
+    @mock.patch.object(slack.app_links, '_resolve_fn')
+    @mock.patch('main.slack._unfurl')
+    def test_partial(self, unfurl_mock, fetch_app_link_mock, *_):
+        def unfurl(strava_client, link, alt_url=None):
+            if link['url'].endswith('/2'):
+                raise ValueError('Unparsable')
+            return {'blocks': [alt_url or link['url']]}
+
+        unfurl_mock.side_effect = unfurl
+        fetch_app_link_mock.return_value = 'https://www.strava.com/activities/3'
+        event = _event(
+            'https://www.strava.com/routes/1',
+            'https://www.strava.com/activities/2',
+            'https://strava.app.link/abc',
+        )
+
+        unfurls = slack._create_unfurls(event)
+
+        self.assertEqual(
+            {
+                'https://www.strava.com/routes/1': {
+                    'blocks': ['https://www.strava.com/routes/1']
+                },
+                'https://strava.app.link/abc': {
+                    'blocks': ['https://www.strava.com/activities/3']
+                },
+            },
+            unfurls,
+        )
+
+        # App links are resolved once, for good.
+        slack.app_links._lru.clear()
+        slack._create_unfurls(_event('https://strava.app.link/abc'))
+        fetch_app_link_mock.assert_called_once_with('https://strava.app.link/abc')
+
+    @mock.patch('main.slack.UNFURL_TIMEOUT_SECONDS', 0.1)
+    @mock.patch('main.slack._unfurl')
+    def test_timeout(self, unfurl_mock, *_):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def unfurl(strava_client, link, alt_url=None):
+            if link['url'].endswith('/slow'):
+                release.wait()
+            return {'blocks': [link['url']]}
+
+        unfurl_mock.side_effect = unfurl
+        event = _event(
+            'https://www.strava.com/activities/slow',
+            'https://www.strava.com/activities/1',
+        )
+
+        unfurls = slack._create_unfurls(event)
+
+        self.assertEqual(['https://www.strava.com/activities/1'], list(unfurls))
+
+
+def _event(*urls):
+    return {'event': {'links': [{'url': url} for url in urls]}}
+
+
 LINK_SHARED_EVENT = {
     'api_app_id': 'SOME_APP_ID',
     'authed_users': ['SOME_USER_ID'],
@@ -18,6 +18,7 @@ import unittest
 from google.cloud.datastore.entity import Entity
 
 from shared import ds_util
+from shared import testing_util
 
 from services.slack.testing_util import (
     activity_entity_for_test,
@@ -25,6 +26,7 @@ from services.slack.testing_util import (
     MOCK_CRAWLED_ACTIVITY,
 )
 from services.slack.unfurl_activity import (
+    page_cache,
     _api_activity_blocks,
     _crawled_activity_blocks,
     _unfurl_activity_from_crawl,
@@ -37,6 +39,11 @@ class MainTest(unittest.TestCase):
     def setUp(self):
         self.maxDiff = None
 
+        # Crawls are cached in Datastore.
+        testing_util.fake_datastore(self)
+        page_cache._lru.clear()
+        self.addCleanup(page_cache._lru.clear)
+
     def test_api_activity_block(self):
         activity = activity_entity_for_test(11111)
         blocks = _api_activity_blocks(
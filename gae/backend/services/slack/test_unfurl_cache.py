@@ -0,0 +1,121 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import mock
+import unittest
+
+from google.api_core.exceptions import AlreadyExists
+
+from shared import testing_util
+
+from services.slack import unfurl_cache
+from services.slack.unfurl_cache import UnfurlCache
+
+
+URL = 'https://www.strava.com/activities/3123195350'
+
+
+class UnfurlCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.stored = testing_util.fake_datastore(self).stored
+        patcher = mock.patch('shared.task_util.slack_tasks_unfurl_refresh')
+        self.refresh_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.fetch_mock = mock.Mock(return_value={'og:title': 'Choo choo'})
+        self.cache = UnfurlCache(self.fetch_mock)
+
+    def test_canonical_url(self):
+        self.assertEqual(
+            URL, unfurl_cache.canonical_url('https://strava.com/activities/3123195350')
+        )
+        self.assertEqual(URL, unfurl_cache.canonical_url(URL + '?a=b#x'))
+        self.assertEqual(
+            URL + '?share_sig=abc',
+            unfurl_cache.canonical_url(URL + '?utm_source=x&share_sig=abc#x'),
+        )
+
+    def test_get_share_signed(self):
+        self.cache.get(URL)
+        self.fetch_mock.return_value = {'og:title': 'Private ride'}
+
+        # Crawled, and cached, apart from the unsigned page.
+        self.assertEqual(
+            {'og:title': 'Private ride'},
+            self.cache.get(URL + '?share_sig=abc&utm_medium=social'),
+        )
+        self.assertEqual({'og:title': 'Choo choo'}, self.cache.get(URL))
+
+        self.fetch_mock.assert_called_with(URL + '?share_sig=abc')
+        self.assertEqual(2, self.fetch_mock.call_count)
+        self.assertEqual(2, len(self.stored))
+
+    def test_get_hit(self):
+        self.assertEqual({'og:title': 'Choo choo'}, self.cache.get(URL))
+        self.assertEqual({'og:title': 'Choo choo'}, self.cache.get(URL + '?a=b'))
+
+        self.fetch_mock.assert_called_once_with(URL)
+        self.assertEqual(1, self.cache.stats['misses'])
+        self.assertEqual(1, self.cache.stats['hits'])
+
+    def test_get_datastore_hit(self):
+        self.cache.get(URL)
+
+        # Another instance, with a cold LRU.
+        other = UnfurlCache(self.fetch_mock)
+        self.assertEqual({'og:title': 'Choo choo'}, other.get(URL))
+
+        self.fetch_mock.assert_called_once_with(URL)
+        self.assertEqual(1, other.stats['datastore_hits'])
+
+    def test_get_stale(self):
+        self.cache.get(URL)
+        later = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
+            hours=2
+        )
+
+        with mock.patch.object(unfurl_cache, 'datetime', wraps=datetime) as dt:
+            dt.datetime.now.return_value = later
+            self.assertEqual({'og:title': 'Choo choo'}, self.cache.get(URL))
+            self.refresh_mock.side_effect = AlreadyExists('Refreshing')
+            self.assertEqual({'og:title': 'Choo choo'}, self.cache.get(URL))
+
+        self.fetch_mock.assert_called_once_with(URL)
+        self.assertEqual(2, self.refresh_mock.call_count)
+        self.assertEqual(2, self.cache.stats['stale_hits'])
+        self.assertEqual(1, self.cache.stats['revalidations'])
+
+    def test_get_expired(self):
+        self.cache.get(URL)
+        later = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
+            days=8
+        )
+        self.fetch_mock.return_value = {'og:title': 'Renamed'}
+
+        with mock.patch.object(unfurl_cache, 'datetime', wraps=datetime) as dt:
+            dt.datetime.now.return_value = later
+            self.assertEqual({'og:title': 'Renamed'}, self.cache.get(URL))
+
+        self.assertEqual(2, self.fetch_mock.call_count)
+        self.refresh_mock.assert_not_called()
+
+    def test_get_fetch_error(self):
+        self.fetch_mock.return_value = None
+
+        self.assertIsNone(self.cache.get(URL))
+        self.assertIsNone(self.cache.get(URL))
+
+        self.assertEqual(2, self.fetch_mock.call_count)
+        self.assertEqual({}, self.stored)
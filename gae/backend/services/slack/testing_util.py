@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import datetime
+import io
 import mock
 
 from google.cloud.datastore.entity import Entity
@@ -142,7 +143,7 @@ def route_generator(route_id):
 def set_mockurlopen(mock_urlopen):
     cm = mock.MagicMock()
     cm.getcode.return_value = 200
-    cm.read.return_value = MOCK_STRAVA_ACTIVITY_LINK_CONTENTS
+    cm.read.side_effect = io.BytesIO(MOCK_STRAVA_ACTIVITY_LINK_CONTENTS.encode()).read
     cm.__enter__.return_value = cm
     mock_urlopen.return_value = cm
 
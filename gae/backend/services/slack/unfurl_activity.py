@@ -17,19 +17,24 @@ import urllib
 import urllib.request
 
 from babel.dates import format_date
-from bs4 import BeautifulSoup
 from measurement.measures import Distance, Speed
 from measurement.utils import guess
 
+from services.slack import meta_tags
+from services.slack.unfurl_cache import UnfurlCache
 from services.slack.util import get_id, generate_url
 
 
+# How long to wait on Strava for an activity page.
+FETCH_TIMEOUT_SECONDS = 10
+
+
 def unfurl_activity(client, url):
     return _unfurl_activity_from_crawl(url)
 
 
 def _unfurl_activity_from_crawl(url):
-    activity = _fetch_parse_activity_url(url)
+    activity = page_cache.get(url)
     if not activity:
         logging.warn(f'Unable to crawl url {url}')
         return
@@ -131,15 +136,15 @@ def _api_activity_blocks(url, activity):
 
 def _fetch_parse_activity_url(url):
     try:
-        with urllib.request.urlopen(url) as response:
-            contents = response.read()
-    except urllib.request.HTTPError:
+        with urllib.request.urlopen(url, timeout=FETCH_TIMEOUT_SECONDS) as response:
+            # Only the head, where the OpenGraph tags are, is read.
+            return meta_tags.read_meta_tags(response)
+    except OSError:  # Including HTTPError, URLError and timeouts.
         logging.exception('Could not fetch %s', url)
         return None
 
-    soup = BeautifulSoup(contents, 'html.parser')
-    metas = soup.find_all('meta', property=True, content=True)
-    return dict((meta['property'], meta['content']) for meta in metas)
+
+page_cache = UnfurlCache(_fetch_parse_activity_url)
 
 
 def _crawled_activity_blocks(url, activity):
@@ -0,0 +1,199 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import datetime
+import logging
+import threading
+import urllib.parse
+
+from google.api_core.exceptions import AlreadyExists
+from google.cloud.datastore.entity import Entity
+
+from shared import cache_util
+from shared import ds_util
+from shared import task_util
+
+from services.slack.util import get_id
+
+
+UNFURL_CACHE_SIZE = 256
+
+# Crawled metadata is served as is for this long...
+FRESH_FOR = datetime.timedelta(hours=1)
+
+# ...and then, until it's this old, served while a task refreshes it.
+STALE_FOR = datetime.timedelta(days=7)
+
+# Query parameters that change what a page shows: Strava's share_sig lets a
+# logged-out crawl see a private activity, rather than a login page.
+SIGNED_PARAMS = ('share_sig',)
+
+
+class UnfurlCache(object):
+    """Caches the metadata crawled from Strava pages for unfurls.
+
+    Metadata is stored in Datastore as UnfurlPage entities, named by the
+    page's canonical URL, with an in-process LRU in front. An entry older
+    than FRESH_FOR is still returned, but a task is queued to crawl it again.
+    """
+
+    def __init__(self, fetch_fn, max_size=UNFURL_CACHE_SIZE):
+        self._fetch_fn = fetch_fn
+        self._lru = cache_util.LruCache(max_size)
+        self._lock = threading.Lock()
+        self.stats = collections.Counter()
+
+    def get(self, url):
+        """Returns the metadata crawled from url, or None if it can't be."""
+        name = canonical_url(url)
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+        entry = self._lru.get(name)
+        if entry is not cache_util.MISSING and _is_fresh(entry, now):
+            self._count('hits')
+            return dict(entry['metadata'])
+
+        stored = ds_util.client.get(_key(name))
+        if stored is not None and (
+            entry is cache_util.MISSING or stored['fetched_at'] > entry['fetched_at']
+        ):
+            entry = {'metadata': stored['metadata'], 'fetched_at': stored['fetched_at']}
+            self._lru.set(name, entry, ttl=STALE_FOR.total_seconds())
+            if _is_fresh(entry, now):
+                self._count('hits', 'datastore_hits')
+                return dict(entry['metadata'])
+
+        if entry is not cache_util.MISSING and now - entry['fetched_at'] < STALE_FOR:
+            self._count('hits', 'stale_hits')
+            self._revalidate(name, entry)
+            return dict(entry['metadata'])
+
+        self._count('misses')
+        entry = self.refresh(name)
+        return dict(entry['metadata']) if entry is not None else None
+
+    def refresh(self, url):
+        """Crawls url again, caching and returning the entry if it could."""
+        name = canonical_url(url)
+        metadata = self._fetch_fn(name)
+        if not metadata:
+            self._count('fetch_errors')
+            return None
+        self._count('fetches')
+
+        entry = {
+            'metadata': metadata,
+            'fetched_at': datetime.datetime.now(datetime.timezone.utc),
+        }
+        stored = Entity(_key(name), exclude_from_indexes=['metadata'])
+        stored.update(entry)
+        ds_util.client.put(stored)
+        self._lru.set(name, entry, ttl=STALE_FOR.total_seconds())
+        return entry
+
+    def log_stats(self):
+        logging.info('Unfurl cache: %s', dict(self.stats))
+
+    def _revalidate(self, name, entry):
+        # Named by the stale entry, so only one task refreshes each.
+        try:
+            task_util.slack_tasks_unfurl_refresh(name, entry['fetched_at'])
+            self._count('revalidations')
+        except AlreadyExists:
+            logging.debug('UnfurlCache: Already refreshing: %s', name)
+
+    def _count(self, *stats):
+        with self._lock:
+            for stat in stats:
+                self.stats[stat] += 1
+
+
+class AppLinkCache(object):
+    """Caches what strava.app.link share links resolve to, which never changes.
+
+    Resolutions are stored in Datastore as StravaAppLink entities, named by
+    the share link, with an in-process LRU in front.
+    """
+
+    def __init__(self, resolve_fn, max_size=UNFURL_CACHE_SIZE):
+        self._resolve_fn = resolve_fn
+        self._lru = cache_util.LruCache(max_size)
+        self._lock = threading.Lock()
+        self.stats = collections.Counter()
+
+    def resolve(self, url):
+        """Returns the Strava URL url links to, or None if it can't be found."""
+        resolved = self._lru.get(url)
+        if resolved is not cache_util.MISSING:
+            self._count('hits')
+            return resolved
+
+        key = ds_util.client.key('StravaAppLink', url)
+        entity = ds_util.client.get(key)
+        if entity is not None:
+            self._count('hits', 'datastore_hits')
+            resolved = entity['resolved_url']
+        else:
+            self._count('misses')
+            resolved = self._resolve_fn(url)
+            if resolved is None:
+                self._count('resolve_errors')
+                return None
+            entity = Entity(key)
+            entity['resolved_url'] = resolved
+            ds_util.client.put(entity)
+
+        self._lru.set(url, resolved)
+        return resolved
+
+    def log_stats(self):
+        logging.info('App link cache: %s', dict(self.stats))
+
+    def _count(self, *stats):
+        with self._lock:
+            for stat in stats:
+                self.stats[stat] += 1
+
+
+def canonical_url(url):
+    """The page's URL, without a strava.com alias, fragment, or most of its query.
+
+    Only SIGNED_PARAMS are kept, so a share-signed page is crawled, and
+    cached, apart from the one a logged-out crawl would see without it.
+    """
+    parsed = urllib.parse.urlparse(url)
+    query = urllib.parse.urlencode(
+        [
+            (name, value)
+            for name, value in urllib.parse.parse_qsl(parsed.query)
+            if name in SIGNED_PARAMS
+        ]
+    )
+    if '/activities/' in parsed.path:
+        try:
+            parsed = urllib.parse.urlparse(
+                'https://www.strava.com/activities/%s' % (get_id(url),)
+            )
+        except ValueError:
+            pass
+    return urllib.parse.urlunparse(parsed._replace(query=query, fragment=''))
+
+
+def _key(name):
+    return ds_util.client.key('UnfurlPage', name)
+
+
+def _is_fresh(entry, now):
+    return now - entry['fetched_at'] < FRESH_FOR
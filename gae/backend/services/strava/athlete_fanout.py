@@ -0,0 +1,156 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import logging
+import time
+
+from google.cloud.datastore.entity import Entity
+
+from shared import ds_util
+from shared import task_util
+
+
+# Activities read and rewritten per query page.
+CHUNK_SIZE = 200
+
+# How long a task works before handing the rest to a new task.
+TIME_BUDGET_SECONDS = 5 * 60
+
+# The athlete fields shown with activities; if these match, an activity's
+# embedded athlete is current.
+_ATHLETE_FIELDS = (
+    'id',
+    'firstname',
+    'lastname',
+    'profile',
+    'profile_medium',
+    'city',
+    'state',
+    'country',
+)
+
+
+class AthleteFanout(object):
+    """Copies the service's athlete onto each of its activities, in chunks.
+
+    Start it with AthleteFanout.start, or resume_or_start. After every chunk,
+    progress is checkpointed in an AthleteFanout entity under the service, so
+    a task that times out is retried from its last chunk rather than from
+    scratch. When the time budget runs out, the rest is handed to a new task.
+    """
+
+    def __init__(
+        self,
+        service,
+        chunk_size=CHUNK_SIZE,
+        time_budget_seconds=TIME_BUDGET_SECONDS,
+        clock=time.monotonic,
+    ):
+        self.service = service
+        self.chunk_size = chunk_size
+        self.time_budget_seconds = time_budget_seconds
+        self._clock = clock
+
+    @classmethod
+    def key(cls, service_key):
+        return ds_util.client.key('AthleteFanout', 'athlete', parent=service_key)
+
+    @classmethod
+    def start(cls, service, athlete_entity, **kwargs):
+        """Checkpoints a new fan-out of athlete_entity, replacing any other."""
+        checkpoint = Entity(
+            cls.key(service.key), exclude_from_indexes=['athlete', 'cursor']
+        )
+        checkpoint.update(
+            {
+                'athlete': athlete_entity,
+                'cursor': None,
+                'updated': 0,
+                'skipped': 0,
+                'done': False,
+                'started_at': datetime.datetime.now(datetime.timezone.utc),
+            }
+        )
+        ds_util.client.put(checkpoint)
+        return cls(service, **kwargs)
+
+    @classmethod
+    def resume_or_start(cls, service, athlete_entity, **kwargs):
+        """Resumes an unfinished fan-out of the same athlete, or starts one.
+
+        A retried event task would otherwise start over from the first chunk.
+        """
+        checkpoint = ds_util.client.get(cls.key(service.key))
+        if (
+            checkpoint is not None
+            and not checkpoint['done']
+            and _is_current(checkpoint['athlete'], athlete_entity)
+        ):
+            logging.info('AthleteFanout: Resuming: %s', service.key)
+            return cls(service, **kwargs)
+        return cls.start(service, athlete_entity, **kwargs)
+
+    def sync(self):
+        checkpoint = ds_util.client.get(self.key(self.service.key))
+        if checkpoint is None or checkpoint['done']:
+            logging.debug('AthleteFanout: Nothing to do: %s', self.service.key)
+            return checkpoint
+
+        deadline = self._clock() + self.time_budget_seconds
+        while not checkpoint['done']:
+            self._sync_chunk(checkpoint)
+            ds_util.client.put(checkpoint)
+            if not checkpoint['done'] and self._clock() > deadline:
+                logging.info(
+                    'AthleteFanout: Continuing in a new task: %s', self.service.key
+                )
+                task_util.strava_tasks_athlete_fanout(self.service.key)
+                break
+
+        logging.info(
+            'AthleteFanout: %s updated, %s skipped, done: %s: %s',
+            checkpoint['updated'],
+            checkpoint['skipped'],
+            checkpoint['done'],
+            self.service.key,
+        )
+        return checkpoint
+
+    def _sync_chunk(self, checkpoint):
+        athlete = checkpoint['athlete']
+        query = ds_util.client.query(kind='Activity', ancestor=self.service.key)
+        query_iter = query.fetch(
+            limit=self.chunk_size, start_cursor=checkpoint['cursor']
+        )
+        activities = list(next(query_iter.pages))
+
+        stale = [a for a in activities if not _is_current(a.get('athlete'), athlete)]
+        with ds_util.BatchWriter() as writer:
+            for activity in stale:
+                activity['athlete'] = athlete
+                writer.put(activity)
+
+        checkpoint['cursor'] = query_iter.next_page_token
+        checkpoint['updated'] += len(stale)
+        checkpoint['skipped'] += len(activities) - len(stale)
+        checkpoint['done'] = (
+            query_iter.next_page_token is None or len(activities) < self.chunk_size
+        )
+
+
+def _is_current(embedded, athlete):
+    if not embedded:
+        return False
+    return all(embedded.get(f) == athlete.get(f) for f in _ATHLETE_FIELDS)
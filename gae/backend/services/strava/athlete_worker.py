@@ -42,10 +42,11 @@ class AthleteWorker(object):
 
         # Track the clubs that these activities were a part of, by annotating
         # them with the athlete's clubs.
-        for activity in self.client.get_activities():
-            activity_entity = Activity.to_entity(activity, parent=self.service.key)
-            activity_entity['clubs'] = athlete_clubs
-            ds_util.client.put(activity_entity)
+        with ds_util.BatchWriter() as writer:
+            for activity in self.client.get_activities():
+                activity_entity = Activity.to_entity(activity, parent=self.service.key)
+                activity_entity['clubs'] = athlete_clubs
+                writer.put(activity_entity)
 
     def _sync_activity(self, activity_id):
         """Gets additional info: description, calories and embed_token."""
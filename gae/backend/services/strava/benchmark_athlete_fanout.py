@@ -0,0 +1,226 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares per-activity puts with AthleteFanout for an athlete rename.
+
+"sequential" is what EventsWorker used to do, one put per activity, minus the
+enclosing transaction (which can't hold more than 500 mutations anyway).
+"fanout" is AthleteFanout after a rename, and "fanout-current" is a rerun once
+every activity is already current.
+
+By default this runs against an in-memory Datastore that sleeps
+--rpc-latency-ms per RPC; with --emulator it runs against the Datastore
+emulator at $DATASTORE_EMULATOR_HOST, writing under a throwaway User.
+
+Usage, from gae/backend:
+    python -m services.strava.benchmark_athlete_fanout --activities 5000
+    python -m services.strava.benchmark_athlete_fanout --activities 5000 --emulator
+"""
+
+import argparse
+import collections
+import copy
+import datetime
+import time
+
+from google.cloud.datastore import Client
+from google.cloud.datastore.entity import Entity
+from google.cloud.datastore.key import Key
+
+from shared import ds_util
+from shared.config import config
+
+from services.strava.athlete_fanout import AthleteFanout
+
+
+class FakeQueryIter(object):
+    # Datastore returns unlimited query results in batches of about this many.
+    BATCH_SIZE = 300
+
+    def __init__(self, datastore, results, limit, start_cursor):
+        start = int(start_cursor or 0)
+        end = len(results) if limit is None else start + limit
+        self._page = results[start:end]
+        end = start + len(self._page)
+        self.next_page_token = str(end).encode() if end < len(results) else None
+        for _ in range(0, max(1, len(self._page)), self.BATCH_SIZE):
+            datastore.rpc()
+
+    def __iter__(self):
+        return (copy.deepcopy(e) for e in self._page)
+
+    @property
+    def pages(self):
+        return iter([list(self)])
+
+
+class FakeQuery(object):
+    def __init__(self, datastore, kind, ancestor):
+        self._datastore = datastore
+        prefix = ancestor.flat_path
+        self._results = [
+            e
+            for path, e in sorted(datastore.entities.items())
+            if len(path) == len(prefix) + 2
+            and path[: len(prefix)] == prefix
+            and path[-2] == kind
+        ]
+
+    def fetch(self, limit=None, start_cursor=None):
+        return FakeQueryIter(self._datastore, self._results, limit, start_cursor)
+
+
+class FakeDatastore(object):
+    """Just enough of a Datastore Client for AthleteFanout."""
+
+    current_transaction = None
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.entities = {}
+        self.stats = collections.Counter()
+
+    def rpc(self):
+        self.stats['rpcs'] += 1
+        time.sleep(self.latency)
+
+    def key(self, *args, **kwargs):
+        return Key(*args, project=config.project_id, **kwargs)
+
+    def get(self, key):
+        self.rpc()
+        return copy.deepcopy(self.entities.get(key.flat_path))
+
+    def put(self, entity):
+        self.put_multi([entity])
+
+    def put_multi(self, entities):
+        self.rpc()
+        for entity in entities:
+            self.entities[entity.key.flat_path] = entity
+
+    def query(self, kind=None, ancestor=None):
+        return FakeQuery(self, kind, ancestor)
+
+
+class CountingDatastore(object):
+    """Counts the RPCs made through a real client."""
+
+    def __init__(self, client):
+        self.client = client
+        self.stats = collections.Counter()
+
+    def __getattr__(self, attr):
+        return getattr(self.client, attr)
+
+    def get(self, key):
+        self.stats['rpcs'] += 1
+        return self.client.get(key)
+
+    def put(self, entity):
+        self.stats['rpcs'] += 1
+        return self.client.put(entity)
+
+    def put_multi(self, entities):
+        self.stats['rpcs'] += 1
+        return self.client.put_multi(entities)
+
+    def query(self, **kwargs):
+        query = self.client.query(**kwargs)
+        fetch = query.fetch
+
+        def counting_fetch(*args, **kwargs):
+            self.stats['rpcs'] += 1
+            return fetch(*args, **kwargs)
+
+        query.fetch = counting_fetch
+        return query
+
+
+def _athlete(service_key, firstname):
+    athlete = Entity(ds_util.client.key('Athlete', 35056021, parent=service_key))
+    athlete.update({'id': 35056021, 'firstname': firstname, 'lastname': 'LaPenna'})
+    return athlete
+
+
+def _seed(datastore, service_key, activities):
+    start = datetime.datetime(2015, 1, 1, tzinfo=datetime.timezone.utc)
+    athlete = _athlete(service_key, 'Joe')
+    entities = []
+    for i in range(activities):
+        activity = Entity(
+            ds_util.client.key('Activity', i + 1, parent=service_key),
+            exclude_from_indexes=['athlete', 'map'],
+        )
+        activity.update(
+            {
+                'id': i + 1,
+                'name': 'Ride %s' % (i,),
+                'start_date': start + datetime.timedelta(days=i),
+                'distance': 40000.0,
+                'map': {'summary_polyline': 'a~l~Fjk~uOwHJy@P' * 50},
+                'athlete': athlete,
+            }
+        )
+        entities.append(activity)
+    with ds_util.BatchWriter(datastore) as writer:
+        writer.put_multi(entities)
+
+
+def _sequential(service, athlete):
+    query = ds_util.client.query(kind='Activity', ancestor=service.key)
+    for activity in query.fetch():
+        activity['athlete'] = athlete
+        ds_util.client.put(activity)
+
+
+def _fanout(service, athlete):
+    AthleteFanout.start(service, athlete, time_budget_seconds=3600).sync()
+
+
+def main(activities, rpc_latency_ms, emulator):
+    if emulator:
+        backing = CountingDatastore(Client(project=config.project_id))
+        user_key = ds_util.client.key('User', 'benchmark-%s' % (int(time.time()),))
+    else:
+        backing = FakeDatastore(rpc_latency_ms / 1000)
+        user_key = ds_util.client.key('User', 'benchmark')
+    # Route everything, including AthleteFanout, through the backing client.
+    ds_util.client = ds_util.CachingClient(backing)
+    service = Entity(ds_util.client.key('Service', 'strava', parent=user_key))
+
+    print('%-15s %6s %9s' % ('approach', 'rpcs', 'wall (s)'))
+    runs = (
+        ('sequential', _sequential, 'Sequential'),
+        ('fanout', _fanout, 'Fanout'),
+        ('fanout-current', _fanout, 'Fanout'),
+    )
+    for name, run, firstname in runs:
+        if name != 'fanout-current':
+            _seed(backing, service.key, activities)
+        backing.stats.clear()
+        start = time.perf_counter()
+        run(service, _athlete(service.key, firstname))
+        elapsed = time.perf_counter() - start
+        print('%-15s %6d %9.2f' % (name, backing.stats['rpcs'], elapsed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--activities', type=int, default=5000)
+    parser.add_argument('--rpc-latency-ms', type=float, default=2)
+    parser.add_argument('--emulator', action='store_true')
+    args = parser.parse_args()
+
+    main(args.activities, args.rpc_latency_ms, args.emulator)
@@ -20,6 +20,8 @@ from shared.datastore.athlete import Athlete
 
 from shared.services.strava.client import ClientWrapper
 
+from services.strava.athlete_fanout import AthleteFanout
+
 
 class EventsWorker(object):
     def __init__(self, service, event):
@@ -33,6 +35,11 @@ class EventsWorker(object):
         object_id = self.event.get('object_id')
         object_type = self.event.get('object_type')
         aspect_type = self.event.get('aspect_type')
+        if object_type == 'athlete':
+            # Touches every activity, too many for one transaction.
+            self._sync_athlete()
+            return
+
         with ds_util.client.transaction():
             logging.debug(
                 'StravaEvent: process_event_batch:  %s, %s',
@@ -63,29 +70,25 @@ class EventsWorker(object):
                         activity_entity.key,
                         self.event.key,
                     )
-            elif object_type == 'athlete':
-                athlete = self.client.get_athlete()
-                athlete_entity = Athlete.to_entity(athlete, parent=self.service.key)
-                ds_util.client.put(athlete_entity)
-                logging.info(
-                    'StravaEvent: Updated Athlete: %s: %s',
-                    athlete_entity.key,
-                    self.event.key,
-                )
-                activities_query = ds_util.client.query(
-                    kind='Activity', ancestor=self.service.key, order=['-start_date']
-                )
-                for activity in activities_query.fetch():
-                    activity['athlete'] = athlete
-                    ds_util.client.put(activity)
-                logging.info(
-                    'StravaEvent: Updated Activities: %s: %s',
-                    athlete_entity.key,
-                    self.event.key,
-                )
             else:
                 logging.warning(
                     'StravaEvent: Update object_type %s not implemented: %s',
                     object_type,
                     self.event.key,
                 )
+
+    def _sync_athlete(self):
+        athlete = self.client.get_athlete()
+        athlete_entity = Athlete.to_entity(athlete, parent=self.service.key)
+        ds_util.client.put(athlete_entity)
+        logging.info(
+            'StravaEvent: Updated Athlete: %s: %s',
+            athlete_entity.key,
+            self.event.key,
+        )
+        AthleteFanout.resume_or_start(self.service, athlete_entity).sync()
+        logging.info(
+            'StravaEvent: Updated Activities: %s: %s',
+            athlete_entity.key,
+            self.event.key,
+        )
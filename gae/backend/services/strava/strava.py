@@ -12,12 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import datetime
 import logging
 
 import flask
 
 from shared import ds_util
 from shared import googlemaps_util
+from shared import hash_util
 from shared import responses
 from shared import task_util
 from shared.datastore.activity import Activity
@@ -28,9 +30,12 @@ from shared.datastore.segment import Segment
 from shared.datastore.segment_effort import SegmentEffort
 from shared.datastore.service import Service
 from shared.exceptions import SyncException
+from shared.services.strava.activity_fetcher import ActivityFetcher
+from shared.services.strava import event_coalescer
 from shared.services.strava.client import ClientWrapper
 from shared.services.strava.club_worker import ClubWorker
 
+from services.strava.athlete_fanout import AthleteFanout
 from services.strava.events_worker import EventsWorker
 
 import sync_helper
@@ -38,6 +43,24 @@ import sync_helper
 
 module = flask.Blueprint('strava', __name__)
 
+# Incremental syncs re-list activities that started this long before the newest
+# one we've seen, to pick up late uploads and recent edits.
+SYNC_OVERLAP = datetime.timedelta(days=7)
+
+# Summary fields that, when changed, mean the stored detail is stale.
+_HASHED_ACTIVITY_FIELDS = (
+    'name',
+    'type',
+    'start_date',
+    'distance',
+    'moving_time',
+    'elapsed_time',
+    'total_elevation_gain',
+    'private',
+    'commute',
+    'gear_id',
+)
+
 
 @module.route('/tasks/sync', methods=['POST'])
 def sync():
@@ -52,7 +75,9 @@ def sync():
 
     try:
         Service.set_sync_started(service)
-        sync_helper.do(Worker(service), work_key=service.key)
+        sync_helper.do(
+            Worker(service, force=params.get('force', False)), work_key=service.key
+        )
         Service.set_sync_finished(service)
         return responses.OK
     except SyncException as e:
@@ -71,7 +96,24 @@ def sync_club(club_id):
 @module.route('/tasks/event', methods=['POST'])
 def process_event_task():
     params = task_util.get_payload(flask.request)
-    event = params['event']
+    if params.get('event_key') is None:
+        return _process_event(params['event'])
+
+    event = event_coalescer.get(params['event_key'])
+    if event is None:
+        logging.info('Event: Already processed: %s', params['event_key'])
+        return responses.OK
+    response = _process_event(event)
+    if response is responses.OK_SYNC_EXCEPTION:
+        # Requeued, since events merged into it have no task of their own.
+        event_coalescer.retry(event)
+    else:
+        event_coalescer.done(event)
+    event_coalescer.log_stats()
+    return response
+
+
+def _process_event(event):
     logging.info('Event: %s', event.key)
 
     # First try to get the service using the event.key's service.
@@ -95,9 +137,25 @@ def process_event_task():
     return responses.OK
 
 
+@module.route('/tasks/athlete_fanout', methods=['POST'])
+def athlete_fanout_task():
+    params = task_util.get_payload(flask.request)
+    service = ds_util.client.get(params['service_key'])
+    if service is None:
+        logging.error('AthleteFanout: No service: %s', params['service_key'])
+        return responses.OK_NO_SERVICE
+
+    try:
+        sync_helper.do(AthleteFanout(service), work_key=service.key)
+    except SyncException:
+        return responses.OK_SYNC_EXCEPTION
+    return responses.OK
+
+
 class Worker(object):
-    def __init__(self, service):
+    def __init__(self, service, force=False):
         self.service = service
+        self.force = force
         self.client = ClientWrapper(service)
 
     def sync(self):
@@ -113,44 +171,90 @@ class Worker(object):
         ds_util.client.put(Athlete.to_entity(athlete, parent=self.service.key))
 
     def sync_activities(self):
+        """Syncs activities since the last sync, or all of them when forced.
+
+        The cursor in sync_state holds the newest start_date synced, the
+        number of activities synced and the summary hashes of those within
+        SYNC_OVERLAP of the newest. Only activities that are new or whose
+        hash changed get their detail fetched.
+        """
         self.client.ensure_access()
 
         athlete = self.client.get_athlete()
 
-        for activity in self.client.get_activities():
-            # Track full activity info (detailed), not returned by the normal
-            # get_activities (summary) request.
-            detailed_activity = self.client.get_activity(activity.id)
-            activity_entity = Activity.to_entity(
-                detailed_activity, detailed_athlete=athlete, parent=self.service.key
-            )
-            ds_util.client.put(activity_entity)
-
-            # But also add all the user's best efforts.
-            for segment_effort in detailed_activity.segment_efforts:
-                segment_effort_entity = SegmentEffort.to_entity(
-                    segment_effort, parent=self.service.key
+        cursor = {} if self.force else self.service['sync_state'].get('cursor') or {}
+        known_hashes = cursor.get('activity_hashes', {})
+        after = cursor.get('after')
+        if after is not None:
+            after = after - SYNC_OVERLAP
+
+        listed = []
+        to_fetch = []
+        new_activities = 0
+        for activity in self.client.get_activities(after=after):
+            activity_hash = _activity_hash(activity)
+            listed.append((activity.start_date, str(activity.id), activity_hash))
+            known_hash = known_hashes.get(str(activity.id))
+            if known_hash is None:
+                new_activities += 1
+            elif known_hash == activity_hash:
+                continue
+            to_fetch.append(activity.id)
+
+        # Track full activity info (detailed), not returned by the normal
+        # get_activities (summary) request.
+        with ds_util.BatchWriter() as writer:
+            for detailed_activity in ActivityFetcher(self.client).fetch(to_fetch):
+                activity_entity = Activity.to_entity(
+                    detailed_activity, detailed_athlete=athlete, parent=self.service.key
                 )
-                ds_util.client.put(segment_effort_entity)
+                writer.put(activity_entity)
+
+                # But also add all the user's best efforts.
+                for segment_effort in detailed_activity.segment_efforts:
+                    segment_effort_entity = SegmentEffort.to_entity(
+                        segment_effort, parent=self.service.key
+                    )
+                    writer.put(segment_effort_entity)
+
+        if after is None:
+            activity_count = len(listed)
+        else:
+            activity_count = cursor.get('activity_count', 0) + new_activities
+        self.service['sync_state']['cursor'] = _activities_cursor(
+            listed, activity_count, cursor.get('after')
+        )
+        # A full sync fetches detail for every activity.
+        self.service['sync_state']['api_calls_saved'] = max(
+            0, activity_count - len(to_fetch)
+        )
+        logging.info(
+            'Synced activities: %s detail fetches, %s saved',
+            len(to_fetch),
+            self.service['sync_state']['api_calls_saved'],
+        )
 
     def sync_routes(self):
         self.client.ensure_access()
 
-        for route in self.client.get_routes():
-            ds_util.client.put(Route.to_entity(route, parent=self.service.key))
+        with ds_util.BatchWriter() as writer:
+            for route in self.client.get_routes():
+                writer.put(Route.to_entity(route, parent=self.service.key))
 
     def sync_segments(self):
         self.client.ensure_access()
 
-        for segment in self.client.get_starred_segments():
-            # Track full segment info (detailed), not returned by the normal
-            # get_starred_segments (summary) request.
-            detailed_segment = self.client.get_segment(segment.id)
-            elevations = self._fetch_segment_elevation(detailed_segment)
-            segment_entity = Segment.to_entity(
-                detailed_segment, elevations=elevations, parent=self.service.key
-            )
-            ds_util.client.put(segment_entity)
+        with ds_util.BatchWriter() as writer:
+            for segment in self.client.get_starred_segments():
+                # Track full segment info (detailed), not returned by the normal
+                # get_starred_segments (summary) request.
+                detailed_segment = self.client.get_segment(segment.id)
+                elevations = self._fetch_segment_elevation(detailed_segment)
+                segment_entity = Segment.to_entity(
+                    detailed_segment, elevations=elevations, parent=self.service.key
+                )
+                writer.put(segment_entity)
+        googlemaps_util.elevation_cache.log_stats()
 
     def _fetch_segment_elevation(self, segment):
         return [
@@ -162,7 +266,7 @@ class Worker(object):
                 'elevation': e['elevation'],
                 'resolution': e['resolution'],
             }
-            for e in googlemaps_util.client.elevation_along_path(
+            for e in googlemaps_util.elevation_cache.elevation_along_path(
                 segment.map.polyline, samples=100
             )
         ]
@@ -171,3 +275,24 @@ class Worker(object):
         """Gets additional info: description, calories and embed_token."""
         activity = self.client.get_activity(activity_id)
         return ds_util.client.put(Activity.to_entity(activity, parent=self.service.key))
+
+
+def _activity_hash(activity):
+    return hash_util.hash_name(
+        *(getattr(activity, field, None) for field in _HASHED_ACTIVITY_FIELDS)
+    )
+
+
+def _activities_cursor(listed, activity_count, previous_after):
+    """Returns the sync cursor for the listed (start_date, id, hash)s."""
+    start_dates = [start_date for start_date, _, _ in listed if start_date]
+    after = max(start_dates) if start_dates else previous_after
+    return {
+        'after': after,
+        'activity_count': activity_count,
+        'activity_hashes': {
+            activity_id: activity_hash
+            for start_date, activity_id, activity_hash in listed
+            if after is None or start_date is None or start_date >= after - SYNC_OVERLAP
+        },
+    }
@@ -0,0 +1,143 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+import unittest
+
+from google.cloud.datastore.entity import Entity
+
+from shared import ds_util
+from shared import testing_util
+
+from services.strava.athlete_fanout import AthleteFanout
+
+
+class MockQueryIter(object):
+    def __init__(self, results, limit, start_cursor):
+        start = int(start_cursor or 0)
+        self.page = results[start : start + limit]
+        end = start + len(self.page)
+        self.next_page_token = str(end).encode() if end < len(results) else None
+
+    @property
+    def pages(self):
+        return iter([self.page])
+
+
+class MockQuery(object):
+    def __init__(self, results):
+        self.results = results
+
+    def fetch(self, limit=None, start_cursor=None):
+        return MockQueryIter(self.results, limit, start_cursor)
+
+
+class AthleteFanoutTest(unittest.TestCase):
+    def setUp(self):
+        self.service = Entity(ds_util.client.key('Service', 'strava'))
+        self.athlete = _athlete('Joe')
+        self.activities = []
+        for i in range(10):
+            activity = Entity(ds_util.client.key('Activity', i + 1))
+            activity['athlete'] = _athlete('Joe' if i % 2 else 'Old')
+            self.activities.append(activity)
+        self.put_multi_mock = testing_util.fake_datastore(self).mocks['put_multi']
+
+        patchers = [
+            mock.patch('shared.ds_util.client.query'),
+            mock.patch('shared.task_util.strava_tasks_athlete_fanout'),
+        ]
+        query_mock, self.task_mock = [p.start() for p in patchers]
+        for patcher in patchers:
+            self.addCleanup(patcher.stop)
+        query_mock.return_value = MockQuery(self.activities)
+
+    def _written(self):
+        return [e for c in self.put_multi_mock.call_args_list for e in c.args[0]]
+
+    def test_updates_stale_activities(self):
+        checkpoint = AthleteFanout.start(
+            self.service, self.athlete, chunk_size=3
+        ).sync()
+
+        self.assertTrue(checkpoint['done'])
+        self.assertEqual(5, checkpoint['updated'])
+        self.assertEqual(5, checkpoint['skipped'])
+        self.assertEqual([1, 3, 5, 7, 9], sorted(a.key.id for a in self._written()))
+        self.assertTrue(all(a['athlete'] == self.athlete for a in self._written()))
+        self.task_mock.assert_not_called()
+
+    def test_continues_in_new_task(self):
+        now = [0]
+
+        def clock():
+            now[0] += 10
+            return now[0]
+
+        fanout = AthleteFanout.start(
+            self.service,
+            self.athlete,
+            chunk_size=3,
+            time_budget_seconds=15,
+            clock=clock,
+        )
+        checkpoint = fanout.sync()
+        self.assertFalse(checkpoint['done'])
+        self.assertEqual(b'6', checkpoint['cursor'])
+        self.task_mock.assert_called_once_with(self.service.key)
+
+        # The next task resumes from the checkpoint.
+        checkpoint = AthleteFanout(self.service, chunk_size=3).sync()
+        self.assertTrue(checkpoint['done'])
+        self.assertEqual(5, checkpoint['updated'])
+        self.assertEqual(5, len(self._written()))
+
+    def test_resume_or_start(self):
+        now = [0]
+
+        def clock():
+            now[0] += 10
+            return now[0]
+
+        AthleteFanout.start(
+            self.service,
+            self.athlete,
+            chunk_size=3,
+            time_budget_seconds=15,
+            clock=clock,
+        ).sync()
+
+        # A retry for the same athlete picks up from the checkpoint...
+        checkpoint = AthleteFanout.resume_or_start(
+            self.service, _athlete('Joe'), chunk_size=3
+        ).sync()
+        self.assertTrue(checkpoint['done'])
+        self.assertEqual(5, checkpoint['updated'])
+        self.assertEqual(5, checkpoint['skipped'])
+
+        # ...but a finished one, or another athlete, starts over.
+        checkpoint = AthleteFanout.resume_or_start(
+            self.service, _athlete('New'), chunk_size=3
+        ).sync()
+        self.assertTrue(checkpoint['done'])
+        self.assertEqual(10, checkpoint['updated'])
+
+    def test_nothing_to_do(self):
+        self.assertIsNone(AthleteFanout(self.service).sync())
+
+
+def _athlete(firstname):
+    athlete = Entity(ds_util.client.key('Athlete', 35056021))
+    athlete.update({'id': 35056021, 'firstname': firstname, 'lastname': 'LaPenna'})
+    return athlete
@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import datetime
 import mock
 import unittest
 
@@ -32,6 +33,72 @@ class MockWorker(object):
         pass
 
 
+class WorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.service = Entity(ds_util.client.key('Service', 'strava'))
+        Service._set_defaults(self.service)
+        self.service['credentials'] = {'access_token': 'validaccesstoken'}
+        self.activities = [_activity(i, name='Ride %s' % (i,)) for i in range(5)]
+
+        patcher = mock.patch('services.strava.strava.ClientWrapper')
+        self.client = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.client.get_activities.side_effect = lambda after=None: [
+            a for a in self.activities if after is None or a.start_date >= after
+        ]
+        self.client.get_activity.side_effect = lambda activity_id: (
+            self.activities[activity_id]
+        )
+
+        patcher = mock.patch('shared.services.strava.rate_limit.budget')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = mock.patch('services.strava.strava.Activity.to_entity')
+        patcher.start().side_effect = lambda activity, **kwargs: Entity(
+            ds_util.client.key('Activity', activity.id + 1)
+        )
+        self.addCleanup(patcher.stop)
+
+    def _sync(self, force=False):
+        self.client.get_activity.reset_mock()
+        with mock.patch('shared.ds_util.client.put_multi'):
+            strava.Worker(self.service, force=force).sync_activities()
+        return sorted(c[0][0] for c in self.client.get_activity.call_args_list)
+
+    def test_sync_activities_incremental(self):
+        self.assertEqual([0, 1, 2, 3, 4], self._sync())
+        self.assertEqual(0, self.service['sync_state']['api_calls_saved'])
+        cursor = self.service['sync_state']['cursor']
+        self.assertEqual(self.activities[4].start_date, cursor['after'])
+        self.assertEqual(5, cursor['activity_count'])
+
+        # Nothing changed: only recent activities are listed, none fetched.
+        self.assertEqual([], self._sync())
+        self.client.get_activities.assert_called_with(
+            after=self.activities[4].start_date - strava.SYNC_OVERLAP
+        )
+        self.assertEqual(5, self.service['sync_state']['api_calls_saved'])
+
+        # One new, one renamed.
+        self.activities[4].name = 'Renamed'
+        self.activities.append(_activity(5))
+        self.assertEqual([4, 5], self._sync())
+        self.assertEqual(6, self.service['sync_state']['cursor']['activity_count'])
+        self.assertEqual(4, self.service['sync_state']['api_calls_saved'])
+
+    def test_sync_activities_force(self):
+        self._sync()
+        self.assertEqual([0, 1, 2, 3, 4], self._sync(force=True))
+        self.client.get_activities.assert_called_with(after=None)
+
+    def test_cursor_survives_enqueue(self):
+        self._sync()
+        with mock.patch('shared.ds_util.client.put'):
+            Service.set_sync_enqueued(self.service)
+        self.assertEqual(5, self.service['sync_state']['cursor']['activity_count'])
+
+
 class StravaTest(unittest.TestCase):
     def setUp(self):
         self.app = flask.Flask(__name__)
@@ -65,6 +132,58 @@ class StravaTest(unittest.TestCase):
         responses.assertResponse(self, responses.OK, r)
         strava_worker_mock.assert_called_once()
 
+    @mock.patch('services.strava.strava.EventsWorker', return_value=MockWorker())
+    @mock.patch('shared.services.strava.event_coalescer.get', return_value=None)
+    def test_process_event_task_already_processed(self, get_mock, strava_worker_mock):
+        event_key = ds_util.client.key('SubscriptionEvent', 'pending')
+        r = self.client.post(
+            '/tasks/event',
+            data=task_util.task_body_for_test(event_key=event_key),
+        )
+        responses.assertResponse(self, responses.OK, r)
+        get_mock.assert_called_once_with(event_key)
+        strava_worker_mock.assert_not_called()
+
+    @mock.patch('services.strava.strava.EventsWorker')
+    @mock.patch('shared.services.strava.event_coalescer.retry')
+    @mock.patch('shared.services.strava.event_coalescer.done')
+    @mock.patch('shared.services.strava.event_coalescer.get')
+    @mock.patch('shared.ds_util.client.get')
+    def test_process_event_task_done_after_success(
+        self,
+        ds_util_client_get_mock,
+        get_mock,
+        done_mock,
+        retry_mock,
+        strava_worker_mock,
+    ):
+        service = Entity(ds_util.client.key('Service', 'strava'))
+        service['credentials'] = {'refresh_token': 'validrefreshtoken'}
+        ds_util_client_get_mock.return_value = service
+        event = Entity(
+            ds_util.client.key('SubscriptionEvent', 'pending', parent=service.key)
+        )
+        get_mock.return_value = event
+
+        strava_worker_mock.return_value.sync.side_effect = ValueError('Failed')
+        r = self.client.post(
+            '/tasks/event',
+            data=task_util.task_body_for_test(event_key=event.key),
+        )
+        # Requeued, since events merged into it since have no task.
+        responses.assertResponse(self, responses.OK_SYNC_EXCEPTION, r)
+        retry_mock.assert_called_once_with(event)
+        done_mock.assert_not_called()
+
+        strava_worker_mock.return_value.sync.side_effect = None
+        r = self.client.post(
+            '/tasks/event',
+            data=task_util.task_body_for_test(event_key=event.key),
+        )
+        responses.assertResponse(self, responses.OK, r)
+        done_mock.assert_called_once_with(event)
+        retry_mock.assert_called_once()
+
 
 def _setup_service_get_put(service, ds_util_client_get_mock, ds_util_client_put_mock):
     # We pretend a service exists in the event we create.
@@ -74,3 +193,22 @@ def _setup_service_get_put(service, ds_util_client_get_mock, ds_util_client_put_
         ds_util_client_get_mock.return_value = service
 
     ds_util_client_put_mock.side_effect = mock_put_service
+
+
+def _activity(activity_id, name='Ride'):
+    activity = mock.Mock(
+        id=activity_id,
+        type='Ride',
+        start_date=datetime.datetime(2021, 5, 1, tzinfo=datetime.timezone.utc)
+        + datetime.timedelta(days=activity_id * 3),
+        distance=40000.0,
+        moving_time=datetime.timedelta(hours=2),
+        elapsed_time=datetime.timedelta(hours=2),
+        total_elevation_gain=500.0,
+        private=False,
+        commute=False,
+        gear_id='b1',
+        segment_efforts=[],
+    )
+    activity.name = name
+    return activity
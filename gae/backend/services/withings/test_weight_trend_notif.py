@@ -149,8 +149,8 @@ class WeightTrendWorkerTest(unittest.TestCase):
 
         self._assert_send(
             fcm_util_send_mock,
-            'Down 24.0 kg from a week ago',
-            'You were 54.0 kg on Sep 18, 2020',
+            'Down 26.0 kg from a week ago',
+            'You were 56.0 kg on Sep 18, 2020',
         )
 
     @mock.patch('shared.fcm_util.send')
@@ -15,13 +15,17 @@
 import mock
 import unittest
 
+import arrow
 import flask
 
+from withings_api.common import MeasureType
+
 from google.cloud.datastore.entity import Entity
 
 from shared import ds_util
 from shared import responses
 from shared import task_util
+from shared.datastore.series import Series
 from shared.datastore.service import Service
 
 from services.withings import withings
@@ -40,20 +44,26 @@ class WithingsTest(unittest.TestCase):
         self.app.testing = True
         self.client = self.app.test_client()
 
+    @mock.patch('shared.ds_util.client.transaction')
+    @mock.patch('shared.task_util.xsync_tasks_measure')
     @mock.patch('shared.task_util.withings_tasks_weight_trend')
     @mock.patch('shared.services.withings.client.create_client')
     @mock.patch('shared.ds_util.client.delete_multi')
     @mock.patch('shared.ds_util.client.query')
+    @mock.patch('shared.ds_util.client.put_multi')
     @mock.patch('shared.ds_util.client.put')
     @mock.patch('shared.ds_util.client.get')
     def test_process_event_task_no_duplicate(
         self,
         ds_util_client_get_mock,
         ds_util_client_put_mock,
+        ds_util_client_put_multi_mock,
         ds_util_client_query_mock,
         ds_util_client_delete_multi_mock,
         withings_create_client_mock,
         withings_tasks_weight_trend_mock,
+        xsync_tasks_measure_mock,
+        ds_util_client_transaction_mock,
     ):
         user = Entity(ds_util.client.key('User', 'someuser'))
         user['preferences'] = {'daily_weight_notif': True}
@@ -82,12 +92,70 @@ class WithingsTest(unittest.TestCase):
                 return user
 
         ds_util_client_get_mock.side_effect = get_side_effect
+        measure_get_meas = (
+            withings_create_client_mock.return_value.measure_get_meas.return_value
+        )
+        measure_get_meas.measuregrps = [_measure_group(1600000000, 7529)]
 
         worker = EventsWorker(service, event_entity)
         worker.sync()
 
         ds_util_client_put_mock.assert_any_call(event_entity)
+        ds_util_client_put_multi_mock.assert_called_once()
         withings_tasks_weight_trend_mock.assert_called_once()
+        xsync_tasks_measure_mock.assert_called_once()
+
+    @mock.patch('shared.ds_util.client.transaction')
+    @mock.patch('shared.task_util.withings_tasks_weight_trend')
+    @mock.patch('shared.services.withings.client.create_client')
+    @mock.patch('shared.ds_util.client.delete_multi')
+    @mock.patch('shared.ds_util.client.query')
+    @mock.patch('shared.ds_util.client.put_multi')
+    @mock.patch('shared.ds_util.client.put')
+    @mock.patch('shared.ds_util.client.get')
+    def test_process_event_task_unchanged_measures(
+        self,
+        ds_util_client_get_mock,
+        ds_util_client_put_mock,
+        ds_util_client_put_multi_mock,
+        ds_util_client_query_mock,
+        ds_util_client_delete_multi_mock,
+        withings_create_client_mock,
+        withings_tasks_weight_trend_mock,
+        ds_util_client_transaction_mock,
+    ):
+        user = Entity(ds_util.client.key('User', 'someuser'))
+        user['preferences'] = {'daily_weight_notif': True}
+        service = Entity(ds_util.client.key('Service', 'withings', parent=user.key))
+        service['credentials'] = {'refresh_token': 'validrefreshtoken'}
+
+        event_entity = Entity(
+            ds_util.client.key('SubscriptionEvent', 'Event', parent=service.key)
+        )
+        event_entity.update({'event_data': {'startdate': '1', 'enddate': '1'}})
+
+        measure_group = _measure_group(1600000000, 7529)
+        series = Series.to_entity([measure_group], service.key)
+
+        def get_side_effect(key):
+            if key.kind == 'Series':
+                return series
+            elif key.name == 'withings':
+                return service
+            elif key.name == 'someuser':
+                return user
+
+        ds_util_client_get_mock.side_effect = get_side_effect
+        measure_get_meas = (
+            withings_create_client_mock.return_value.measure_get_meas.return_value
+        )
+        measure_get_meas.measuregrps = [measure_group]
+
+        worker = EventsWorker(service, event_entity)
+        worker.sync()
+
+        ds_util_client_put_multi_mock.assert_not_called()
+        withings_tasks_weight_trend_mock.assert_not_called()
 
     @mock.patch('shared.task_util.withings_tasks_weight_trend')
     @mock.patch('shared.services.withings.client.create_client')
@@ -205,3 +273,11 @@ def _setup_service_get_put(service, ds_util_client_get_mock, ds_util_client_put_
         ds_util_client_get_mock.return_value = service
 
     ds_util_client_put_mock.side_effect = mock_put_service
+
+
+def _measure_group(timestamp, weight):
+    measure = mock.Mock(type=MeasureType.WEIGHT, unit=-2, value=weight)
+    return mock.Mock(
+        date=arrow.get(timestamp),
+        measures=[measure],
+    )
@@ -22,8 +22,8 @@ from measurement.measures import Weight
 
 from shared import ds_util
 from shared import fcm_util
-from shared.datastore.series import Series
 from shared.datastore.user import Preferences
+from shared.datastore.weight_trend import WeightTrendSnapshot
 from shared.services.withings import client as withings_client
 
 
@@ -49,8 +49,8 @@ class WeightTrendWorker(object):
         to_imperial = user['preferences']['units'] == Preferences.Units.IMPERIAL
 
         # Calculate the trend.
-        series_entity = Series.get(self.service.key)
-        weight_trend = self._weight_trend(series_entity)
+        snapshot = WeightTrendSnapshot.get_or_rebuild(self.service.key)
+        weight_trend = self._weight_trend(snapshot)
 
         time_frame = self._get_best_time_frame(weight_trend)
         if time_frame is None:
@@ -112,33 +112,32 @@ class WeightTrendWorker(object):
 
         fcm_util.send(self.event.key, clients, notif_fn)
 
-    def _weight_trend(self, series):
+    def _weight_trend(self, snapshot):
         """Find a series of weights across various time intervals.
 
-        Returns: {'time_frame': [time_frame_date, measure]}
+        Returns: {'time_frame': {'date': date, 'weight': weight}}
         """
         today = get_now().date()
 
         trend = [
-            ('a year ago', today - datetime.timedelta(days=365)),
-            ('six months ago', today - datetime.timedelta(days=183)),
-            ('a month ago', today - datetime.timedelta(days=30)),
-            ('a week ago', today - datetime.timedelta(days=7)),
-            ('latest', today),
+            ('a year ago', 365),
+            ('six months ago', 183),
+            ('a month ago', 30),
+            ('a week ago', 7),
+            ('latest', 0),
         ]
 
         trend_result = {}
-
-        trend_index = 0
-        time_frame, tick = trend[trend_index]
-        for measure in series['measures']:
-            while measure['date'].date() > tick:
-                # we've come newer than the tick, we need a smaller tick.
-                trend_index += 1
-                time_frame, tick = trend[trend_index]
-            if measure['date'].date() <= tick:
-                if 'weight' in measure:
-                    trend_result[time_frame] = measure
+        previous_tick = None
+        for time_frame, days in trend:
+            tick = today - datetime.timedelta(days=days)
+            measure = WeightTrendSnapshot.lookback(snapshot, days, today)
+            # Each time frame only counts measures newer than the one before.
+            if measure is not None and (
+                previous_tick is None or measure['date'].date() > previous_tick
+            ):
+                trend_result[time_frame] = measure
+            previous_tick = tick
         return trend_result
 
     def _get_best_time_frame(self, weight_trend):
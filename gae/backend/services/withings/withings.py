@@ -13,7 +13,6 @@
 # limitations under the License.
 
 import datetime
-import heapq
 import logging
 from urllib.parse import urlencode
 
@@ -33,6 +32,7 @@ from shared.datastore.series import Measure, Series
 from shared.datastore.service import Service
 from shared.datastore.subscription import Subscription
 from shared.datastore.user import User
+from shared.datastore.weight_trend import WeightTrendSnapshot
 from shared.exceptions import SyncException
 from shared.services.withings import client
 
@@ -131,7 +131,8 @@ class Worker(object):
             key=lambda x: x.date,
         )
         series = Series.to_entity(measures, parent=self.service.key)
-        ds_util.client.put(series)
+        Series.put(series)
+        WeightTrendSnapshot.rebuild(self.service.key, series['measures'])
 
     def sync_subscription(self):
         query_string = urlencode(
@@ -238,10 +239,6 @@ class EventsWorker(object):
         else:
             ds_util.client.put(self.event)
 
-        series = Series.get(self.service.key)
-        series['measures'] = series.get('measures', [])
-        logging.debug('Measures length before: %s', len(series['measures']))
-
         new_measures = [
             Measure.to_entity(m, self.service.key)
             for m in self.client.measure_get_meas(
@@ -256,44 +253,35 @@ class EventsWorker(object):
         ]
         logging.debug('Found %s new measures', len(new_measures))
 
-        # Remove any measures with dates we just fetched.
-        series['measures'] = [
-            m
-            for m in filter(
-                lambda x: x['date'] not in (nm['date'] for nm in new_measures),
-                series['measures'],
-            )
-        ]
-
-        logging.debug('Measures length filtered: %s', len(series['measures']))
-
-        # Merge the two sorted lists.
-        series['measures'] = [
-            m
-            for m in heapq.merge(
-                series['measures'], new_measures, key=lambda x: x['date']
-            )
-        ]
-        logging.debug('Measures length after: %s', len(series['measures']))
-
-        # Store the updated measures.
-        ds_util.client.put(series)
-        logging.debug('WithingsEvent: Updated series: %s', self.event.key)
+        # Store the new measures, replacing any with the same dates.
+        change = Series.upsert(self.service.key, new_measures)
+        if change is None:
+            logging.info('WithingsEvent: No measures changed: %s', self.event.key)
+            return
+        logging.debug(
+            'WithingsEvent: Updated %s measures from %s to %s: %s',
+            len(change.changed),
+            change.start,
+            change.end,
+            self.event.key,
+        )
+        WeightTrendSnapshot.update(self.service.key, change)
 
-        # Possibly fire off down-stream events.
+        # Possibly fire off down-stream events, for only what changed.
         user = User.get(self.service.key.parent)
-        if user['preferences']['daily_weight_notif']:
-            logging.debug(
-                'WithingsEvent: daily_weight_notif: Queued: %s: %s',
-                user.key,
-                self.event.key,
-            )
-            task_util.withings_tasks_weight_trend(self.event)
-        if user['preferences']['sync_weight']:
-            logging.debug(
-                'WithingsEvent: ProcessMeasure: Queued: %s: %s',
-                user.key,
-                self.event.key,
-            )
-            for measure in new_measures:
-                task_util.xsync_tasks_measure(user.key, measure)
+        with task_util.TaskBatch():
+            if user['preferences']['daily_weight_notif']:
+                logging.debug(
+                    'WithingsEvent: daily_weight_notif: Queued: %s: %s',
+                    user.key,
+                    self.event.key,
+                )
+                task_util.withings_tasks_weight_trend(self.event)
+            if user['preferences']['sync_weight']:
+                logging.debug(
+                    'WithingsEvent: ProcessMeasure: Queued: %s: %s',
+                    user.key,
+                    self.event.key,
+                )
+                for measure in change.changed:
+                    task_util.xsync_tasks_measure(user.key, measure)
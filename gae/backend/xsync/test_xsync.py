@@ -12,11 +12,22 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import datetime
+import mock
 import unittest
 
 import flask
 
+from google.cloud.datastore.entity import Entity
+
+from shared import ds_util
+from shared import testing_util
+from shared.datastore.backfill_job import BackfillJob
+from shared.datastore import sync_ledger
+from shared.datastore.sync_ledger import SyncLedger
+
 from xsync import xsync
+from xsync.xsync import BackfillWorker
 
 
 class XsyncTest(unittest.TestCase):
@@ -26,5 +37,248 @@ class XsyncTest(unittest.TestCase):
         self.app.testing = True
         self.client = self.app.test_client()
 
-    def test(self):
-        pass
+        user_key = ds_util.client.key('User', 'someuser')
+        self.user_key = user_key
+        self.stored = testing_util.fake_datastore(self).stored
+        for name in ('garmin', 'trainerroad'):
+            service = Entity(ds_util.client.key('Service', name, parent=user_key))
+            service['credentials'] = {'username': 'user', 'password': 'validpassword'}
+            self.stored[service.key] = service
+
+        patchers = [
+            mock.patch('shared.task_util.get_payload'),
+            mock.patch('shared.task_util.xsync_tasks_trainerroad'),
+            mock.patch('shared.services.garmin.client.create'),
+            mock.patch('xsync.xsync.trainerroad_create_client'),
+        ]
+        (
+            self.payload_mock,
+            self.trainerroad_task_mock,
+            self.garmin_create_mock,
+            self.trainerroad_create_mock,
+        ) = [p.start() for p in patchers]
+        for patcher in patchers:
+            self.addCleanup(patcher.stop)
+
+    def _post_measure(self, measure):
+        self.payload_mock.return_value = {'user_key': self.user_key, 'measure': measure}
+        self.client.post('/tasks/measure')
+
+    def test_measure_written_once(self):
+        measure = _measure(1, 71.0)
+        self._post_measure(measure)
+        self._post_measure(measure)
+
+        set_weight = self.garmin_create_mock.return_value.set_weight
+        set_weight.assert_called_once_with(71.0, measure['date'])
+        self.assertTrue(SyncLedger.is_synced(self.user_key, 'garmin', measure))
+
+        # A new value for the same measure is written.
+        self._post_measure(_measure(1, 72.0))
+        set_weight.assert_called_with(72.0, measure['date'])
+
+    def test_trainerroad_burst_written_once(self):
+        for day, weight in ((1, 71.0), (3, 73.0), (2, 72.0)):
+            self._post_measure(_measure(day, weight))
+        self.trainerroad_task_mock.assert_called_once()
+
+        self.payload_mock.return_value = {'user_key': self.user_key}
+        self.client.post('/tasks/trainerroad')
+        self.client.post('/tasks/trainerroad')
+
+        trainerroad = self.trainerroad_create_mock.return_value
+        self.assertEqual(1, self.trainerroad_create_mock.call_count)
+        self.assertEqual(73.0, trainerroad.weight)
+
+        # Older measures don't replace the latest.
+        self._post_measure(_measure(2, 70.0))
+        self.trainerroad_task_mock.assert_called_once()
+
+    def test_trainerroad_failure_retried(self):
+        self._post_measure(_measure(1, 71.0))
+        trainerroad = self.trainerroad_create_mock.return_value
+        type(trainerroad).weight = mock.PropertyMock(side_effect=[Exception, None])
+
+        self.payload_mock.return_value = {'user_key': self.user_key}
+        self.assertEqual(201, self.client.post('/tasks/trainerroad').status_code)
+        self.assertIn(SyncLedger.pending_key(self.user_key, 'trainerroad'), self.stored)
+        # Requeued, since queues don't retry.
+        self.trainerroad_task_mock.assert_called_with(
+            self.user_key, sync_ledger.RETRY_DELAY
+        )
+
+        self.assertEqual(200, self.client.post('/tasks/trainerroad').status_code)
+        self.assertNotIn(
+            SyncLedger.pending_key(self.user_key, 'trainerroad'), self.stored
+        )
+        self.assertTrue(
+            SyncLedger.is_synced(self.user_key, 'trainerroad', _measure(1, 71.0))
+        )
+
+    @mock.patch('xsync.xsync.BackfillWorker.sync')
+    def test_backfill_failure_returns_error(self, sync_mock):
+        sync_mock.side_effect = Exception('Boom')
+        self.payload_mock.return_value = {
+            'source_key': ds_util.client.key(
+                'Service', 'withings', parent=self.user_key
+            ),
+            'dest_key': ds_util.client.key('Service', 'garmin', parent=self.user_key),
+            'start': None,
+            'end': None,
+        }
+
+        self.assertEqual(500, self.client.post('/tasks/backfill').status_code)
+
+
+class BackfillWorkerTest(unittest.TestCase):
+    def setUp(self):
+        user_key = ds_util.client.key('User', 'someuser')
+        self.source = Entity(ds_util.client.key('Service', 'withings', parent=user_key))
+        self.source['credentials'] = {'refresh_token': 'validrefreshtoken'}
+        self.dest = Entity(ds_util.client.key('Service', 'garmin', parent=user_key))
+        self.dest['credentials'] = {'password': 'validpassword'}
+        self.measures = [_measure(day, 70.0 + day) for day in range(1, 11)]
+        # Garmin already has the third measure.
+        self.garmin_weights = [self.measures[2]]
+
+        self.stored = testing_util.fake_datastore(self).stored
+        self.stored[self.source.key] = self.source
+        self.stored[self.dest.key] = self.dest
+        job = BackfillJob.to_entity(self.source.key, self.dest.key, None, None)
+        self.stored[job.key] = job
+
+        patchers = [
+            mock.patch('shared.datastore.series.Series.get'),
+            mock.patch('shared.services.garmin.client.create'),
+            mock.patch('shared.task_util.xsync_tasks_backfill'),
+            mock.patch('xsync.xsync.time.sleep'),
+        ]
+        (
+            series_get_mock,
+            create_mock,
+            self.task_mock,
+            _,
+        ) = [p.start() for p in patchers]
+        for patcher in patchers:
+            self.addCleanup(patcher.stop)
+        series_get_mock.side_effect = self._series_get
+        self.garmin = create_mock.return_value
+        self.garmin.get_body_comp.side_effect = lambda start, end: {
+            'dateWeightList': [
+                {'timestampGMT': int(m['date'].timestamp() * 1000)}
+                for m in self.garmin_weights
+            ]
+        }
+        self.garmin.set_weight.side_effect = lambda weight, date: (
+            self.garmin_weights.append({'date': date})
+        )
+
+    def _series_get(self, parent, start=None, end=None):
+        series = Entity(ds_util.client.key('Series', parent.name, parent=parent))
+        series['measures'] = [
+            m for m in self.measures if start is None or m['date'] >= start
+        ]
+        return series
+
+    def test_uploads_measures_dest_lacks(self):
+        job = BackfillWorker(self.source.key, self.dest.key).sync()
+
+        self.assertTrue(job['done'])
+        self.assertEqual(9, job['uploaded'])
+        self.assertEqual(1, job['skipped'])
+        self.assertEqual(10, job['total'])
+        self.assertEqual(self.measures[-1]['date'], job['cursor'])
+        self.assertEqual(9, self.garmin.set_weight.call_count)
+        self.garmin.get_body_comp.assert_called_once_with('2020-09-01', '2020-09-10')
+        self.task_mock.assert_not_called()
+
+    def test_continues_in_new_task(self):
+        now = [0]
+
+        def clock():
+            now[0] += 10
+            return now[0]
+
+        job = BackfillWorker(
+            self.source.key, self.dest.key, time_budget_seconds=45, clock=clock
+        ).sync()
+        self.assertFalse(job['done'])
+        self.assertEqual(self.measures[3]['date'], job['cursor'])
+        self.task_mock.assert_called_once_with(
+            self.source.key, self.dest.key, None, None
+        )
+
+        # The next task resumes after the cursor.
+        job = BackfillWorker(self.source.key, self.dest.key).sync()
+        self.assertTrue(job['done'])
+        self.assertEqual(9, job['uploaded'])
+        self.assertEqual(9, self.garmin.set_weight.call_count)
+        self.garmin.get_body_comp.assert_called_with('2020-09-05', '2020-09-10')
+
+    def test_skips_ledgered_measures(self):
+        for measure in self.measures[:5]:
+            SyncLedger.record(self.source.key.parent, 'garmin', measure)
+
+        job = BackfillWorker(self.source.key, self.dest.key).sync()
+
+        self.assertTrue(job['done'])
+        self.assertEqual(5, job['uploaded'])
+        self.assertEqual(5, job['skipped'])
+        self.garmin.get_body_comp.assert_called_once_with('2020-09-06', '2020-09-10')
+
+    def test_failure_is_recorded(self):
+        def set_weight(weight, date):
+            if weight > 73:
+                raise Exception('Boom')
+
+        self.garmin.set_weight.side_effect = set_weight
+
+        self.assertRaises(
+            Exception, BackfillWorker(self.source.key, self.dest.key).sync
+        )
+
+        job = self.stored[BackfillJob.key(self.source.key, self.dest.key)]
+        self.assertFalse(job['done'])
+        self.assertEqual('Boom', job['error'])
+        self.assertEqual(self.measures[2]['date'], job['cursor'])
+        self.assertEqual(2, job['uploaded'])
+
+    def test_failed_job_resumed(self):
+        def set_weight(weight, date):
+            if weight > 73 and not resumed:
+                raise Exception('Boom')
+
+        resumed = False
+        self.garmin.set_weight.side_effect = set_weight
+        self.assertRaises(
+            Exception, BackfillWorker(self.source.key, self.dest.key).sync
+        )
+
+        # A later POST /backfill resumes it, rather than leaving it failed.
+        resumed = True
+        job = BackfillJob.start(self.source.key, self.dest.key, None, None)
+        self.assertIsNone(job['error'])
+        self.assertEqual(self.measures[2]['date'], job['cursor'])
+
+        job = BackfillWorker(self.source.key, self.dest.key).sync()
+        self.assertTrue(job['done'])
+        self.assertIsNone(job['error'])
+        self.assertEqual(9, job['uploaded'])
+        self.assertEqual(1, job['skipped'])
+
+    def test_nothing_to_do(self):
+        del self.stored[BackfillJob.key(self.source.key, self.dest.key)]
+        self.assertIsNone(BackfillWorker(self.source.key, self.dest.key).sync())
+
+
+def _measure(day, weight):
+    measure = Entity()
+    measure.update(
+        {
+            'date': datetime.datetime(
+                2020, 9, day, 7, 13, tzinfo=datetime.timezone.utc
+            ),
+            'weight': weight,
+        }
+    )
+    return measure
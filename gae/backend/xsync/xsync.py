@@ -26,8 +26,10 @@ from google.cloud.datastore.key import Key
 from shared import ds_util
 from shared import task_util
 from shared import responses
+from shared.datastore.backfill_job import BackfillJob
 from shared.datastore.series import Series
 from shared.datastore.service import Service
+from shared.datastore.sync_ledger import SyncLedger
 from shared.exceptions import SyncException
 from shared.services.garmin import client as garmin_client
 from shared.services.trainerroad.client import (
@@ -39,6 +41,9 @@ import sync_helper
 
 module = flask.Blueprint('xsync', __name__)
 
+# How long a backfill task uploads before handing the rest to a new task.
+TIME_BUDGET_SECONDS = 5 * 60
+
 
 @module.route('/tasks/measure', methods=['POST'])
 def xsync_tasks_measure():
@@ -67,12 +72,18 @@ def _withings_garmin(request, user_key, measure):
         logging.debug('ProcessMeasure: Skipping non-weight measure.')
         return responses.OK
 
+    if SyncLedger.is_synced(user_key, 'garmin', measure):
+        logging.debug('ProcessMeasure: Already synced to Garmin: %s', measure)
+        return responses.OK
+
     try:
         client = garmin_client.create(garmin_service)
         client.set_weight(measure['weight'], measure['date'])
     except Exception:
         logging.exception('ProcessMeasure: Failed: %s', measure)
         return responses.OK_SYNC_EXCEPTION
+    SyncLedger.record(user_key, 'garmin', measure)
+    garmin_client.sessions.log_stats()
     return responses.OK
 
 
@@ -91,13 +102,44 @@ def _withings_trainerroad(request, user_key, measure):
         logging.debug('ProcessMeasure: Skipping non-weight measure.')
         return responses.OK
 
-    try:
-        client = trainerroad_create_client(trainerroad_service)
-        with client:
-            client.weight = measure['weight']
-    except Exception:
-        logging.exception('ProcessMeasure: Failed: %s', measure)
-        return responses.OK_SYNC_EXCEPTION
+    if SyncLedger.is_synced(user_key, 'trainerroad', measure):
+        logging.debug('ProcessMeasure: Already synced to Trainerroad: %s', measure)
+        return responses.OK
+
+    # Trainerroad only keeps the latest weight, so write a burst's once.
+    SyncLedger.defer(user_key, 'trainerroad', measure)
+    return responses.OK
+
+
+@module.route('/tasks/trainerroad', methods=['POST'])
+def xsync_tasks_trainerroad():
+    params = task_util.get_payload(flask.request)
+    user_key = params['user_key']
+
+    pending = SyncLedger.peek(user_key, 'trainerroad')
+    if pending is None:
+        logging.debug('ProcessMeasure: No pending Trainerroad weight: %s', user_key)
+        return responses.OK
+    measure = {'date': pending['date'], 'weight': pending['weight']}
+    logging.info('ProcessMeasure: trainerroad: %s %s', user_key, measure)
+
+    trainerroad_service = Service.get('trainerroad', parent=user_key)
+    if not Service.has_credentials(trainerroad_service, required_key='password'):
+        logging.debug('ProcessMeasure: Trainerroad not connected')
+    elif SyncLedger.is_synced(user_key, 'trainerroad', measure):
+        logging.debug('ProcessMeasure: Already synced to Trainerroad: %s', measure)
+    else:
+        try:
+            client = trainerroad_create_client(trainerroad_service)
+            with client:
+                client.weight = measure['weight']
+        except Exception:
+            logging.exception('ProcessMeasure: Failed: %s', measure)
+            SyncLedger.retry(user_key, 'trainerroad', pending)
+            return responses.OK_SYNC_EXCEPTION
+        SyncLedger.record(user_key, 'trainerroad', measure)
+
+    SyncLedger.done(user_key, 'trainerroad', pending)
     return responses.OK
 
 
@@ -106,33 +148,48 @@ def tasks_xsync_tasks_backfill():
     params = task_util.get_payload(flask.request)
     source_key = params['source_key']
     dest_key = params['dest_key']
-    start = params['start']
-    end = params['end']
     logging.info('xsync_tasks_backfill: %s->%s', source_key, dest_key)
 
-    try:
-        sync_helper.do(
-            BackfillWorker(source_key, dest_key, start, end), work_key=source_key
+    if BackfillJob.get(source_key, dest_key) is None:
+        ds_util.client.put(
+            BackfillJob.to_entity(source_key, dest_key, params['start'], params['end'])
         )
+
+    try:
+        sync_helper.do(BackfillWorker(source_key, dest_key), work_key=source_key)
     except SyncException:
-        return responses.OK_SYNC_EXCEPTION
+        # Queues don't retry, so the job keeps its error, for the next POST
+        # /backfill to resume it from its last checkpoint.
+        return responses.INTERNAL_SERVER_ERROR
     return responses.OK
 
 
 class BackfillWorker(object):
+    """Uploads a BackfillJob's measures, resuming from its checkpoint.
+
+    Each task works through the measures after the job's cursor for up to
+    time_budget_seconds, checkpointing after every upload, then hands the
+    rest to a new task. Measures the destination already has are skipped.
+    """
+
     def __init__(
         self,
         source_key: Key,
         dest_key: Key,
-        start: datetime.datetime,
-        end: datetime.datetime,
+        time_budget_seconds=TIME_BUDGET_SECONDS,
+        clock=time.monotonic,
     ):
         self.source_key = source_key
         self.dest_key = dest_key
-        self.start = start
-        self.end = end
+        self.time_budget_seconds = time_budget_seconds
+        self._clock = clock
 
     def sync(self):
+        job = BackfillJob.get(self.source_key, self.dest_key)
+        if job is None or job['done']:
+            logging.debug('BackfillWorker: Nothing to do: %s', self.source_key)
+            return job
+
         source = ds_util.client.get(self.source_key)
         dest = ds_util.client.get(self.dest_key)
 
@@ -141,39 +198,101 @@ class BackfillWorker(object):
         if not self._check_creds(dest):
             raise Exception('Dest does not have credentials: %s', dest.key)
 
-        series = Series.get(source.key)
-        if not series['measures']:
-            logging.debug('Source has no measures: %s', source.key)
-            return
-        measures = series['measures']
-        del series
-
-        measures = [m for m in filter(lambda m: self._isbackfillable(m), measures)]
+        try:
+            self._sync_slice(job, dest)
+        except Exception as e:
+            job['error'] = str(e)
+            self._checkpoint(job)
+            raise
+
+        logging.info(
+            'BackfillWorker: %s uploaded, %s skipped of %s, done: %s: %s',
+            job['uploaded'],
+            job['skipped'],
+            job['total'],
+            job['done'],
+            job.key,
+        )
+        garmin_client.sessions.log_stats()
+        return job
+
+    def _sync_slice(self, job, dest):
+        deadline = self._clock() + self.time_budget_seconds
+        measures = self._remaining(job)
+        job['total'] = job['uploaded'] + job['skipped'] + len(measures)
+        job['slices'] += 1
+        job['error'] = None
         logging.debug('Syncing %s measures to %s', len(measures), dest.key.name)
 
-        if dest.key.name == 'garmin':
-            client = garmin_client.create(dest)
-            # Shorten and maybe GC measures as we iterate
-            while len(measures) > 0:
-                measure = measures.pop(0)
+        if measures and dest.key.name != 'garmin':
+            raise Exception('Backfill to %s is not supported' % (dest.key.name,))
 
-                @retry(
-                    wait_exponential_multiplier=1000 * 2,
-                    wait_exponential_max=1000 * 60 * 30,
+        user_key = self.source_key.parent
+        synced = SyncLedger.synced_dates(user_key, dest.key.name, measures)
+        unsynced = [m for m in measures if m['date'] not in synced]
+        existing = set()
+        if unsynced:
+            client = garmin_client.create(dest)
+            existing = self._dest_timestamps(client, unsynced)
+        for measure in measures:
+            if self._clock() > deadline:
+                logging.info('BackfillWorker: Continuing in a new task: %s', job.key)
+                self._checkpoint(job)
+                task_util.xsync_tasks_backfill(
+                    self.source_key, self.dest_key, job['start'], job['end']
                 )
-                def _set_weight():
-                    logging.debug('Setting weight for %s', measure['date'])
-                    try:
-                        client.set_weight(measure['weight'], measure['date'])
-                        time.sleep(random.randint(1, 2))
-                    except Exception:
-                        logging.exception(
-                            'Failed to set_weight for %s', measure['date']
-                        )
-                        raise
-
-                _set_weight()
-                del measure
+                return
+
+            timestamp = ds_util.to_micros(measure['date']) // 1000000
+            if measure['date'] in synced or timestamp in existing:
+                job['skipped'] += 1
+                job['cursor'] = measure['date']
+                continue
+
+            _set_weight(client, measure)
+            SyncLedger.record(user_key, dest.key.name, measure)
+            job['uploaded'] += 1
+            job['cursor'] = measure['date']
+            self._checkpoint(job)
+            time.sleep(random.randint(1, 2))
+
+        job['done'] = True
+        self._checkpoint(job)
+
+    def _remaining(self, job):
+        """The measures to upload after the job's cursor, oldest first."""
+        cursor = job['cursor']
+        start = job['start']
+        if cursor is not None and (start is None or cursor > start):
+            start = cursor
+        series = Series.get(self.source_key, start=start, end=job['end'])
+        if series is None:
+            logging.debug('Source has no measures: %s', self.source_key)
+            return []
+        return [
+            m
+            for m in series['measures']
+            if m.get('weight') and (cursor is None or m['date'] > cursor)
+        ]
+
+    def _dest_timestamps(self, client, measures):
+        """The timestamps of the destination's weights over measures' dates."""
+        try:
+            body_comp = client.get_body_comp(
+                measures[0]['date'].date().isoformat(),
+                measures[-1]['date'].date().isoformat(),
+            )
+        except Exception:
+            logging.exception('BackfillWorker: Failed to fetch destination range')
+            return set()
+        return set(
+            item['timestampGMT'] // 1000
+            for item in (body_comp or {}).get('dateWeightList', [])
+        )
+
+    def _checkpoint(self, job):
+        job['updated_at'] = datetime.datetime.now(datetime.timezone.utc)
+        ds_util.client.put(job)
 
     def _check_creds(self, service):
         return (
@@ -181,11 +300,16 @@ class BackfillWorker(object):
             and Service.has_credentials(service, required_key='password')
         ) or (Service.has_credentials(service))
 
-    def _isbackfillable(self, measure):
-        if not measure.get('weight'):
-            return False
-        if self.start and measure['date'] < self.start:
-            return False
-        if self.end and measure['date'] > self.end:
-            return False
-        return True
+
+@retry(
+    wait_exponential_multiplier=1000 * 2,
+    wait_exponential_max=1000 * 60,
+    stop_max_attempt_number=5,
+)
+def _set_weight(client, measure):
+    logging.debug('Setting weight for %s', measure['date'])
+    try:
+        client.set_weight(measure['weight'], measure['date'])
+    except Exception:
+        logging.exception('Failed to set_weight for %s', measure['date'])
+        raise
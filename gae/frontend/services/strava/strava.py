@@ -18,7 +18,6 @@ import logging
 import flask
 from flask_cors import cross_origin
 
-from google.api_core.exceptions import AlreadyExists
 from google.cloud.datastore.entity import Entity
 
 import stravalib
@@ -30,6 +29,7 @@ from shared.datastore.bot import Bot
 from shared.datastore.athlete import Athlete
 from shared.datastore.service import Service
 from shared.datastore.subscription import SubscriptionEvent
+from shared.services.strava import event_coalescer
 from shared import responses
 
 
@@ -97,11 +97,9 @@ def events_post():
         logging.error('StravaEvent: failure: %s', sub_event_failure)
     else:
         event_entity = SubscriptionEvent.to_entity(event_data, parent=service_key)
-        try:
-            task_util.process_event(service_key, event_entity)
-            logging.debug('StravaEvent: Queued: %s', event_entity.key)
-        except AlreadyExists:
-            logging.debug('StravaEvent: Duplicate: %s', event_entity.key)
+        pending = event_coalescer.coalesce(service_key, event_entity)
+        logging.debug('StravaEvent: Queued: %s', pending.key)
+        event_coalescer.log_stats()
     return responses.OK
 
 
@@ -21,6 +21,7 @@ from google.cloud.datastore.entity import Entity
 
 from shared import ds_util
 from shared import responses
+from shared import testing_util
 
 from services.strava import strava
 
@@ -48,11 +49,20 @@ class StravaTest(unittest.TestCase):
     def test_strava_event_valid(self, _post_task_for_dev_mock, athlete_get_by_id_mock):
         mock_athlete = Entity(ds_util.client.key('Service', 'strava', 'Athlete'))
         athlete_get_by_id_mock.return_value = mock_athlete
+        stored = testing_util.fake_datastore(self).stored
 
         r = self.client.post('/events', json=self._create_event())
         responses.assertResponse(self, responses.OK, r)
         _post_task_for_dev_mock.assert_called_once()
 
+        # A second event for the same activity joins the pending one.
+        update = dict(self._create_event(), aspect_type='update', event_time=1549151212)
+        r = self.client.post('/events', json=update)
+        responses.assertResponse(self, responses.OK, r)
+        _post_task_for_dev_mock.assert_called_once()
+        (pending,) = stored.values()
+        self.assertEqual(2, pending['coalesced'])
+
     @mock.patch('shared.datastore.athlete.Athlete.get_by_id', return_value=None)
     @mock.patch('shared.task_util._post_task_for_dev')
     def test_strava_event_unknown_athlete(
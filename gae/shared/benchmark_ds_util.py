@@ -0,0 +1,146 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares sequential puts with BatchWriter for a synthetic Strava sync.
+
+Each activity is written along with its segment efforts, as in
+strava.Worker.sync_activities. By default, commits go to a fake client that
+sleeps --rpc-latency-ms per commit; with --emulator they go to the Datastore
+emulator at $DATASTORE_EMULATOR_HOST.
+
+Usage, from gae/:
+    python -m shared.benchmark_ds_util --activities 2000
+    python -m shared.benchmark_ds_util --activities 2000 --emulator
+"""
+
+import argparse
+import collections
+import datetime
+import time
+
+from google.cloud.datastore import Client
+from google.cloud.datastore.entity import Entity
+
+from shared import ds_util
+from shared.config import config
+
+
+class FakeClient(object):
+    """Stands in for Datastore, each commit taking latency seconds."""
+
+    current_transaction = None
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def put(self, entity):
+        self.put_multi([entity])
+
+    def put_multi(self, entities):
+        time.sleep(self.latency)
+
+
+class CountingClient(object):
+    """Counts the commits made through client."""
+
+    def __init__(self, client):
+        self.client = client
+        self.stats = collections.Counter()
+
+    def __getattr__(self, attr):
+        return getattr(self.client, attr)
+
+    def put(self, entity):
+        self.stats['rpcs'] += 1
+        self.stats['entities'] += 1
+        return self.client.put(entity)
+
+    def put_multi(self, entities):
+        self.stats['rpcs'] += 1
+        self.stats['entities'] += len(entities)
+        return self.client.put_multi(entities)
+
+
+def _entities(activities, efforts):
+    parent = ds_util.client.key(
+        'Service', 'strava', parent=ds_util.client.key('User', 'bench')
+    )
+    start = datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)
+    for i in range(activities):
+        activity = Entity(ds_util.client.key('Activity', i + 1, parent=parent))
+        activity.update(
+            {
+                'id': i + 1,
+                'name': 'Ride %s' % (i,),
+                'description': 'Hills and coffee.',
+                'distance': 40000.0,
+                'moving_time': 5400,
+                'start_date': start + datetime.timedelta(days=i),
+                'map': {'summary_polyline': 'a~l~Fjk~uOwHJy@P' * 50},
+            }
+        )
+        yield activity
+        for j in range(efforts):
+            effort = Entity(
+                ds_util.client.key('SegmentEffort', i * efforts + j + 1, parent=parent)
+            )
+            effort.update(
+                {
+                    'id': i * efforts + j + 1,
+                    'name': 'Segment %s' % (j,),
+                    'elapsed_time': 300,
+                    'start_date': start + datetime.timedelta(days=i, minutes=j),
+                }
+            )
+            yield effort
+
+
+def _sequential(client, entities):
+    for entity in entities:
+        client.put(entity)
+
+
+def _batched(client, entities):
+    with ds_util.BatchWriter(client) as writer:
+        for entity in entities:
+            writer.put(entity)
+
+
+def main(activities, efforts, rpc_latency_ms, emulator):
+    if emulator:
+        backing = Client(project=config.project_id)
+    else:
+        backing = FakeClient(rpc_latency_ms / 1000)
+
+    print('%-10s %9s %6s %9s' % ('writer', 'entities', 'rpcs', 'wall (s)'))
+    for name, write in (('sequential', _sequential), ('batched', _batched)):
+        client = CountingClient(backing)
+        start = time.perf_counter()
+        write(client, _entities(activities, efforts))
+        elapsed = time.perf_counter() - start
+        print(
+            '%-10s %9d %6d %9.2f'
+            % (name, client.stats['entities'], client.stats['rpcs'], elapsed)
+        )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--activities', type=int, default=2000)
+    parser.add_argument('--efforts', type=int, default=5)
+    parser.add_argument('--rpc-latency-ms', type=float, default=5)
+    parser.add_argument('--emulator', action='store_true')
+    args = parser.parse_args()
+
+    main(args.activities, args.efforts, args.rpc_latency_ms, args.emulator)
@@ -0,0 +1,166 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares task payload encodings for representative task params.
+
+"legacy" is the bare Entity protobuf tasks used to carry, with embedded
+entities. "codec" is task_codec.encode of the params tasks send now, with keys
+in place of entities the worker fetches anyway.
+
+Usage, from gae/:
+    python -m shared.benchmark_task_codec --iterations 200
+"""
+
+import argparse
+import datetime
+import timeit
+
+from google.cloud.datastore.entity import Entity
+
+from shared import ds_util
+from shared import task_codec
+from shared.datastore.subscription import SubscriptionEvent
+
+
+def _params(**kwargs):
+    params = Entity(ds_util.client.key('TaskParams'))
+    params.update(kwargs)
+    return params
+
+
+def _track(points):
+    start = datetime.datetime(2021, 5, 1, 16, 0)
+    track = Entity(ds_util.client.key('Track', 'https://livetrack.garmin.com/s/t'))
+    track.update(
+        {
+            'url': 'https://livetrack.garmin.com/s/t',
+            'url_info': {'session': 's', 'token': 't'},
+            'status': 4,
+            'info': {
+                'session': {
+                    'sessionName': "Joe LaPenna's Ride",
+                    'start': start.isoformat(),
+                    'end': (start + datetime.timedelta(hours=2)).isoformat(),
+                }
+            },
+            'trackpoints': {
+                'trackPoints': [
+                    {
+                        'dateTime': (start + datetime.timedelta(seconds=i)).isoformat(),
+                        'position': {'lat': 37.7 + i / 10000, 'lon': -122.4},
+                        'altitude': 50.0 + i % 30,
+                        'speed': 6.2,
+                        'fitnessPointData': {'heartRateBeatsPerMin': 140},
+                    }
+                    for i in range(points)
+                ]
+            },
+        }
+    )
+    return track
+
+
+def _activity(efforts):
+    activity = Entity(ds_util.client.key('Activity', 4000000000))
+    activity.update(
+        {
+            'id': 4000000000,
+            'name': 'Morning Ride',
+            'description': 'Hills and coffee. ' * 10,
+            'distance': 80467.2,
+            'moving_time': 10800,
+            'start_date': datetime.datetime(2021, 5, 1, 16, 0),
+            'map': {'summary_polyline': 'a~l~Fjk~uOwHJy@P' * 100},
+            'segment_efforts': [
+                {'id': 1000 + i, 'name': 'Segment %s' % i, 'elapsed_time': 300}
+                for i in range(efforts)
+            ],
+        }
+    )
+    return activity
+
+
+def _event():
+    return SubscriptionEvent.to_entity(
+        {
+            'aspect_type': 'update',
+            'event_time': 1549151212,
+            'object_id': 2120517766,
+            'object_type': 'activity',
+            'owner_id': 35056021,
+            'subscription_id': 133263,
+            'updates': {'title': 'Updated Title'},
+        },
+        parent=ds_util.client.key('Service', 'strava'),
+    )
+
+
+def _cases():
+    track = _track(points=1000)
+    activity = _activity(efforts=50)
+    event = _event()
+    return [
+        ('track', _params(track=track), _params(track_key=track.key)),
+        ('activity', _params(activity=activity), _params(activity=activity)),
+        ('event', _params(event=event), _params(event=event)),
+    ]
+
+
+def _time(fn, iterations):
+    return timeit.timeit(fn, number=iterations) / iterations * 1000000
+
+
+def main(iterations):
+    print(
+        '%-9s %-7s %9s %12s %12s'
+        % ('payload', 'codec', 'bytes', 'encode (us)', 'decode (us)')
+    )
+    for name, legacy_params, params in _cases():
+        legacy = task_codec.serialize_entity(legacy_params)
+        encoded = task_codec.encode(params, version=task_codec.VERSION_PROTO_ZLIB)
+        rows = [
+            (
+                'legacy',
+                legacy,
+                lambda: task_codec.serialize_entity(legacy_params),
+                lambda: task_codec.deserialize_entity(legacy),
+            ),
+            (
+                'codec',
+                encoded,
+                lambda: task_codec.encode(
+                    params, version=task_codec.VERSION_PROTO_ZLIB
+                ),
+                lambda: task_codec.decode(encoded),
+            ),
+        ]
+        for codec, payload, encode_fn, decode_fn in rows:
+            print(
+                '%-9s %-7s %9d %12.1f %12.1f'
+                % (
+                    name,
+                    codec,
+                    len(payload),
+                    _time(encode_fn, iterations),
+                    _time(decode_fn, iterations),
+                )
+            )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+
+    main(args.iterations)
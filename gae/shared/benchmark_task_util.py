@@ -0,0 +1,91 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares serial and batched task creation against a fake CloudTasksClient.
+
+Usage, from gae/:
+    python -m shared.benchmark_task_util --tasks 500 --latency_ms 20
+"""
+
+import argparse
+import threading
+import time
+
+import mock
+
+from shared import ds_util
+from shared import task_util
+from shared.config import config
+
+
+class FakeCloudTasksClient(object):
+    """Stands in for CloudTasksClient, sleeping to simulate each RPC."""
+
+    def __init__(self, latency_s):
+        self.latency_s = latency_s
+        self.created = 0
+        self._lock = threading.Lock()
+
+    def create_task(self, request):
+        time.sleep(self.latency_s)
+        with self._lock:
+            self.created += 1
+        return request['task']
+
+
+def _enqueue(user_key, count):
+    for i in range(count):
+        task_util.xsync_tasks_measure(user_key, {'weight': 60 + i / 100})
+
+
+def _run(label, fn, fake_client, count):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print(
+        '%-10s %5d tasks in %7.3fs: %8.1f tasks/s'
+        % (label, fake_client.created, elapsed, count / elapsed)
+    )
+
+
+def main(tasks, latency_ms, max_workers):
+    user_key = ds_util.client.key('User', 'benchmark')
+    fake_client = FakeCloudTasksClient(latency_ms / 1000)
+
+    with mock.patch.object(config, 'is_dev', False), mock.patch.object(
+        task_util, '_client', fake_client
+    ):
+
+        def serial():
+            _enqueue(user_key, tasks)
+
+        _run('serial', serial, fake_client, tasks)
+
+        fake_client.created = 0
+
+        def batched():
+            with task_util.TaskBatch(max_workers=max_workers):
+                _enqueue(user_key, tasks)
+
+        _run('batched', batched, fake_client, tasks)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tasks', type=int, default=500)
+    parser.add_argument('--latency_ms', type=float, default=20)
+    parser.add_argument('--max_workers', type=int, default=task_util._BATCH_MAX_WORKERS)
+    args = parser.parse_args()
+
+    main(args.tasks, args.latency_ms, args.max_workers)
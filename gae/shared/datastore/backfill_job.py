@@ -0,0 +1,85 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import logging
+
+from google.cloud.datastore.entity import Entity
+
+from shared import ds_util
+
+
+# A running job not checkpointed for this long has lost its task.
+_STALE_AFTER = datetime.timedelta(minutes=15)
+
+
+class BackfillJob(object):
+    """Progress of a backfill of measures from one service to another.
+
+    There's one per source and destination, under the source service; cursor
+    is the date of the last measure uploaded, or skipped, so far.
+    """
+
+    @classmethod
+    def key(cls, source_key, dest_key):
+        return ds_util.client.key('BackfillJob', dest_key.name, parent=source_key)
+
+    @classmethod
+    def get(cls, source_key, dest_key):
+        return ds_util.client.get(cls.key(source_key, dest_key))
+
+    @classmethod
+    def start(cls, source_key, dest_key, start, end):
+        """Stores a new job, replacing any that's done.
+
+        Returns the job to queue a task for, or None if one is still running,
+        which is left as-is so its cursor isn't lost. A job that failed, or
+        whose task was lost, is returned with its error cleared, to resume
+        from its cursor.
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        with ds_util.client.transaction():
+            job = cls.get(source_key, dest_key)
+            if job is None or job['done']:
+                job = cls.to_entity(source_key, dest_key, start, end)
+            elif job['error'] is not None or job['updated_at'] < now - _STALE_AFTER:
+                logging.info('BackfillJob: Resuming: %s', job.key)
+                job.update({'error': None, 'updated_at': now})
+            else:
+                return None
+            ds_util.client.put(job)
+        return job
+
+    @classmethod
+    def to_entity(cls, source_key, dest_key, start, end):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        job = Entity(cls.key(source_key, dest_key), exclude_from_indexes=['error'])
+        job.update(
+            {
+                'source_key': source_key,
+                'dest_key': dest_key,
+                'start': ds_util.utc(start),
+                'end': ds_util.utc(end),
+                'cursor': None,
+                'total': None,
+                'uploaded': 0,
+                'skipped': 0,
+                'slices': 0,
+                'done': False,
+                'error': None,
+                'started_at': now,
+                'updated_at': now,
+            }
+        )
+        return job
@@ -0,0 +1,148 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares the old Withings event merge with splice and Series.upsert.
+
+"legacy" is what EventsWorker used to do: filter every stored measure against
+a generator over the new ones, then heapq.merge the two lists. "splice" is
+the in-memory upsert alone, and "upsert" is Series.upsert end to end, with
+shard packing, against an in-memory Datastore.
+
+Each event batch replaces its first half with new values for measures
+already stored, at the end of the series, and appends the rest.
+
+Usage, from gae/:
+    python -m shared.datastore.benchmark_series --measures 10000
+"""
+
+import argparse
+import contextlib
+import copy
+import datetime
+import heapq
+import time
+
+from google.cloud.datastore.entity import Entity
+from google.cloud.datastore.key import Key
+
+from shared import ds_util
+from shared.config import config
+from shared.datastore.series import Series, splice
+
+
+class FakeDatastore(object):
+    """Just enough of a Datastore Client for Series."""
+
+    current_transaction = None
+
+    def __init__(self):
+        self.entities = {}
+
+    def key(self, *args, **kwargs):
+        return Key(*args, project=config.project_id, **kwargs)
+
+    def get(self, key):
+        return copy.deepcopy(self.entities.get(key))
+
+    def get_multi(self, keys):
+        return [self.get(key) for key in keys if key in self.entities]
+
+    def transaction(self):
+        return contextlib.nullcontext()
+
+    def put_multi(self, entities):
+        for entity in entities:
+            self.entities[entity.key] = entity
+
+    def delete_multi(self, keys):
+        for key in keys:
+            self.entities.pop(key, None)
+
+
+def _measures(start, count, weight):
+    measures = []
+    for i in range(count):
+        measure = Entity()
+        measure.update(
+            {
+                'date': start + datetime.timedelta(hours=8 * i),
+                'weight': weight + (i % 50) / 10,
+                'fat_ratio': 20 + (i % 30) / 10,
+            }
+        )
+        measures.append(measure)
+    return measures
+
+
+def _legacy(stored, new_measures):
+    stored = [
+        m
+        for m in filter(
+            lambda x: x['date'] not in (nm['date'] for nm in new_measures),
+            stored,
+        )
+    ]
+    return [m for m in heapq.merge(stored, new_measures, key=lambda x: x['date'])]
+
+
+def _splice(stored, new_measures):
+    splice(list(stored), new_measures)
+
+
+def _time(run, repeat, setup=None):
+    elapsed = 0
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        run()
+        elapsed += time.perf_counter() - start
+    return elapsed / repeat * 1000
+
+
+def main(measures, batches, repeat):
+    ds_util.client = FakeDatastore()
+    service_key = ds_util.client.key('Service', 'withings')
+
+    begin = datetime.datetime(2015, 1, 1, tzinfo=datetime.timezone.utc)
+    stored = _measures(begin, measures, 70)
+    last = stored[-1]['date']
+
+    print('%6s %12s %12s %12s' % ('batch', 'legacy (ms)', 'splice (ms)', 'upsert (ms)'))
+    for batch in batches:
+        replaced = batch // 2
+        new_measures = _measures(
+            last - datetime.timedelta(hours=8 * (replaced - 1)), batch, 80
+        )
+        series = Entity(Series.key(service_key))
+        series['measures'] = stored
+
+        legacy = _time(lambda: _legacy(stored, new_measures), repeat)
+        spliced = _time(lambda: _splice(stored, new_measures), repeat)
+        upserted = _time(
+            lambda: Series.upsert(service_key, new_measures),
+            repeat,
+            setup=lambda: Series.put(series),
+        )
+        print('%6d %12.2f %12.2f %12.2f' % (batch, legacy, spliced, upserted))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--measures', type=int, default=10000)
+    parser.add_argument('--batches', type=int, nargs='+', default=[1, 10, 100, 1000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    main(args.measures, args.batches, args.repeat)
@@ -0,0 +1,129 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares storing a LiveTrack's Garmin JSON with packing its trackpoints.
+
+"legacy" is _TrackConverter's deepcopy of the track, trackpoints and all,
+into one entity. "compact" is what the LiveTrack poller stores: the track
+without its trackpoints, plus a polyline, and a TrackPoints chunk packed by
+track_util. Sizes are of the entities' protobufs; "read" is decoding those
+protobufs, as a get would, and getting the trackpoints back out.
+
+Usage, from gae/:
+    python -m shared.datastore.benchmark_track --points 100 1000 10000
+"""
+
+import argparse
+import datetime
+import timeit
+
+from google.cloud.datastore import helpers
+
+from shared import track_util
+from shared.datastore.track import Track, TrackPoints
+
+
+def _track(points):
+    start = datetime.datetime(2021, 5, 1, 16, 0, tzinfo=datetime.timezone.utc)
+    return {
+        'url': 'https://livetrack.garmin.com/session/s/token/t',
+        'url_info': {'session': 's', 'token': 't'},
+        'status': 4,
+        'info': {
+            'session': {
+                'sessionName': "Joe LaPenna's Ride",
+                'start': start.isoformat(),
+                'end': (start + datetime.timedelta(hours=2)).isoformat(),
+            }
+        },
+        'trackpoints': {
+            'trackPoints': [
+                {
+                    'dateTime': (start + datetime.timedelta(seconds=i)).isoformat(),
+                    'position': {
+                        'lat': 37.7 + i / 10000,
+                        'lon': -122.4 + (i % 200) / 20000,
+                    },
+                    'altitude': 50.0 + i % 30,
+                    'speed': 6.2 + (i % 7) / 10,
+                    'fitnessPointData': {'heartRateBeatsPerMin': 130 + i % 40},
+                }
+                for i in range(points)
+            ]
+        },
+    }
+
+
+def _legacy(track):
+    return [Track.to_entity(track)]
+
+
+def _compact(track):
+    trackpoints = track['trackpoints']['trackPoints']
+    entity = Track.to_entity(
+        dict(
+            {k: v for k, v in track.items() if k != 'trackpoints'},
+            polyline=track_util.encode_polyline(track_util.positions(trackpoints)),
+        )
+    )
+    return [entity, TrackPoints.to_entity(entity.key, 1, trackpoints)]
+
+
+def _read_legacy(pbs):
+    return helpers.entity_from_protobuf(pbs[0])['trackpoints']['trackPoints']
+
+
+def _read_compact(pbs):
+    helpers.entity_from_protobuf(pbs[0])
+    return track_util.unpack(helpers.entity_from_protobuf(pbs[1]))
+
+
+def _size(pbs):
+    return sum(pb._pb.ByteSize() for pb in pbs)
+
+
+def _time(fn, iterations):
+    return timeit.timeit(fn, number=iterations) / iterations * 1000
+
+
+def main(points, iterations):
+    print(
+        '%7s %-8s %10s %14s %10s'
+        % ('points', 'format', 'bytes', 'convert (ms)', 'read (ms)')
+    )
+    for count in points:
+        track = _track(count)
+        for name, convert, read in (
+            ('legacy', _legacy, _read_legacy),
+            ('compact', _compact, _read_compact),
+        ):
+            pbs = [helpers.entity_to_protobuf(e) for e in convert(track)]
+            print(
+                '%7d %-8s %10d %14.2f %10.2f'
+                % (
+                    count,
+                    name,
+                    _size(pbs),
+                    _time(lambda: convert(track), iterations),
+                    _time(lambda: read(pbs), iterations),
+                )
+            )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--points', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--iterations', type=int, default=10)
+    args = parser.parse_args()
+    main(args.points, args.iterations)
@@ -23,13 +23,19 @@ from shared import ds_util
 
 class _MeasureConverter(object):
     @classmethod
-    def to_entity(cls, item):
+    def to_entity(cls, item, parent=None):
+        """Keyed by its timestamp, in seconds, like a Withings measure."""
+        date = datetime.datetime.fromtimestamp(
+            item['timestampGMT'] / 1000, tz=datetime.timezone.utc
+        )
         attributes = {
-            'date': datetime.datetime.utcfromtimestamp(item['timestampGMT'] / 1000),
+            'date': date,
             'fat_ratio': item['bodyFat'],
             'weight': round(item['weight'] / 1000, 4),
         }
-        entity = Entity(ds_util.client.key('Measure'))
+        entity = Entity(
+            ds_util.client.key('Measure', item['timestampGMT'] // 1000, parent=parent)
+        )
         entity.update(attributes)
         return entity
 
@@ -41,6 +47,16 @@ class _TrackConverter(object):
             'url_info',
             'info',
             'status',
+            'polyline',
+            'polyline_end',
+            'points_count',
+            'points_chunks',
+            'last_point_millis',
+            'last_point_at',
+            'poll_interval',
+            'polls',
+            'polled_at',
+            'poll_started_at',
         ]
     )
     __INCLUDE_IN_INDEXES = SortedSet(
@@ -25,15 +25,20 @@ class GarminConvertersTest(unittest.TestCase):
     def test_measures(self):
         measure_item = BODY_COMP['dateWeightList'][0]
         entity = GarminConverters.Measure.to_entity(measure_item)
-        expected_entity = Entity(ds_util.client.key('Measure'))
+        expected_entity = Entity(
+            ds_util.client.key('Measure', measure_item['timestampGMT'] // 1000)
+        )
         expected_entity.update(
             {
-                'date': datetime.datetime(2020, 3, 22, 1, 49),
+                'date': datetime.datetime(
+                    2020, 3, 22, 1, 49, tzinfo=datetime.timezone.utc
+                ),
                 'fat_ratio': None,
                 'weight': 59.4206,
             }
         )
         self.assertEqual(entity.items(), expected_entity.items())
+        self.assertEqual(entity.key, expected_entity.key)
 
 
 STATS = {
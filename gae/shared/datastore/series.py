@@ -12,6 +12,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import array
+import bisect
+import collections
+import itertools
+import logging
+import math
+import numbers
+import sys
+import zlib
+
 from google.cloud.datastore.entity import Entity
 
 from shared import ds_util
@@ -20,23 +30,444 @@ from shared.datastore.garmin.converters import GarminConverters
 from shared.datastore.withings.converters import WithingsConverters
 
 
+# Series entities with this format are an index over SeriesShard entities,
+# rather than holding every measure themselves.
+SHARDED_FORMAT = 2
+
+# Stands for a missing value in a shard's int64 columns.
+_MISSING_INT = -(2**63)
+
+# What Series.upsert changed: the first and last changed dates, and the
+# changed measures, in date order.
+Splice = collections.namedtuple('Splice', ['start', 'end', 'changed'])
+
+_INDEX_EXCLUDE_FROM_INDEXES = (
+    'count',
+    'end',
+    'fields',
+    'shard_summaries',
+    'shards',
+    'start',
+)
+
+
 class Series(object):
-    """Its a series!"""
+    """Its a series!
+
+    A Series is stored as an index entity, keyed ('Series', service name)
+    under its service, and one SeriesShard per year of measures. Each shard
+    packs its measures column by column, so reading a range only loads the
+    years it touches.
+
+    Series stored in the legacy format, a single entity with a list of
+    measures, are still read as-is, and are rewritten as shards on their next
+    put or upsert, or by migrate.
+
+    The index and its shards are written in a transaction, so concurrent
+    writers can't leave the index summarizing shards it doesn't match.
+    """
+
+    @classmethod
+    def key(cls, parent):
+        return ds_util.client.key('Series', parent.name, parent=parent)
 
     @classmethod
-    def get(cls, parent):
-        return ds_util.client.get(
-            ds_util.client.key('Series', parent.name, parent=parent)
+    def get(cls, parent, start=None, end=None, limit=None):
+        """Returns the series with its measures between start and end.
+
+        Both bounds are inclusive and optional; only the shards between them
+        are loaded. With a limit, only the most recent limit measures are
+        returned, and only the shards needed for them are loaded.
+        """
+        index = ds_util.client.get(cls.key(parent))
+        if index is None:
+            return None
+        if not cls.is_sharded(index):
+            # Legacy series were stored in whatever order the API returned.
+            measures = _in_range(_sorted(index.get('measures', [])), start, end)
+            index['measures'] = measures[-limit:] if limit else measures
+            return index
+
+        summaries = [
+            summary
+            for summary in index['shard_summaries']
+            if (start is None or summary['end'] >= ds_util.utc(start))
+            and (end is None or summary['start'] <= ds_util.utc(end))
+        ]
+        if limit:
+            # A shard cut short by end may hold fewer than its count.
+            newest = list(reversed(summaries))
+            counts = itertools.accumulate(
+                s['count'] if end is None or s['end'] <= ds_util.utc(end) else 0
+                for s in newest
+            )
+            needed = next((i + 1 for i, c in enumerate(counts) if c >= limit), None)
+            summaries = newest[:needed][::-1]
+
+        series = Entity(index.key)
+        series.update(index)
+        series['measures'] = list(
+            itertools.chain.from_iterable(
+                SeriesShard.to_measures(shard, start, end)
+                for shard in SeriesShard.get_multi(
+                    index.key, [s['year'] for s in summaries]
+                )
+            )
         )
+        if limit:
+            series['measures'] = series['measures'][-limit:]
+        return series
+
+    @classmethod
+    def bounds(cls, parent):
+        """Returns the first and last measures' dates, or None if it has none.
+
+        A sharded series answers from its index, without reading any shards.
+        """
+        index = ds_util.client.get(cls.key(parent))
+        if index is None:
+            return None
+        if cls.is_sharded(index):
+            return (index['start'], index['end']) if index['count'] else None
+        dates = [ds_util.utc(m['date']) for m in index.get('measures', [])]
+        return (min(dates), max(dates)) if dates else None
+
+    @classmethod
+    def is_sharded(cls, series):
+        return series.get('format') == SHARDED_FORMAT
 
     @classmethod
     def to_entity(cls, measures, parent):
-        series = Entity(ds_util.client.key('Series', parent.name, parent=parent))
+        series = Entity(cls.key(parent))
         series['measures'] = [
             Measure.to_entity(measure, parent) for measure in measures
         ]
         return series
 
+    @classmethod
+    def put(cls, series):
+        """Stores all of series' measures, replacing any stored before."""
+        return ds_util.transact(cls._put, series)
+
+    @classmethod
+    def _put(cls, series):
+        previous = ds_util.client.get(series.key)
+        shards = [
+            SeriesShard.to_entity(series.key, year, list(measures))
+            for year, measures in itertools.groupby(
+                _sorted(series['measures']), key=lambda m: ds_util.utc(m['date']).year
+            )
+        ]
+        index = _index(series.key, shards)
+        ds_util.client.put_multi([index] + shards)
+
+        if previous is not None and cls.is_sharded(previous):
+            stale = set(previous['shards']) - set(index['shards'])
+            if stale:
+                ds_util.client.delete_multi(
+                    SeriesShard.key(series.key, year) for year in stale
+                )
+        return index
+
+    @classmethod
+    def upsert(cls, parent, measures):
+        """Adds measures to the series, replacing those with the same date.
+
+        Only the shards for the measures' years are read, and only those that
+        change are rewritten. Returns the Splice of what changed, or None.
+        """
+        measures = _sorted(measures)
+        if not measures:
+            return None
+        return ds_util.transact(cls._upsert, parent, measures)
+
+    @classmethod
+    def _upsert(cls, parent, measures):
+        index = ds_util.client.get(cls.key(parent))
+        if index is None or not cls.is_sharded(index):
+            series = Entity(cls.key(parent))
+            # Legacy series were stored in whatever order the API returned.
+            series['measures'] = _sorted(index.get('measures', []) if index else [])
+            change = splice(series['measures'], measures)
+            if change is not None:
+                cls._put(series)
+            return change
+
+        years = sorted(set(ds_util.utc(m['date']).year for m in measures))
+        existing = {
+            shard.key.id: shard
+            for shard in SeriesShard.get_multi(
+                index.key, [year for year in years if year in index['shards']]
+            )
+        }
+        shards = []
+        changes = []
+        for year, new_measures in itertools.groupby(
+            measures, key=lambda m: ds_util.utc(m['date']).year
+        ):
+            shard = existing.get(year)
+            stored = SeriesShard.to_measures(shard) if shard is not None else []
+            change = splice(stored, list(new_measures))
+            if change is not None:
+                shards.append(SeriesShard.to_entity(index.key, year, stored))
+                changes.append(change)
+        if not changes:
+            return None
+
+        rewritten = [shard.key.id for shard in shards]
+        unchanged = [s for s in index['shard_summaries'] if s['year'] not in rewritten]
+        ds_util.client.put_multi([_index(index.key, shards, unchanged)] + shards)
+        return Splice(
+            changes[0].start,
+            changes[-1].end,
+            [m for change in changes for m in change.changed],
+        )
+
+    @classmethod
+    def migrate(cls, parent):
+        """Rewrites a legacy series as shards. Returns whether it did."""
+        return ds_util.transact(cls._migrate, parent)
+
+    @classmethod
+    def _migrate(cls, parent):
+        series = ds_util.client.get(cls.key(parent))
+        if series is None or cls.is_sharded(series):
+            return False
+        logging.info(
+            'Series: Migrating %s measures: %s',
+            len(series.get('measures', [])),
+            series.key,
+        )
+        cls._put(series)
+        return True
+
+
+class SeriesShard(object):
+    """A year of a series' measures, packed into a compressed blob per field.
+
+    Dates are microseconds since the epoch, delta encoded as int64s. A field
+    whose values are all ints, like a Fitbit log's id, is an int64, and any
+    other is a float64; a measure lacking it, or with it None, has NaN or
+    _MISSING_INT. Fields with any other type of value can't be packed.
+    """
+
+    @classmethod
+    def key(cls, series_key, year):
+        return ds_util.client.key('SeriesShard', year, parent=series_key)
+
+    @classmethod
+    def get_multi(cls, series_key, years):
+        if not years:
+            return []
+        shards = ds_util.client.get_multi([cls.key(series_key, y) for y in years])
+        return sorted(shards, key=lambda shard: shard.key.id)
+
+    @classmethod
+    def to_entity(cls, series_key, year, measures):
+        """Packs measures, which must be sorted by date, into a shard.
+
+        Raises a ValueError for a value that isn't a number or None.
+        """
+        is_int = {}
+        for measure in measures:
+            for name, value in measure.items():
+                if name == 'date' or value is None:
+                    continue
+                if not _is_number(value):
+                    raise ValueError(
+                        'Cannot pack %s=%r into a SeriesShard' % (name, value)
+                    )
+                is_int[name] = is_int.get(name, True) and _is_int64(value)
+        fields = sorted(is_int)
+        int_fields = [name for name in fields if is_int[name]]
+
+        shard = Entity(
+            cls.key(series_key, year),
+            exclude_from_indexes=['date']
+            + fields
+            + ['fields', 'int_fields', 'start', 'end'],
+        )
+        micros = [ds_util.to_micros(m['date']) for m in measures]
+        shard['date'] = _pack('q', [b - a for a, b in zip([0] + micros, micros)])
+        for name in fields:
+            values = [measure.get(name) for measure in measures]
+            if is_int[name]:
+                shard[name] = _pack(
+                    'q', [_MISSING_INT if v is None else v for v in values]
+                )
+            else:
+                shard[name] = _pack(
+                    'd', [math.nan if v is None else float(v) for v in values]
+                )
+        shard.update(
+            {
+                'fields': fields,
+                'int_fields': int_fields,
+                'count': len(measures),
+                'start': ds_util.utc(measures[0]['date']) if measures else None,
+                'end': ds_util.utc(measures[-1]['date']) if measures else None,
+            }
+        )
+        return shard
+
+    @classmethod
+    def to_measures(cls, shard, start=None, end=None):
+        """Unpacks the shard's measures between start and end, inclusive."""
+        dates = list(itertools.accumulate(_unpack('q', shard['date'])))
+        lo = bisect.bisect_left(dates, ds_util.to_micros(start)) if start else 0
+        hi = bisect.bisect_right(dates, ds_util.to_micros(end)) if end else len(dates)
+        columns = [
+            (name, _unpack('q' if name in shard['int_fields'] else 'd', shard[name]))
+            for name in shard['fields']
+        ]
+        measures = []
+        for i in range(lo, hi):
+            micros = dates[i]
+            measure = Entity()
+            measure['date'] = ds_util.from_micros(micros)
+            for name, values in columns:
+                if not _is_missing(values[i]):
+                    measure[name] = values[i]
+            measures.append(measure)
+        return measures
+
+
+def _index(series_key, shards, summaries=()):
+    summaries = sorted(
+        list(summaries)
+        + [
+            {
+                'year': shard.key.id,
+                'count': shard['count'],
+                'start': shard['start'],
+                'end': shard['end'],
+                'fields': shard['fields'],
+            }
+            for shard in shards
+        ],
+        key=lambda s: s['year'],
+    )
+    index = Entity(
+        series_key,
+        exclude_from_indexes=_INDEX_EXCLUDE_FROM_INDEXES,
+    )
+    index.update(
+        {
+            'format': SHARDED_FORMAT,
+            'shards': [s['year'] for s in summaries],
+            'shard_summaries': summaries,
+            'count': sum(s['count'] for s in summaries),
+            'start': summaries[0]['start'] if summaries else None,
+            'end': summaries[-1]['end'] if summaries else None,
+            'fields': sorted(set(f for s in summaries for f in s['fields'])),
+        }
+    )
+    return index
+
+
+def splice(stored, measures):
+    """Upserts measures into stored, in place. Both must be sorted by date.
+
+    Only the window of stored between the first and last of measures'
+    dates is visited, found by binary search, so a batch of m measures
+    costs O(log n + m + w) comparisons for a window of w stored measures.
+    A stored measure with the same date as one in measures is replaced.
+
+    Returns a Splice with the dates spanned by the changed measures and the
+    changed measures themselves, or None if every measure was already
+    stored with the same values.
+    """
+    if not measures:
+        return None
+    lo = _bisect(stored, ds_util.utc(measures[0]['date']))
+    hi = _bisect(stored, ds_util.utc(measures[-1]['date']), right=True)
+
+    window = []
+    changed = []
+    i = lo
+    for j, measure in enumerate(measures):
+        date = ds_util.utc(measure['date'])
+        if j + 1 < len(measures) and ds_util.utc(measures[j + 1]['date']) == date:
+            # The last of measures with the same date wins.
+            continue
+        while i < hi and ds_util.utc(stored[i]['date']) < date:
+            window.append(stored[i])
+            i += 1
+        if i < hi and ds_util.utc(stored[i]['date']) == date:
+            if _values(stored[i]) != _values(measure):
+                changed.append(measure)
+            i += 1
+        else:
+            changed.append(measure)
+        window.append(measure)
+    window.extend(stored[i:hi])
+
+    if not changed:
+        return None
+    stored[lo:hi] = window
+    return Splice(
+        ds_util.utc(changed[0]['date']), ds_util.utc(changed[-1]['date']), changed
+    )
+
+
+def _bisect(measures, date, right=False):
+    lo, hi = 0, len(measures)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        mid_date = ds_util.utc(measures[mid]['date'])
+        if mid_date < date or (right and mid_date == date):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def _values(measure):
+    """The values a shard would store for measure."""
+    return {
+        name: value
+        for name, value in measure.items()
+        if name != 'date' and value is not None
+    }
+
+
+def _in_range(measures, start, end):
+    """Slices measures, sorted by date, to those between start and end."""
+    lo = _bisect(measures, ds_util.utc(start)) if start is not None else 0
+    hi = _bisect(measures, ds_util.utc(end), right=True) if end is not None else None
+    return measures[lo:hi]
+
+
+def _sorted(measures):
+    return sorted(measures, key=lambda m: ds_util.utc(m['date']))
+
+
+def _is_number(value):
+    return isinstance(value, numbers.Real) and not isinstance(value, bool)
+
+
+def _is_int64(value):
+    return isinstance(value, numbers.Integral) and _MISSING_INT < value < 2**63
+
+
+def _is_missing(value):
+    return value == _MISSING_INT if isinstance(value, int) else math.isnan(value)
+
+
+def _pack(typecode, values):
+    packed = array.array(typecode, values)
+    if sys.byteorder != 'little':
+        packed.byteswap()
+    return zlib.compress(packed.tobytes())
+
+
+def _unpack(typecode, blob):
+    packed = array.array(typecode)
+    packed.frombytes(zlib.decompress(blob))
+    if sys.byteorder != 'little':
+        packed.byteswap()
+    return packed
+
 
 class Measure(object):
     """Its a measure!"""
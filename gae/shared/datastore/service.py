@@ -92,6 +92,8 @@ class Service(object):
     @classmethod
     def set_sync_enqueued(cls, service):
         now = datetime.datetime.now(datetime.timezone.utc)
+        # Keep the cursor, where workers track what they've already synced.
+        cursor = service['sync_state'].get('cursor')
         service['sync_state'] = {
             'updated_at': now,
             'syncing': True,
@@ -100,6 +102,8 @@ class Service(object):
             'successful': None,
             'error': None,
         }
+        if cursor is not None:
+            service['sync_state']['cursor'] = cursor
         ds_util.client.put(service)
 
     @classmethod
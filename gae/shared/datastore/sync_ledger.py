@@ -0,0 +1,199 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import datetime
+import hashlib
+import logging
+import threading
+
+from google.cloud.datastore.entity import Entity
+
+from shared import ds_util
+from shared import pending_util
+from shared import task_util
+
+
+# Measures for a latest-only destination that arrive within this long of the
+# first are collapsed into a single write.
+COALESCE_WINDOW = datetime.timedelta(seconds=60)
+
+# How long after a failed pending write it's tried again, and how many times.
+RETRY_DELAY = datetime.timedelta(minutes=5)
+_MAX_RETRIES = 5
+
+# A pending write this old has lost its task.
+_STALE_AFTER = datetime.timedelta(minutes=10)
+
+# Process-wide counts of writes recorded and skipped, and of pending writes
+# enqueued, coalesced, processed, requeued, retried and abandoned.
+stats = collections.Counter()
+_stats_lock = threading.Lock()
+
+
+class SyncLedger(object):
+    """Weights written to other services, so rewriting them can be skipped.
+
+    Garmin keeps every weight, so it has an entry per measure date. TrainerRoad
+    only keeps the current weight, so it has a single entry, for the latest
+    weight written; a burst of measures for it is deferred into one pending
+    write, of the latest, by defer, peek, done and retry.
+    """
+
+    # Destinations that only keep the latest weight.
+    LATEST_ONLY = ('trainerroad',)
+
+    @classmethod
+    def key(cls, user_key, dest, date=None):
+        if dest in cls.LATEST_ONLY:
+            name = dest
+        else:
+            name = '%s:%s' % (dest, ds_util.to_micros(date))
+        return ds_util.client.key('SyncLedger', name, parent=user_key)
+
+    @classmethod
+    def pending_key(cls, user_key, dest):
+        return ds_util.client.key('PendingSync', dest, parent=user_key)
+
+    @classmethod
+    def value_hash(cls, measure):
+        return hashlib.sha1(('%.3f' % (measure['weight'],)).encode()).hexdigest()
+
+    @classmethod
+    def is_synced(cls, user_key, dest, measure):
+        """Whether writing measure to dest would be a no-op."""
+        entry = ds_util.client.get(cls.key(user_key, dest, measure['date']))
+        if not _is_synced(entry, dest, measure):
+            return False
+        _count('skipped')
+        return True
+
+    @classmethod
+    def synced_dates(cls, user_key, dest, measures):
+        """The dates of those of measures already written to dest."""
+        hashes = {}
+        for offset in range(0, len(measures), ds_util.MAX_LOOKUP_KEYS):
+            keys = [
+                cls.key(user_key, dest, m['date'])
+                for m in measures[offset : offset + ds_util.MAX_LOOKUP_KEYS]
+            ]
+            hashes.update(
+                (e.key.name, e['value_hash']) for e in ds_util.client.get_multi(keys)
+            )
+        return set(
+            m['date']
+            for m in measures
+            if hashes.get(cls.key(user_key, dest, m['date']).name) == cls.value_hash(m)
+        )
+
+    @classmethod
+    def record(cls, user_key, dest, measure):
+        entry = Entity(cls.key(user_key, dest, measure['date']))
+        entry.update(
+            {
+                'date': ds_util.utc(measure['date']),
+                'weight': measure['weight'],
+                'value_hash': cls.value_hash(measure),
+                'synced_at': datetime.datetime.now(datetime.timezone.utc),
+            }
+        )
+        ds_util.client.put(entry)
+        _count('recorded')
+        return entry
+
+    @classmethod
+    def defer(cls, user_key, dest, measure):
+        """Holds measure as dest's pending write, unless a later one is.
+
+        Returns True if this starts a new burst, whose task is queued to write
+        the pending measure after COALESCE_WINDOW.
+        """
+        date = ds_util.utc(measure['date'])
+
+        def update(pending, queue):
+            if queue:
+                # A stale burst is restarted.
+                pending = Entity(cls.pending_key(user_key, dest))
+                pending['coalesced'] = 0
+            if queue or date >= pending['date']:
+                pending.update({'date': date, 'weight': measure['weight']})
+            pending['coalesced'] += 1
+            return pending
+
+        _, started = _pending.add(
+            cls.pending_key(user_key, dest), update, COALESCE_WINDOW
+        )
+        return started
+
+    @classmethod
+    def peek(cls, user_key, dest):
+        """Returns dest's pending write, or None if done.
+
+        It stays pending until passed to done, so a failed write can be retried.
+        """
+        key = cls.pending_key(user_key, dest)
+        pending = ds_util.client.get(key)
+        if pending is not None:
+            logging.info(
+                'SyncLedger: Writing the latest of %s measures: %s',
+                pending['coalesced'],
+                key,
+            )
+        return pending
+
+    @classmethod
+    def done(cls, user_key, dest, pending):
+        """Deletes pending, once written, unless more were deferred since.
+
+        Returns True if some were, which are left pending, and queued again
+        after COALESCE_WINDOW.
+        """
+        return _pending.done(pending, COALESCE_WINDOW)
+
+    @classmethod
+    def retry(cls, user_key, dest, pending):
+        """Queues pending again, after RETRY_DELAY, once writing it has failed.
+
+        After _MAX_RETRIES, it's left pending instead, until the next defer
+        finds it stale and starts a new burst. Returns whether it was queued.
+        """
+        return _pending.retry(pending)
+
+
+def _is_synced(entry, dest, measure):
+    if entry is None:
+        return False
+    if entry['value_hash'] == SyncLedger.value_hash(measure):
+        return True
+    # A later weight has been written, which this must not replace.
+    return dest in SyncLedger.LATEST_ONLY and entry['date'] > ds_util.utc(
+        measure['date']
+    )
+
+
+def _count(stat):
+    with _stats_lock:
+        stats[stat] += 1
+
+
+def _enqueue(pending, delay):
+    # PendingSync entities are named by their destination.
+    if pending.key.name != 'trainerroad':
+        raise ValueError('No task writes pending weights to %s' % (pending.key.name,))
+    task_util.xsync_tasks_trainerroad(pending.key.parent, delay)
+
+
+_pending = pending_util.PendingTasks(
+    'SyncLedger', _enqueue, _STALE_AFTER, RETRY_DELAY, _MAX_RETRIES, _count
+)
@@ -0,0 +1,78 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import unittest
+
+from shared import ds_util
+from shared import testing_util
+from shared.datastore.backfill_job import BackfillJob
+
+
+class BackfillJobTest(unittest.TestCase):
+    def setUp(self):
+        user_key = ds_util.client.key('User', 'someuser')
+        self.source_key = ds_util.client.key('Service', 'withings', parent=user_key)
+        self.dest_key = ds_util.client.key('Service', 'garmin', parent=user_key)
+        self.stored = testing_util.fake_datastore(self).stored
+
+    def test_start_leaves_running_job(self):
+        job = BackfillJob.start(self.source_key, self.dest_key, _date(1), _date(10))
+        job['cursor'] = _date(5)
+        self.stored[job.key] = job
+
+        self.assertIsNone(
+            BackfillJob.start(self.source_key, self.dest_key, _date(2), _date(10))
+        )
+        stored = self.stored[job.key]
+        self.assertEqual(_date(1), stored['start'])
+        self.assertEqual(_date(5), stored['cursor'])
+
+    def test_start_replaces_done_job(self):
+        job = BackfillJob.start(self.source_key, self.dest_key, _date(1), _date(10))
+        job.update({'cursor': _date(10), 'done': True})
+        self.stored[job.key] = job
+
+        job = BackfillJob.start(self.source_key, self.dest_key, _date(2), _date(10))
+
+        self.assertEqual(job, self.stored[job.key])
+        self.assertEqual(_date(2), job['start'])
+        self.assertIsNone(job['cursor'])
+
+    def test_start_resumes_failed_job(self):
+        job = BackfillJob.start(self.source_key, self.dest_key, _date(1), _date(10))
+        job.update({'cursor': _date(5), 'error': 'Boom'})
+        self.stored[job.key] = job
+
+        job = BackfillJob.start(self.source_key, self.dest_key, _date(2), _date(10))
+
+        self.assertEqual(job, self.stored[job.key])
+        self.assertEqual(_date(1), job['start'])
+        self.assertEqual(_date(5), job['cursor'])
+        self.assertIsNone(job['error'])
+
+    def test_start_resumes_stale_job(self):
+        job = BackfillJob.start(self.source_key, self.dest_key, _date(1), _date(10))
+        job.update({'cursor': _date(5), 'updated_at': _date(1)})
+        self.stored[job.key] = job
+
+        job = BackfillJob.start(self.source_key, self.dest_key, _date(2), _date(10))
+
+        self.assertEqual(job, self.stored[job.key])
+        self.assertEqual(_date(5), job['cursor'])
+        self.assertGreater(job['updated_at'], _date(1))
+
+
+def _date(day):
+    return datetime.datetime(2020, 9, day, tzinfo=datetime.timezone.utc)
@@ -0,0 +1,304 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import unittest
+
+from google.cloud.datastore.entity import Entity
+
+from shared import ds_util
+from shared import testing_util
+from shared.datastore.series import Series, SeriesShard, splice
+
+
+class SeriesTest(unittest.TestCase):
+    def setUp(self):
+        self.service_key = ds_util.client.key('Service', 'withings')
+        self.datastore = testing_util.fake_datastore(self)
+        self.stored = self.datastore.stored
+        self.put_multi_mock = self.datastore.mocks['put_multi']
+
+    def test_round_trip(self):
+        measures = [
+            _measure(2019, 12, 31, weight=75.3, fat_ratio=20.1),
+            _measure(2020, 1, 1, weight=75.1),
+            _measure(2020, 6, 1, weight=74.2, fat_ratio=19.5, heart_pulse=60),
+        ]
+        Series.put(_series(self.service_key, measures))
+
+        self.assertEqual(
+            {
+                Series.key(self.service_key),
+                SeriesShard.key(Series.key(self.service_key), 2019),
+                SeriesShard.key(Series.key(self.service_key), 2020),
+            },
+            set(self.stored),
+        )
+        series = Series.get(self.service_key)
+        self.assertEqual(3, series['count'])
+        self.assertEqual([2019, 2020], series['shards'])
+        self.assertEqual(measures, [dict(m) for m in series['measures']])
+
+    def test_round_trip_keeps_types(self):
+        measures = [
+            _measure(2020, 1, 1, id=1234567890123, weight=75, fat_ratio=20.5),
+            _measure(2020, 1, 2, weight=74.5, fat_ratio=None),
+            _measure(2020, 1, 3, id=-1, weight=74.0),
+        ]
+        Series.put(_series(self.service_key, measures))
+
+        got = Series.get(self.service_key)['measures']
+        self.assertEqual(
+            [
+                {
+                    'date': measures[0]['date'],
+                    'id': 1234567890123,
+                    'weight': 75.0,
+                    'fat_ratio': 20.5,
+                },
+                {'date': measures[1]['date'], 'weight': 74.5},
+                {'date': measures[2]['date'], 'id': -1, 'weight': 74.0},
+            ],
+            [dict(m) for m in got],
+        )
+        self.assertIsInstance(got[0]['id'], int)
+        self.assertIsInstance(got[0]['weight'], float)
+
+    def test_put_rejects_non_numbers(self):
+        for value in ('75.3', True, datetime.datetime(2020, 1, 1)):
+            self.assertRaises(
+                ValueError,
+                Series.put,
+                _series(self.service_key, [_measure(2020, 1, 1, weight=value)]),
+            )
+        self.assertEqual({}, self.stored)
+
+    def test_writes_are_transactional(self):
+        in_transaction = []
+        self.put_multi_mock.side_effect = lambda entities: (
+            in_transaction.append(self.datastore.in_transaction)
+            or self.datastore.put_multi(entities)
+        )
+
+        Series.put(_series(self.service_key, [_measure(2019, 1, 1, weight=1.0)]))
+        Series.upsert(self.service_key, [_measure(2020, 1, 1, weight=2.0)])
+
+        self.assertEqual([1, 1], in_transaction)
+
+    def test_get_loads_only_shards_in_range(self):
+        Series.put(
+            _series(
+                self.service_key,
+                [
+                    _measure(year, 3, 1, weight=70.0 + i)
+                    for i, year in enumerate(range(2015, 2021))
+                ],
+            )
+        )
+
+        series = Series.get(
+            self.service_key,
+            start=datetime.datetime(2018, 1, 1, tzinfo=datetime.timezone.utc),
+            end=datetime.datetime(2019, 2, 1, tzinfo=datetime.timezone.utc),
+        )
+
+        self.assertEqual([73.0], [m['weight'] for m in series['measures']])
+        (keys,), _ = ds_util.client.get_multi.call_args
+        self.assertEqual([2018], [key.id for key in keys])
+
+    def test_get_limit_loads_only_recent_shards(self):
+        Series.put(
+            _series(
+                self.service_key,
+                [
+                    _measure(year, month, 1, weight=float(year))
+                    for year in range(2015, 2021)
+                    for month in (3, 9)
+                ],
+            )
+        )
+
+        series = Series.get(
+            self.service_key,
+            end=datetime.datetime(2020, 6, 1, tzinfo=datetime.timezone.utc),
+            limit=2,
+        )
+
+        self.assertEqual([2019.0, 2020.0], [m['weight'] for m in series['measures']])
+        (keys,), _ = ds_util.client.get_multi.call_args
+        self.assertEqual([2019, 2020], [key.id for key in keys])
+
+    def test_put_deletes_stale_shards(self):
+        Series.put(
+            _series(
+                self.service_key,
+                [_measure(2019, 1, 1, weight=1.0), _measure(2020, 1, 1, weight=2.0)],
+            )
+        )
+        Series.put(_series(self.service_key, [_measure(2020, 1, 1, weight=3.0)]))
+
+        self.assertNotIn(
+            SeriesShard.key(Series.key(self.service_key), 2019), self.stored
+        )
+        self.assertEqual(
+            [3.0], [m['weight'] for m in Series.get(self.service_key)['measures']]
+        )
+
+    def test_upsert_rewrites_only_touched_shards(self):
+        Series.put(
+            _series(
+                self.service_key,
+                [_measure(2019, 1, 1, weight=1.0), _measure(2020, 1, 1, weight=2.0)],
+            )
+        )
+        self.put_multi_mock.reset_mock()
+
+        Series.upsert(
+            self.service_key,
+            [_measure(2020, 1, 1, weight=2.5), _measure(2020, 2, 1, weight=3.0)],
+        )
+
+        (written,), _ = self.put_multi_mock.call_args
+        self.assertEqual(
+            [
+                Series.key(self.service_key),
+                SeriesShard.key(Series.key(self.service_key), 2020),
+            ],
+            [e.key for e in written],
+        )
+        series = Series.get(self.service_key)
+        self.assertEqual(3, series['count'])
+        self.assertEqual([1.0, 2.5, 3.0], [m['weight'] for m in series['measures']])
+
+    def test_legacy_series(self):
+        legacy = _series(
+            self.service_key,
+            [_measure(2019, 1, 1, weight=1.0), _measure(2020, 1, 1, weight=2.0)],
+        )
+        self.stored[legacy.key] = legacy
+
+        series = Series.get(
+            self.service_key,
+            start=datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc),
+        )
+        self.assertEqual([2.0], [m['weight'] for m in series['measures']])
+
+        self.assertTrue(Series.migrate(self.service_key))
+        self.assertFalse(Series.migrate(self.service_key))
+        series = Series.get(self.service_key)
+        self.assertTrue(Series.is_sharded(series))
+        self.assertEqual([1.0, 2.0], [m['weight'] for m in series['measures']])
+
+    def test_get_unsorted_legacy_series(self):
+        legacy = _series(
+            self.service_key,
+            [_measure(2020, 1, 1, weight=2.0), _measure(2019, 1, 1, weight=1.0)],
+        )
+        self.stored[legacy.key] = legacy
+
+        series = Series.get(self.service_key)
+        self.assertEqual([1.0, 2.0], [m['weight'] for m in series['measures']])
+
+    def test_upsert_migrates_legacy_series(self):
+        legacy = _series(self.service_key, [_measure(2019, 1, 1, weight=1.0)])
+        self.stored[legacy.key] = legacy
+
+        Series.upsert(self.service_key, [_measure(2020, 1, 1, weight=2.0)])
+
+        series = Series.get(self.service_key)
+        self.assertTrue(Series.is_sharded(series))
+        self.assertNotIn('measures', self.stored[legacy.key])
+        self.assertEqual([1.0, 2.0], [m['weight'] for m in series['measures']])
+
+    def test_upsert_unsorted_legacy_series(self):
+        # Newest first, as Garmin's API returned them.
+        legacy = _series(
+            self.service_key,
+            [_measure(2020, 1, day, weight=float(day)) for day in (3, 2, 1)],
+        )
+        self.stored[legacy.key] = legacy
+
+        self.assertIsNone(
+            Series.upsert(self.service_key, [_measure(2020, 1, 3, weight=3.0)])
+        )
+        change = Series.upsert(self.service_key, [_measure(2020, 1, 2, weight=4.0)])
+
+        self.assertEqual([4.0], [m['weight'] for m in change.changed])
+        series = Series.get(self.service_key)
+        self.assertEqual([1.0, 4.0, 3.0], [m['weight'] for m in series['measures']])
+
+    def test_upsert_unchanged_writes_nothing(self):
+        Series.put(_series(self.service_key, [_measure(2020, 1, 1, weight=2.0)]))
+        self.put_multi_mock.reset_mock()
+
+        self.assertIsNone(
+            Series.upsert(self.service_key, [_measure(2020, 1, 1, weight=2.0)])
+        )
+        self.put_multi_mock.assert_not_called()
+
+
+class SpliceTest(unittest.TestCase):
+    def setUp(self):
+        self.stored = [
+            _measure(2020, 1, day, weight=float(day)) for day in range(1, 11)
+        ]
+
+    def test_replaces_and_inserts(self):
+        replacement = _measure(2020, 1, 3, weight=30.0)
+        inserted = _measure(2020, 1, 4, hour=1, weight=40.0)
+
+        change = splice(self.stored, [replacement, inserted])
+
+        self.assertEqual(replacement['date'], change.start)
+        self.assertEqual(inserted['date'], change.end)
+        self.assertEqual([replacement, inserted], change.changed)
+        self.assertEqual(
+            [1.0, 2.0, 30.0, 40.0, 4.0, 5.0],
+            [m['weight'] for m in self.stored[:6]],
+        )
+        self.assertEqual(11, len(self.stored))
+
+    def test_unchanged(self):
+        self.assertIsNone(splice(self.stored, [_measure(2020, 1, 5, weight=5)]))
+        self.assertEqual(10, len(self.stored))
+
+    def test_appends(self):
+        change = splice(self.stored, [_measure(2020, 2, 1, weight=1.0)])
+
+        self.assertEqual(1, len(change.changed))
+        self.assertEqual(self.stored[-1], change.changed[0])
+
+    def test_last_duplicate_wins(self):
+        change = splice(
+            self.stored,
+            [_measure(2020, 2, 1, weight=1.0), _measure(2020, 2, 1, weight=2.0)],
+        )
+
+        self.assertEqual([2.0], [m['weight'] for m in change.changed])
+        self.assertEqual(11, len(self.stored))
+
+
+def _series(service_key, measures):
+    series = Entity(Series.key(service_key))
+    series['measures'] = measures
+    return series
+
+
+def _measure(year, month, day, hour=7, **values):
+    measure = Entity()
+    measure['date'] = datetime.datetime(
+        year, month, day, hour, 13, tzinfo=datetime.timezone.utc
+    )
+    measure.update(values)
+    return measure
@@ -0,0 +1,149 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import unittest
+from unittest import mock
+
+from shared import ds_util
+from shared import testing_util
+from shared.datastore import sync_ledger
+from shared.datastore.sync_ledger import SyncLedger
+
+
+class SyncLedgerTest(unittest.TestCase):
+    def setUp(self):
+        self.user_key = ds_util.client.key('User', 'someuser')
+        self.stored = testing_util.fake_datastore(self).stored
+        patcher = mock.patch('shared.task_util.xsync_tasks_trainerroad')
+        self.task_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_is_synced_per_measure(self):
+        SyncLedger.record(self.user_key, 'garmin', _measure(1, 70.0))
+
+        self.assertTrue(
+            SyncLedger.is_synced(self.user_key, 'garmin', _measure(1, 70.0))
+        )
+        self.assertFalse(
+            SyncLedger.is_synced(self.user_key, 'garmin', _measure(1, 70.5))
+        )
+        self.assertFalse(
+            SyncLedger.is_synced(self.user_key, 'garmin', _measure(2, 70.0))
+        )
+
+        # Naive dates are UTC.
+        naive = _measure(1, 70.0)
+        naive['date'] = naive['date'].replace(tzinfo=None)
+        self.assertTrue(SyncLedger.is_synced(self.user_key, 'garmin', naive))
+
+    def test_is_synced_latest_only(self):
+        SyncLedger.record(self.user_key, 'trainerroad', _measure(2, 70.0))
+
+        self.assertTrue(
+            SyncLedger.is_synced(self.user_key, 'trainerroad', _measure(1, 69.0))
+        )
+        self.assertTrue(
+            SyncLedger.is_synced(self.user_key, 'trainerroad', _measure(3, 70.0))
+        )
+        self.assertFalse(
+            SyncLedger.is_synced(self.user_key, 'trainerroad', _measure(3, 71.0))
+        )
+
+    def test_synced_dates(self):
+        measures = [_measure(day, 70.0) for day in range(1, 5)]
+        SyncLedger.record(self.user_key, 'garmin', measures[1])
+        SyncLedger.record(self.user_key, 'garmin', _measure(3, 71.0))
+
+        self.assertEqual(
+            {measures[1]['date']},
+            SyncLedger.synced_dates(self.user_key, 'garmin', measures),
+        )
+
+    def test_defer_keeps_latest(self):
+        self.assertTrue(SyncLedger.defer(self.user_key, 'trainerroad', _measure(2, 72)))
+        self.assertFalse(
+            SyncLedger.defer(self.user_key, 'trainerroad', _measure(3, 73))
+        )
+        self.assertFalse(
+            SyncLedger.defer(self.user_key, 'trainerroad', _measure(1, 71))
+        )
+
+        pending = SyncLedger.peek(self.user_key, 'trainerroad')
+        self.assertEqual(_measure(3, 73), _pending_measure(pending))
+        self.assertFalse(SyncLedger.done(self.user_key, 'trainerroad', pending))
+        self.assertIsNone(SyncLedger.peek(self.user_key, 'trainerroad'))
+        self.assertTrue(SyncLedger.defer(self.user_key, 'trainerroad', _measure(4, 74)))
+
+    def test_done_keeps_those_deferred_since(self):
+        SyncLedger.defer(self.user_key, 'trainerroad', _measure(2, 72))
+        pending = SyncLedger.peek(self.user_key, 'trainerroad')
+        # Not yet written, so still pending.
+        self.assertEqual(pending, SyncLedger.peek(self.user_key, 'trainerroad'))
+
+        SyncLedger.defer(self.user_key, 'trainerroad', _measure(3, 73))
+        self.assertTrue(SyncLedger.done(self.user_key, 'trainerroad', pending))
+
+        pending = SyncLedger.peek(self.user_key, 'trainerroad')
+        self.assertEqual(_measure(3, 73), _pending_measure(pending))
+        self.assertFalse(SyncLedger.done(self.user_key, 'trainerroad', pending))
+        self.assertIsNone(SyncLedger.peek(self.user_key, 'trainerroad'))
+
+    def test_defer_restarts_stale_burst(self):
+        SyncLedger.defer(self.user_key, 'trainerroad', _measure(2, 72))
+        pending = self.stored[SyncLedger.pending_key(self.user_key, 'trainerroad')]
+        pending['enqueued_at'] -= datetime.timedelta(hours=1)
+
+        self.assertTrue(SyncLedger.defer(self.user_key, 'trainerroad', _measure(1, 71)))
+        self.assertEqual(
+            _measure(1, 71),
+            _pending_measure(SyncLedger.peek(self.user_key, 'trainerroad')),
+        )
+
+    def test_retry_gives_up(self):
+        SyncLedger.defer(self.user_key, 'trainerroad', _measure(2, 72))
+        pending = SyncLedger.peek(self.user_key, 'trainerroad')
+        for _ in range(sync_ledger._MAX_RETRIES):
+            self.assertTrue(SyncLedger.retry(self.user_key, 'trainerroad', pending))
+        self.assertFalse(SyncLedger.retry(self.user_key, 'trainerroad', pending))
+
+        # Left pending, until the next defer finds it stale.
+        self.assertIsNotNone(SyncLedger.peek(self.user_key, 'trainerroad'))
+        pending = self.stored[SyncLedger.pending_key(self.user_key, 'trainerroad')]
+        pending['enqueued_at'] -= datetime.timedelta(hours=1)
+        self.assertTrue(SyncLedger.defer(self.user_key, 'trainerroad', _measure(3, 73)))
+        pending = SyncLedger.peek(self.user_key, 'trainerroad')
+        self.assertTrue(SyncLedger.retry(self.user_key, 'trainerroad', pending))
+
+    def test_defer_requeues_after_failed_enqueue(self):
+        self.task_mock.side_effect = Exception('Failed')
+        self.assertRaises(
+            Exception, SyncLedger.defer, self.user_key, 'trainerroad', _measure(2, 72)
+        )
+
+        # The next defer queues it, rather than joining a burst with no task.
+        self.task_mock.side_effect = None
+        self.assertTrue(SyncLedger.defer(self.user_key, 'trainerroad', _measure(3, 73)))
+        self.task_mock.assert_called_with(self.user_key, sync_ledger.COALESCE_WINDOW)
+
+
+def _pending_measure(pending):
+    return {'date': pending['date'], 'weight': pending['weight']}
+
+
+def _measure(day, weight):
+    return {
+        'date': datetime.datetime(2020, 9, day, 7, 13, tzinfo=datetime.timezone.utc),
+        'weight': weight,
+    }
@@ -0,0 +1,127 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import unittest
+
+from google.cloud.datastore.entity import Entity
+
+from shared import ds_util
+from shared import testing_util
+from shared.datastore import weight_trend
+from shared.datastore.series import Series
+from shared.datastore.weight_trend import WeightTrendSnapshot
+
+
+class WeightTrendSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.service_key = ds_util.client.key('Service', 'withings')
+        self.stored = testing_util.fake_datastore(self).stored
+
+        self.measures = [
+            _measure(2019, 5, 18, 60.0),
+            _measure(2020, 9, 17, 56.0),
+            _measure(2020, 9, 18, 55.0),
+            _measure(2020, 9, 18, 54.0, hour=19),
+            _measure(2020, 9, 24, 35.0),
+            _measure(2020, 9, 25, 30.0),
+        ]
+        self.today = datetime.date(2020, 9, 25)
+
+    def test_lookback(self):
+        snapshot = WeightTrendSnapshot.rebuild(self.service_key, self.measures)
+
+        self.assertEqual(30.0, _weight(snapshot, 0, self.today))
+        self.assertEqual(35.0, _weight(snapshot, 1, self.today))
+        week_ago = WeightTrendSnapshot.lookback(snapshot, 7, self.today)
+        self.assertEqual(self.measures[3]['date'], week_ago['date'])
+        self.assertEqual(54.0, week_ago['weight'])
+        self.assertEqual(60.0, _weight(snapshot, 365, self.today))
+        self.assertIsNone(WeightTrendSnapshot.lookback(snapshot, 500, self.today))
+
+        # Days after the latest measure carry it forward.
+        self.assertEqual(
+            30.0, _weight(snapshot, 0, self.today + datetime.timedelta(days=10))
+        )
+
+    def test_ema(self):
+        snapshot = WeightTrendSnapshot.rebuild(self.service_key, self.measures)
+
+        alpha = 2 / (weight_trend.EMA_DAYS + 1)
+        day = datetime.date(2019, 5, 18)
+        weights = {m['date'].date(): m['weight'] for m in self.measures}
+        weight = ema = 60.0
+        while day <= self.today:
+            weight = weights.get(day, weight)
+            ema = alpha * weight + (1 - alpha) * ema
+            day += datetime.timedelta(days=1)
+
+        self.assertAlmostEqual(ema, WeightTrendSnapshot.ema(snapshot, self.today))
+        later = WeightTrendSnapshot.ema(
+            snapshot, self.today + datetime.timedelta(days=2)
+        )
+        self.assertAlmostEqual(30 + (ema - 30) * (1 - alpha) ** 2, later)
+
+    def test_update_matches_rebuild(self):
+        Series.put(_series(self.service_key, self.measures))
+        WeightTrendSnapshot.rebuild(self.service_key, self.measures)
+
+        new_measures = [
+            _measure(2020, 9, 20, 40.0),
+            _measure(2020, 9, 30, 28.0),
+        ]
+        change = Series.upsert(self.service_key, new_measures)
+        updated = WeightTrendSnapshot.update(self.service_key, change)
+        rebuilt = WeightTrendSnapshot.rebuild(
+            self.service_key, Series.get(self.service_key)['measures']
+        )
+
+        for name in ('start', 'days', 'weight', 'measured_at'):
+            self.assertEqual(rebuilt[name], updated[name], name)
+        today = datetime.date(2020, 10, 1)
+        self.assertAlmostEqual(
+            WeightTrendSnapshot.ema(rebuilt, today),
+            WeightTrendSnapshot.ema(updated, today),
+        )
+        self.assertEqual(40.0, _weight(updated, 5, datetime.date(2020, 9, 26)))
+
+    def test_no_measures(self):
+        snapshot = WeightTrendSnapshot.get_or_rebuild(self.service_key)
+
+        self.assertEqual(0, snapshot['days'])
+        self.assertIsNone(WeightTrendSnapshot.lookback(snapshot, 0, self.today))
+        self.assertIsNone(WeightTrendSnapshot.ema(snapshot, self.today))
+
+
+def _weight(snapshot, days, today):
+    return WeightTrendSnapshot.lookback(snapshot, days, today)['weight']
+
+
+def _series(service_key, measures):
+    series = Entity(Series.key(service_key))
+    series['measures'] = measures
+    return series
+
+
+def _measure(year, month, day, weight, hour=7):
+    measure = Entity()
+    measure.update(
+        {
+            'date': datetime.datetime(
+                year, month, day, hour, 13, tzinfo=datetime.timezone.utc
+            ),
+            'weight': weight,
+        }
+    )
+    return measure
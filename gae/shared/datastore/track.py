@@ -16,6 +16,7 @@ from google.cloud.datastore.entity import Entity
 from shared.datastore.garmin.converters import GarminConverters
 
 from shared import ds_util
+from shared import track_util
 
 
 class Track(object):
@@ -34,3 +35,42 @@ class Track(object):
     @classmethod
     def to_entity(cls, track, parent=None) -> Entity:
         return GarminConverters.Track.to_entity(track, parent=parent)
+
+
+class TrackPoints(object):
+    """A chunk of a track's points, as appended by each LiveTrack poll.
+
+    Chunks hold their points packed by track_util.pack, rather than as
+    Garmin's JSON, and are numbered from 1, in the order they were polled.
+    """
+
+    @classmethod
+    def key(cls, track_key, chunk):
+        return ds_util.client.key('TrackPoints', chunk, parent=track_key)
+
+    @classmethod
+    def get_all(cls, track):
+        """Returns all of track's points, in Garmin's trackPoints format."""
+        keys = [
+            cls.key(track.key, chunk)
+            for chunk in range(1, track.get('points_chunks', 0) + 1)
+        ]
+        chunks = []
+        for offset in range(0, len(keys), ds_util.MAX_LOOKUP_KEYS):
+            chunks.extend(
+                ds_util.client.get_multi(
+                    keys[offset : offset + ds_util.MAX_LOOKUP_KEYS]
+                )
+            )
+        chunks.sort(key=lambda c: c.key.id)
+        return [point for chunk in chunks for point in track_util.unpack(chunk)]
+
+    @classmethod
+    def to_entity(cls, track_key, chunk, trackpoints):
+        entity = Entity(
+            cls.key(track_key, chunk),
+            exclude_from_indexes=[name for name, _ in track_util.COLUMNS]
+            + ['missing_position'],
+        )
+        entity.update(track_util.pack(trackpoints))
+        return entity
@@ -0,0 +1,261 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import logging
+
+import numpy as np
+
+from google.cloud.datastore.entity import Entity
+
+from shared import ds_util
+from shared.datastore.series import Series
+
+
+# How far back lookback can see.
+MAX_LOOKBACK_DAYS = 3 * 365
+
+# A week, a month, six months and a year.
+DEFAULT_LOOKBACK_DAYS = (7, 30, 183, 365)
+
+# The span of the exponential moving average, in days.
+EMA_DAYS = 7
+
+# Days per block of the vectorized EMA; keeps (1 - alpha) ** -BLOCK finite.
+_EMA_BLOCK = 256
+
+
+class WeightTrendSnapshot(object):
+    """Each day's latest weight and its EMA, for O(1) trend lookups.
+
+    A snapshot holds one entry per UTC day, from MAX_LOOKBACK_DAYS before
+    the latest weighed day to that day: the weight of the latest measure on
+    or before the day, when that measure was taken, and the EMA_DAYS EMA of
+    those daily weights. Each is a little-endian array, read without copying.
+
+    rebuild computes it from a whole series in a vectorized pass; update
+    recomputes only the days from a Series.upsert's change onward.
+    """
+
+    @classmethod
+    def key(cls, service_key):
+        return ds_util.client.key('WeightTrendSnapshot', 'weight', parent=service_key)
+
+    @classmethod
+    def get(cls, service_key):
+        return ds_util.client.get(cls.key(service_key))
+
+    @classmethod
+    def get_or_rebuild(cls, service_key):
+        snapshot = cls.get(service_key)
+        if snapshot is None:
+            series = Series.get(service_key)
+            snapshot = cls.rebuild(service_key, series['measures'] if series else [])
+        return snapshot
+
+    @classmethod
+    def rebuild(cls, service_key, measures):
+        """Stores a snapshot computed from every one of measures."""
+        days, weights, micros = _daily(measures)
+        if len(days):
+            start = max(days[0], days[-1] - np.timedelta64(MAX_LOOKBACK_DAYS, 'D'))
+            weights, micros = _fill(days, weights, micros, start, days[-1])
+            ema = _ema(weights, weights[0])
+        else:
+            start, ema = None, weights
+        snapshot = cls._to_entity(service_key, start, weights, micros, ema)
+        ds_util.client.put(snapshot)
+        logging.debug(
+            'WeightTrendSnapshot: Rebuilt %s days: %s', len(weights), service_key
+        )
+        return snapshot
+
+    @classmethod
+    def update(cls, service_key, change):
+        """Recomputes the snapshot from the first day change touched."""
+        snapshot = cls.get(service_key)
+        first = np.datetime64(ds_util.utc_naive(change.start), 'D')
+        if snapshot is None or not snapshot['days'] or first <= _start(snapshot):
+            series = Series.get(service_key)
+            return cls.rebuild(service_key, series['measures'] if series else [])
+
+        start = _start(snapshot)
+        end = start + np.timedelta64(snapshot['days'] - 1, 'D')
+        # Days after the snapshot's end are filled from it, too.
+        first = min(first, end + np.timedelta64(1, 'D'))
+        keep = int((first - start) / np.timedelta64(1, 'D'))
+        weights, micros, ema = (
+            _column(snapshot, name, dtype)
+            for name, dtype in (
+                ('weight', '<f8'),
+                ('measured_at', '<i8'),
+                ('ema', '<f8'),
+            )
+        )
+        end = max(end, first)
+
+        series = Series.get(service_key, start=_to_datetime(first))
+        days, new_weights, new_micros = _daily(series['measures'] if series else [])
+        if len(days):
+            end = max(end, days[-1])
+        new_weights, new_micros = _fill(
+            days,
+            new_weights,
+            new_micros,
+            first,
+            end,
+            seed=(weights[keep - 1], micros[keep - 1]),
+        )
+        weights = np.concatenate([weights[:keep], new_weights])
+        micros = np.concatenate([micros[:keep], new_micros])
+        ema = np.concatenate([ema[:keep], _ema(new_weights, ema[keep - 1])])
+
+        # Drop the days that have fallen out of the lookback.
+        trim = max(0, len(weights) - MAX_LOOKBACK_DAYS - 1)
+        snapshot = cls._to_entity(
+            service_key,
+            start + np.timedelta64(trim, 'D'),
+            weights[trim:],
+            micros[trim:],
+            ema[trim:],
+        )
+        ds_util.client.put(snapshot)
+        logging.debug(
+            'WeightTrendSnapshot: Updated %s days: %s', len(new_weights), service_key
+        )
+        return snapshot
+
+    @classmethod
+    def lookback(cls, snapshot, days, today):
+        """Returns the latest {'date', 'weight'} on or before days ago."""
+        if not snapshot['days']:
+            return None
+        i = (today - _start(snapshot).astype(datetime.date)).days - days
+        if i < 0:
+            return None
+        i = min(i, snapshot['days'] - 1)
+        weight = _column(snapshot, 'weight', '<f8')[i]
+        micros = _column(snapshot, 'measured_at', '<i8')[i]
+        return {
+            'date': ds_util.from_micros(micros),
+            'weight': float(weight),
+        }
+
+    @classmethod
+    def ema(cls, snapshot, today):
+        """Returns the EMA as of today, decayed toward the latest weight."""
+        if not snapshot['days']:
+            return None
+        start = _start(snapshot).astype(datetime.date)
+        i = (today - start).days
+        if i < 0:
+            return None
+        last = snapshot['days'] - 1
+        ema = _column(snapshot, 'ema', '<f8')
+        if i <= last:
+            return float(ema[i])
+        weight = _column(snapshot, 'weight', '<f8')[last]
+        return float(weight + (ema[last] - weight) * (1 - _alpha()) ** (i - last))
+
+    @classmethod
+    def _to_entity(cls, service_key, start, weights, micros, ema):
+        snapshot = Entity(
+            cls.key(service_key),
+            exclude_from_indexes=['weight', 'measured_at', 'ema'],
+        )
+        snapshot.update(
+            {
+                'start': _to_datetime(start) if start is not None else None,
+                'days': len(weights),
+                'ema_days': EMA_DAYS,
+                'weight': np.asarray(weights, dtype='<f8').tobytes(),
+                'measured_at': np.asarray(micros, dtype='<i8').tobytes(),
+                'ema': np.asarray(ema, dtype='<f8').tobytes(),
+                'updated_at': datetime.datetime.now(datetime.timezone.utc),
+            }
+        )
+        return snapshot
+
+
+def _daily(measures):
+    """Returns each weighed day, with its latest weight and when it was taken.
+
+    Measures needn't be sorted, but those on the same day are taken to be in
+    order.
+    """
+    weighed = [m for m in measures if m.get('weight') is not None]
+    dates = np.array(
+        [ds_util.utc_naive(m['date']) for m in weighed], dtype='datetime64[us]'
+    )
+    weights = np.array([m['weight'] for m in weighed], dtype=np.float64)
+
+    days = dates.astype('datetime64[D]')
+    order = np.argsort(days, kind='stable')
+    days, dates, weights = days[order], dates[order], weights[order]
+    last_of_day = np.r_[days[1:] != days[:-1], True] if len(days) else []
+    return (
+        days[last_of_day],
+        weights[last_of_day],
+        dates[last_of_day].astype(np.int64),
+    )
+
+
+def _fill(days, weights, micros, start, end, seed=None):
+    """Carries each weighed day forward over every day from start to end."""
+    grid = np.arange(start, end + np.timedelta64(1, 'D'), dtype='datetime64[D]')
+    i = np.searchsorted(days, grid, side='right') - 1
+    seed_weight, seed_micros = seed if seed is not None else (np.nan, 0)
+    return (
+        np.where(i >= 0, weights[np.maximum(i, 0)] if len(days) else 0, seed_weight),
+        np.where(i >= 0, micros[np.maximum(i, 0)] if len(days) else 0, seed_micros),
+    )
+
+
+def _ema(weights, previous):
+    """The EMA of weights, continuing from previous, without a Python loop.
+
+    Within a block, ema[t] = d**(t+1) * previous + alpha * sum(d**(t-k) * x[k])
+    for d = 1 - alpha, which is a cumulative sum once scaled by d**-k.
+    """
+    alpha = _alpha()
+    decay = 1 - alpha
+    blocks = []
+    for offset in range(0, len(weights), _EMA_BLOCK):
+        x = np.asarray(weights[offset : offset + _EMA_BLOCK], dtype=np.float64)
+        t = np.arange(len(x))
+        scaled = np.cumsum(alpha * x * decay**-t)
+        block = decay**t * (decay * previous + scaled)
+        blocks.append(block)
+        previous = block[-1]
+    return np.concatenate(blocks) if blocks else np.array([], dtype=np.float64)
+
+
+def _alpha():
+    return 2 / (EMA_DAYS + 1)
+
+
+def _column(snapshot, name, dtype):
+    return np.frombuffer(snapshot[name], dtype=dtype)
+
+
+def _start(snapshot):
+    return np.datetime64(ds_util.utc_naive(snapshot['start']), 'D')
+
+
+def _to_datetime(day):
+    return (
+        day.astype('datetime64[us]')
+        .astype(datetime.datetime)
+        .replace(tzinfo=datetime.timezone.utc)
+    )
@@ -12,15 +12,301 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import copy
+import datetime
 import itertools
+import logging
+import threading
 
+from google.api_core.exceptions import Conflict
 from google.cloud.datastore import Client
+from google.cloud.datastore import helpers
 
+from shared import cache_util
 from shared.config import config
 
 
+# Kinds that rarely change, kept in a per-process cache: {kind: ttl_seconds}.
+PROCESS_CACHED_KINDS = {
+    'Bot': 300,
+    'SlackBot': 300,
+    'SlackInstaller': 300,
+    'SlackWorkspace': 300,
+}
+PROCESS_CACHE_SIZE = 256
+
+# Datastore's limits on a single commit.
+MAX_BATCH_ENTITIES = 500
+MAX_BATCH_BYTES = 8 * 1024 * 1024
+
+# Datastore's limit on the keys in a single lookup.
+MAX_LOOKUP_KEYS = 1000
+
+# How many times transact tries a transaction that conflicts.
+TRANSACTION_ATTEMPTS = 3
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class CachingClient(object):
+    """Wraps a datastore Client, caching gets by key.
+
+    While a cache scope is active on the current thread (see begin_scope),
+    gets are memoized for the rest of the scope, and entities of the kinds in
+    process_cached_kinds are also kept in a process-wide LRU until their TTL
+    expires. Misses are only memoized for the scope, so an entity created by
+    another process is seen by the next request. Puts and deletes made through
+    this client invalidate both caches. Gets inside a transaction always read
+    from Datastore. Outside a scope, this behaves exactly like the wrapped
+    client.
+
+    Cached entities are copied on the way in and out, so callers can't
+    modify each other's results.
+    """
+
+    def __init__(
+        self,
+        client,
+        process_cached_kinds=None,
+        process_cache_size=PROCESS_CACHE_SIZE,
+    ):
+        self._client = client
+        self._process_cached_kinds = dict(process_cached_kinds or {})
+        self._process_cache = cache_util.LruCache(process_cache_size)
+        self._local = threading.local()
+
+    def __getattr__(self, attr):
+        return getattr(self._client, attr)
+
+    def begin_scope(self):
+        """Starts memoizing gets on this thread, e.g., for a Flask request."""
+        self._local.scope = {}
+        self._local.stats = collections.Counter()
+
+    def end_scope(self):
+        """Ends this thread's scope, returning its hit and miss counts."""
+        stats = getattr(self._local, 'stats', collections.Counter())
+        self._local.scope = None
+        self._local.stats = None
+        if stats:
+            logging.debug('Datastore cache: %s', dict(stats))
+        return stats
+
+    @property
+    def stats(self):
+        """This scope's counts of hits, process_hits and misses."""
+        return getattr(self._local, 'stats', None) or collections.Counter()
+
+    def get(self, key, **kwargs):
+        scope = self._cacheable_scope(key, kwargs)
+        if scope is None:
+            return self._client.get(key, **kwargs)
+
+        entity = self._cached(scope, key)
+        if entity is cache_util.MISSING:
+            self._local.stats['misses'] += 1
+            entity = self._client.get(key)
+            self._store(scope, key, entity)
+        return copy.deepcopy(entity)
+
+    def get_multi(self, keys, **kwargs):
+        keys = list(keys)
+        scope = self._cacheable_scope(keys[0] if keys else None, kwargs)
+        if scope is None or any(key.is_partial for key in keys):
+            return self._client.get_multi(keys, **kwargs)
+
+        found = {}
+        misses = []
+        for key in keys:
+            entity = self._cached(scope, key)
+            if entity is cache_util.MISSING:
+                misses.append(key)
+            else:
+                found[key] = entity
+        if misses:
+            self._local.stats['misses'] += len(misses)
+            fetched = {e.key: e for e in self._client.get_multi(misses)}
+            for key in misses:
+                found[key] = fetched.get(key)
+                self._store(scope, key, found[key])
+        return [copy.deepcopy(found[key]) for key in keys if found[key] is not None]
+
+    def put(self, entity, **kwargs):
+        self._invalidate(entity.key)
+        return self._client.put(entity, **kwargs)
+
+    def put_multi(self, entities, **kwargs):
+        entities = list(entities)
+        for entity in entities:
+            self._invalidate(entity.key)
+        return self._client.put_multi(entities, **kwargs)
+
+    def delete(self, key, **kwargs):
+        self._invalidate(key)
+        return self._client.delete(key, **kwargs)
+
+    def delete_multi(self, keys, **kwargs):
+        keys = list(keys)
+        for key in keys:
+            self._invalidate(key)
+        return self._client.delete_multi(keys, **kwargs)
+
+    def _cacheable_scope(self, key, kwargs):
+        scope = getattr(self._local, 'scope', None)
+        if scope is None or kwargs or key is None or key.is_partial:
+            return None
+        if self._client.current_transaction is not None:
+            return None
+        return scope
+
+    def _cached(self, scope, key):
+        entity = scope.get(key, cache_util.MISSING)
+        if entity is not cache_util.MISSING:
+            self._local.stats['hits'] += 1
+            return entity
+        if key.kind in self._process_cached_kinds:
+            entity = self._process_cache.get(key)
+            if entity is not cache_util.MISSING:
+                self._local.stats['process_hits'] += 1
+                scope[key] = entity
+        return entity
+
+    def _store(self, scope, key, entity):
+        entity = copy.deepcopy(entity)
+        scope[key] = entity
+        if entity is not None and key.kind in self._process_cached_kinds:
+            self._process_cache.set(key, entity, self._process_cached_kinds[key.kind])
+
+    def _invalidate(self, key):
+        if key is None or key.is_partial:
+            return
+        scope = getattr(self._local, 'scope', None)
+        if scope is not None:
+            scope.pop(key, None)
+        if key.kind in self._process_cached_kinds:
+            self._process_cache.pop(key)
+
+
 # Datastore Client
-client = Client(project=config.project_id)
+client = CachingClient(
+    Client(project=config.project_id), process_cached_kinds=PROCESS_CACHED_KINDS
+)
+
+
+def transact(fn, *args, attempts=TRANSACTION_ATTEMPTS):
+    """Returns fn(*args), run in a transaction, which is retried on conflict.
+
+    fn may run more than once, so it should read everything it writes from
+    within the transaction.
+    """
+    for attempt in range(attempts):
+        try:
+            with client.transaction():
+                return fn(*args)
+        except Conflict:
+            if attempt == attempts - 1:
+                raise
+            logging.debug('Retrying transaction: %s', fn.__name__)
+
+
+class BatchWriter(object):
+    """Buffers puts and writes them with put_multi.
+
+    Use it as a context manager, which flushes on exit. Entities are also
+    flushed whenever the buffer reaches max_entities or about max_bytes of
+    serialized entities, to stay within Datastore's commit limits. Putting a
+    key that is already buffered replaces the buffered entity. Entities still
+    buffered when the block raises are written, as they would have been by
+    sequential puts.
+
+    It can't be used in a transaction, which would hold every flush for its
+    one commit and so defeat the limits; that raises a ValueError.
+    """
+
+    def __init__(
+        self,
+        datastore_client=None,
+        max_entities=MAX_BATCH_ENTITIES,
+        max_bytes=MAX_BATCH_BYTES,
+    ):
+        self._client = datastore_client
+        self.max_entities = max_entities
+        self.max_bytes = max_bytes
+        self.stats = collections.Counter()
+
+        self._entities = collections.OrderedDict()
+        self._bytes = 0
+
+    @property
+    def client(self):
+        return self._client if self._client is not None else client
+
+    def __enter__(self):
+        self._check_no_transaction()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def put(self, entity):
+        size = helpers.entity_to_protobuf(entity)._pb.ByteSize()
+        if self._entities and self._bytes + size > self.max_bytes:
+            self.flush()
+
+        # Incomplete keys can't collide, so key them by the entity itself.
+        buffer_key = id(entity) if entity.key.is_partial else entity.key
+        previous = self._entities.pop(buffer_key, None)
+        if previous is not None:
+            self._bytes -= previous[1]
+            self.stats['replaced'] += 1
+        self._entities[buffer_key] = (entity, size)
+        self._bytes += size
+        self.stats['entities'] += 1
+
+        if len(self._entities) >= self.max_entities:
+            self.flush()
+
+    def put_multi(self, entities):
+        for entity in entities:
+            self.put(entity)
+
+    def flush(self):
+        if not self._entities:
+            return
+        self._check_no_transaction()
+        entities = [entity for entity, _ in self._entities.values()]
+        self._entities.clear()
+        self._bytes = 0
+        self.client.put_multi(entities)
+        self.stats['flushes'] += 1
+
+    def _check_no_transaction(self):
+        if self.client.current_transaction is not None:
+            raise ValueError('BatchWriter: Can\'t be used in a transaction')
+
+
+def utc(date):
+    """Datastore reads dates back as UTC, so naive dates are taken as UTC."""
+    if date is not None and date.tzinfo is None:
+        return date.replace(tzinfo=datetime.timezone.utc)
+    return date
+
+
+def utc_naive(date):
+    """date in UTC, without tzinfo, as numpy's datetime64 wants it."""
+    if date.tzinfo is not None:
+        date = date.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return date
+
+
+def to_micros(date):
+    """Microseconds since the epoch, as Datastore stores date."""
+    return (utc(date) - _EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def from_micros(micros):
+    return _EPOCH + datetime.timedelta(microseconds=int(micros))
 
 
 def key_from_path(path):
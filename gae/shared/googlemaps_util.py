@@ -12,10 +12,73 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import copy
+import logging
+import threading
+
+from google.cloud.datastore.entity import Entity
 import googlemaps
 
+from shared import cache_util
+from shared import ds_util
+from shared import hash_util
 from shared.config import config
 
 
+ELEVATION_CACHE_SIZE = 512
+
+
 # Google Maps Client
 client = googlemaps.Client(key=config.gcp_server_creds['api_key'])
+
+
+class ElevationCache(object):
+    """Caches elevation_along_path results, which rarely change.
+
+    Profiles are stored in Datastore as ElevationProfile entities, named by
+    a hash of the path and sample count, with an in-process LRU in front.
+    """
+
+    def __init__(self, maps_client=None, max_size=ELEVATION_CACHE_SIZE):
+        self._maps_client = maps_client
+        self._lru = cache_util.LruCache(max_size)
+        self._lock = threading.Lock()
+        self.stats = collections.Counter()
+
+    @property
+    def maps_client(self):
+        return self._maps_client if self._maps_client is not None else client
+
+    def elevation_along_path(self, path, samples):
+        name = hash_util.hash_name(path, samples)
+        elevations = self._lru.get(name)
+        if elevations is not cache_util.MISSING:
+            self._count('hits', 'maps_calls_avoided')
+            return copy.deepcopy(elevations)
+
+        key = ds_util.client.key('ElevationProfile', name)
+        entity = ds_util.client.get(key)
+        if entity is not None:
+            self._count('hits', 'datastore_hits', 'maps_calls_avoided')
+            elevations = entity['elevations']
+        else:
+            self._count('misses')
+            elevations = self.maps_client.elevation_along_path(path, samples)
+            entity = Entity(key, exclude_from_indexes=['elevations'])
+            entity.update({'samples': samples, 'elevations': elevations})
+            ds_util.client.put(entity)
+
+        self._lru.set(name, elevations)
+        return copy.deepcopy(elevations)
+
+    def log_stats(self):
+        logging.info('Elevation cache: %s', dict(self.stats))
+
+    def _count(self, *stats):
+        with self._lock:
+            for stat in stats:
+                self.stats[stat] += 1
+
+
+elevation_cache = ElevationCache()
@@ -0,0 +1,172 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Keeps entities pending until a delayed task processes them.
+
+A pending entity has at most one queued task. Work that arrives while it's
+queued is merged into the entity instead of queueing a task of its own.
+Queues don't retry failed tasks, so a task that fails queues itself again,
+with retry. If queueing a task fails, the entity is marked as having none, so
+the next add queues one rather than merging into it.
+"""
+
+import datetime
+import logging
+
+from shared import ds_util
+
+
+class PendingTasks(object):
+    """Pending entities, whose tasks are queued by enqueue_fn(entity, delay).
+
+    Each entity records enqueued_at, when its task was last queued, or None if
+    that failed, and retries, how many times in a row its task has failed.
+    Callers count the work merged into it in its coalesced property, which,
+    with enqueued_at, tells done whether more arrived since the task read it.
+    """
+
+    def __init__(
+        self, name, enqueue_fn, stale_after, retry_delay, max_retries, count_fn
+    ):
+        self.name = name
+        self.stale_after = stale_after
+        self.retry_delay = retry_delay
+        self.max_retries = max_retries
+        self._enqueue_fn = enqueue_fn
+        self._count = count_fn
+
+    def add(self, key, update, delay):
+        """Updates key's pending entity, and queues its task if it has none.
+
+        update(pending, queue) is called in a transaction, with the pending
+        entity, or None, and whether its task is to be queued, and returns the
+        entity to store. A task is queued for a new entity, or a stale one,
+        whose task was queued more than stale_after ago or failed to be.
+
+        Returns the entity and whether its task was queued.
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+        def _add():
+            pending = ds_util.client.get(key)
+            queue = pending is None or self._is_stale(pending, now)
+            entity = update(pending, queue)
+            if queue:
+                entity.update({'enqueued_at': now, 'retries': 0})
+            ds_util.client.put(entity)
+            return entity, queue
+
+        entity, queued = ds_util.transact(_add)
+        if queued:
+            self._enqueue(entity, delay)
+            self._count('enqueued')
+        else:
+            self._count('coalesced')
+            logging.debug(
+                '%s: Coalesced %s: %s', self.name, entity['coalesced'], entity.key
+            )
+        return entity, queued
+
+    def done(self, entity, delay):
+        """Deletes entity, once processed, unless more was merged into it since.
+
+        If some was, it's left pending, and its task queued again after delay.
+        Returns whether it was.
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+        def _done():
+            pending = ds_util.client.get(entity.key)
+            if pending is None:
+                return None
+            merged = pending['coalesced'] != entity['coalesced'] or (
+                pending.get('enqueued_at') != entity.get('enqueued_at')
+            )
+            if not merged:
+                ds_util.client.delete(entity.key)
+                return None
+            pending['enqueued_at'] = now
+            ds_util.client.put(pending)
+            return pending
+
+        pending = ds_util.transact(_done)
+        if pending is None:
+            self._count('processed')
+            return False
+        self._enqueue(pending, delay)
+        self._count('requeued')
+        logging.debug(
+            '%s: Requeued %s: %s', self.name, pending['coalesced'], entity.key
+        )
+        return True
+
+    def retry(self, entity):
+        """Queues entity's task again, after retry_delay, once it has failed.
+
+        After max_retries, it's left pending instead, until the next add finds
+        it stale. Returns whether it was queued.
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+        def _retry():
+            pending = ds_util.client.get(entity.key)
+            if pending is None:
+                return None, 0
+            retries = pending.get('retries', 0) + 1
+            if retries > self.max_retries:
+                return None, retries
+            pending.update({'retries': retries, 'enqueued_at': now})
+            ds_util.client.put(pending)
+            return pending, retries
+
+        pending, retries = ds_util.transact(_retry)
+        if pending is not None:
+            self._enqueue(pending, self.retry_delay)
+            self._count('retried')
+            logging.info(
+                '%s: Retry %s in %s: %s',
+                self.name,
+                retries,
+                self.retry_delay,
+                entity.key,
+            )
+            return True
+        if retries:
+            self._count('abandoned')
+            logging.error(
+                '%s: Abandoned after %s retries: %s',
+                self.name,
+                retries - 1,
+                entity.key,
+            )
+        return False
+
+    def _is_stale(self, pending, now):
+        enqueued_at = pending.get('enqueued_at')
+        return enqueued_at is None or enqueued_at < now - self.stale_after
+
+    def _enqueue(self, pending, delay):
+        try:
+            self._enqueue_fn(pending, delay)
+        except Exception:
+            logging.exception('%s: Failed to queue: %s', self.name, pending.key)
+            ds_util.transact(self._clear_enqueued_at, pending)
+            raise
+
+    def _clear_enqueued_at(self, pending):
+        # Unless it's been queued again since.
+        current = ds_util.client.get(pending.key)
+        if current is not None and current['enqueued_at'] == pending['enqueued_at']:
+            current['enqueued_at'] = None
+            ds_util.client.put(current)
@@ -0,0 +1,110 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Projects and downsamples measures read from a Series, for charts."""
+
+import datetime
+
+import numpy as np
+
+from shared import ds_util
+
+
+RESOLUTIONS = ('day', 'week', 'month')
+
+# The fields aggregated when downsampling without explicit fields.
+DEFAULT_FIELDS = ('weight', 'fat_ratio')
+
+# 1970-01-01 was a Thursday, three days after the Monday starting its week.
+_EPOCH_WEEKDAY = 3
+
+
+def project(measures, fields):
+    """Returns measures with only their dates and the given fields."""
+    fields = set(fields) | {'date'}
+    return [{k: v for k, v in m.items() if k in fields} for m in measures]
+
+
+def downsample(measures, resolution, fields=DEFAULT_FIELDS):
+    """Aggregates measures, sorted by date, into day, week or month buckets.
+
+    Each bucket is a dict with the UTC date its bucket starts, its count of
+    measures and, for each field, the mean as <field> and the <field>_min,
+    <field>_max and <field>_last. Fields no measure in a bucket has are left
+    out of it.
+    """
+    if resolution not in RESOLUTIONS:
+        raise ValueError('Unknown resolution: %s' % (resolution,))
+    if not measures:
+        return []
+
+    dates = np.array(
+        [ds_util.utc_naive(m['date']) for m in measures], dtype='datetime64[us]'
+    )
+    buckets = _buckets(dates, resolution)
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    counts = np.diff(np.r_[starts, len(measures)])
+
+    aggregates = {}
+    for field in fields:
+        values = np.array([_float(m.get(field)) for m in measures], dtype=np.float64)
+        valid = ~np.isnan(values)
+        if not valid.any():
+            continue
+        present = np.add.reduceat(valid.astype(np.int64), starts)
+        sums = np.add.reduceat(np.where(valid, values, 0), starts)
+        last_index = np.maximum.reduceat(
+            np.where(valid, np.arange(len(values)), -1), starts
+        )
+        with np.errstate(invalid='ignore', divide='ignore'):
+            aggregates[field] = (
+                present,
+                {
+                    field: sums / present,
+                    field + '_min': np.fmin.reduceat(values, starts),
+                    field + '_max': np.fmax.reduceat(values, starts),
+                    field + '_last': values[np.maximum(last_index, 0)],
+                },
+            )
+
+    downsampled = []
+    for i, start in enumerate(starts):
+        bucket = {
+            'date': buckets[start]
+            .astype('datetime64[us]')
+            .astype(datetime.datetime)
+            .replace(tzinfo=datetime.timezone.utc),
+            'count': int(counts[i]),
+        }
+        for present, columns in aggregates.values():
+            if present[i]:
+                bucket.update((name, float(c[i])) for name, c in columns.items())
+        downsampled.append(bucket)
+    return downsampled
+
+
+def _buckets(dates, resolution):
+    if resolution == 'day':
+        return dates.astype('datetime64[D]')
+    elif resolution == 'week':
+        days = dates.astype('datetime64[D]')
+        weekday = (days.astype(np.int64) + _EPOCH_WEEKDAY) % 7
+        return days - weekday.astype('timedelta64[D]')
+    return dates.astype('datetime64[M]')
+
+
+def _float(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    return np.nan
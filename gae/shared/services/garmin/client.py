@@ -15,14 +15,26 @@
 """
 """
 
+import collections
+import contextlib
+import datetime
 from functools import wraps
 import json
 import logging
 import re
+import threading
+import time
+import uuid
 
 import curlify
 import requests
+from requests.adapters import HTTPAdapter
 
+from google.api_core.exceptions import Conflict
+from google.cloud.datastore.entity import Entity
+
+from shared import cache_util
+from shared import ds_util
 from shared.datastore.service import Service
 
 
@@ -45,6 +57,19 @@ HEADERS = {
     'nk': 'NT',  # Needed for user-weight, for some reason.
 }
 
+# Clients kept warm per process, and for how long, in seconds.
+WARM_SESSIONS = 100
+WARM_SESSION_TTL = 60 * 60
+
+# Connections kept open per host, shared by every session.
+POOL_SIZE = 10
+
+# How long a login may hold an account's lock, and how long, in seconds, to
+# wait for another task's login.
+LOGIN_LOCK_LEASE = datetime.timedelta(seconds=60)
+LOGIN_LOCK_TIMEOUT = 90
+_LOGIN_LOCK_POLL_SECONDS = 1
+
 
 class Error(Exception):
     pass
@@ -55,26 +80,151 @@ class SessionExpiredError(Error):
 
 
 def create(service):
-    if not Service.has_credentials(service, required_key='password'):
-        raise Exception('Cannot create Garmin client without creds: %s' % (service,))
-    creds = service.get('credentials', {})
-    session_state = creds.get('session_state', {})
-
-    def refresh_callback(session_state):
-        logging.debug('Garmin creds refresh for: %s', service.key)
-        Service.update_credentials(service, {'session_state': session_state})
-
-    garmin = Garmin(
-        creds['username'],
-        Service.get_credentials_password(creds),
-        refresh_callback=refresh_callback,
-    )
+    return sessions.create(service)
+
+
+# A session kept warm, and the account and stored session_state it's for.
+_WarmSession = collections.namedtuple(
+    '_WarmSession', ['username', 'password', 'session_state', 'session']
+)
+
+
+class SessionManager(object):
+    """Keeps Garmin sessions warm, so that tasks rarely have to log in.
+
+    Each task gets its own Garmin client, but their requests sessions are
+    kept per service in an in-process LRU, and share a pooled adapter, so
+    cookies and connections outlive tasks. Logins to an account are
+    serialized by a GarminLoginLock in Datastore: a task that waited on
+    another's login adopts the session it stored instead of logging in again.
+    """
+
+    def __init__(
+        self,
+        max_size=WARM_SESSIONS,
+        ttl=WARM_SESSION_TTL,
+        lock_timeout=LOGIN_LOCK_TIMEOUT,
+        clock=time.monotonic,
+        sleep=time.sleep,
+    ):
+        self._warm = cache_util.LruCache(max_size)
+        self._ttl = ttl
+        self._lock_timeout = lock_timeout
+        self._clock = clock
+        self._sleep = sleep
+        self._adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+        self._lock = threading.Lock()
+        self.stats = collections.Counter()
+
+    def create(self, service):
+        if not Service.has_credentials(service, required_key='password'):
+            raise Exception(
+                'Cannot create Garmin client without creds: %s' % (service,)
+            )
+        creds = service.get('credentials', {})
+        session_state = creds.get('session_state', {})
+        password = Service.get_credentials_password(creds)
+
+        def refresh_callback(session_state):
+            logging.debug('Garmin creds refresh for: %s', service.key)
+            Service.update_credentials(service, {'session_state': session_state})
+            self._set_warm(service.key, garmin, session_state)
+
+        garmin = Garmin(
+            creds['username'],
+            password,
+            refresh_callback=refresh_callback,
+            login_lock=lambda: self.login_lock(service.key),
+            adapter=self._adapter,
+            counter=self.count,
+        )
+
+        # Unless another task has logged in since the session was warmed.
+        warm = self._warm.get(service.key)
+        if warm is not cache_util.MISSING and warm[:3] == (
+            creds['username'],
+            password,
+            session_state,
+        ):
+            self.count('warm_hits')
+            garmin.set_session(
+                warm.session,
+                profile=session_state.get('profile'),
+                preferences=session_state.get('preferences'),
+            )
+            return garmin
+
+        self.count('cold_starts')
+        try:
+            garmin.set_session_state(**session_state)
+        except ValueError:
+            logging.exception('Invalid session_state, ignoring')
+            del creds['session_state']
+            session_state = {}
+            garmin.set_session_state()
+        self._set_warm(service.key, garmin, session_state)
+        return garmin
+
+    @contextlib.contextmanager
+    def login_lock(self, service_key):
+        """Holds the account's login lock, yielding its stored session_state."""
+        key = ds_util.client.key(
+            'GarminLoginLock', service_key.name, parent=service_key
+        )
+        owner = uuid.uuid4().hex
+        deadline = self._clock() + self._lock_timeout
+        while not _acquire(key, owner):
+            if self._clock() > deadline:
+                raise Error('Timed out waiting for login: %s' % (service_key,))
+            self.count('lock_waits')
+            self._sleep(_LOGIN_LOCK_POLL_SECONDS)
+        try:
+            # Read in a transaction, past the request's cache, which may hold
+            # the Service from before another task logged in.
+            with ds_util.client.transaction(read_only=True):
+                service = ds_util.client.get(service_key)
+            creds = service.get('credentials', {}) if service is not None else {}
+            yield creds.get('session_state')
+        finally:
+            _release(key, owner)
+
+    def log_stats(self):
+        logging.info('Garmin sessions: %s', dict(self.stats))
+
+    def _set_warm(self, service_key, garmin, session_state):
+        self._warm.set(
+            service_key,
+            _WarmSession(
+                garmin._username, garmin._password, session_state, garmin._session
+            ),
+            ttl=self._ttl,
+        )
+
+    def count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+
+def _acquire(key, owner):
+    now = datetime.datetime.now(datetime.timezone.utc)
     try:
-        garmin.set_session_state(**session_state)
-    except ValueError:
-        logging.exception('Invalid session_state, ignoring')
-        del creds['session_state']
-    return garmin
+        with ds_util.client.transaction():
+            lock = ds_util.client.get(key)
+            if lock is not None and lock['owner'] != owner and lock['expires_at'] > now:
+                return False
+            lock = Entity(key)
+            lock.update({'owner': owner, 'expires_at': now + LOGIN_LOCK_LEASE})
+            ds_util.client.put(lock)
+    except Conflict:
+        return False
+    return True
+
+
+def _release(key, owner):
+    with ds_util.client.transaction():
+        lock = ds_util.client.get(key)
+        if lock is not None and lock['owner'] == owner:
+            ds_util.client.delete(key)
 
 
 def require_session(client_function):
@@ -95,10 +245,21 @@ def require_session(client_function):
 
 
 class Garmin(object):
-    def __init__(self, username, password, refresh_callback=None):
+    def __init__(
+        self,
+        username,
+        password,
+        refresh_callback=None,
+        login_lock=None,
+        adapter=None,
+        counter=None,
+    ):
         self._username = username
         self._password = password
         self._refresh_callback = refresh_callback
+        self._login_lock = login_lock
+        self._adapter = adapter
+        self._counter = counter
 
         self._session = None
         self._preferences = None
@@ -116,12 +277,20 @@ class Garmin(object):
                 )
         self._session = requests.Session()
         self._session.headers.update(HEADERS)
+        if self._adapter is not None:
+            self._session.mount('https://', self._adapter)
         if cookies:
             self._session.cookies.update(cookies)
             self._preferences = preferences
 
             self.profile = profile
 
+    def set_session(self, session, profile=None, preferences=None):
+        """Uses session, which already holds its cookies, e.g., a warm one."""
+        self._session = session
+        self._preferences = preferences
+        self.profile = profile
+
     def get_session_state(self):
         if not self._session:
             return None
@@ -132,7 +301,27 @@ class Garmin(object):
         }
 
     def login(self):
+        if self._login_lock is None:
+            return self._login()
+
+        seen = self.get_session_state()
+        with self._login_lock() as session_state:
+            if self.get_session_state() != seen:
+                logging.debug('Garmin Login: Logged in by another thread')
+                return
+            if session_state and session_state != seen:
+                try:
+                    self.set_session_state(**session_state)
+                    logging.debug('Garmin Login: Adopted a stored session')
+                    self._count('logins_adopted')
+                    return
+                except ValueError:
+                    logging.exception('Invalid session_state, logging in')
+            self._login()
+
+    def _login(self):
         logging.debug('Garmin Login')
+        self._count('logins')
         self.set_session_state()
         try:
             self._authenticate()
@@ -252,8 +441,13 @@ class Garmin(object):
             },
         )
 
+    def _count(self, stat):
+        if self._counter is not None:
+            self._counter(stat)
+
     def _get(self, url):
         logging.debug('Fetching: %s', url)
+        self._count('api_calls')
         response = self._session.get(url)
         logging.info(
             'Response code %s, and json %s',
@@ -278,6 +472,7 @@ class Garmin(object):
 
     def _post(self, url, json=None):
         logging.debug('Posting: %s', url)
+        self._count('api_calls')
         response = self._session.post(url, json=json)
         logging.info('Response code %s, and %s', response.status_code, response.text)
         logging.debug('Request: %s', curlify.to_curl(response.request))
@@ -290,3 +485,6 @@ class Garmin(object):
             response.raise_for_status()
 
         return None
+
+
+sessions = SessionManager()
@@ -0,0 +1,165 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import mock
+import unittest
+
+from google.cloud.datastore.entity import Entity
+
+from shared import ds_util
+from shared import testing_util
+from shared.services.garmin import client
+from shared.services.garmin.client import Garmin, SessionManager
+
+
+class SessionManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = testing_util.fake_datastore(self)
+        self.stored = self.fake.stored
+        patchers = [
+            mock.patch('shared.datastore.service.Service.get_credentials_password'),
+            mock.patch.object(Garmin, '_authenticate', autospec=True),
+        ]
+        password_mock, self.authenticate_mock = [p.start() for p in patchers]
+        for patcher in patchers:
+            self.addCleanup(patcher.stop)
+        password_mock.return_value = 'validpassword'
+        self.authenticate_mock.side_effect = _authenticate
+
+        user_key = ds_util.client.key('User', 'someuser')
+        self.service = Entity(ds_util.client.key('Service', 'garmin', parent=user_key))
+        self.service['credentials'] = {'username': 'user', 'password': 'encrypted'}
+        self.stored[self.service.key] = self.service
+
+        self.now = 0
+        self.sessions = SessionManager(clock=self._clock, sleep=self._sleep)
+
+    def _clock(self):
+        return self.now
+
+    def _sleep(self, seconds):
+        self.now += seconds
+
+    def _create(self):
+        return self.sessions.create(self.stored[self.service.key])
+
+    def test_warm_session_reused(self):
+        garmin = self._create()
+        garmin.login()
+
+        warm = self._create()
+        self.assertIsNot(garmin, warm)
+        self.assertIs(garmin._session, warm._session)
+        self.assertEqual(garmin.get_session_state(), warm.get_session_state())
+        self.assertIs(
+            self.sessions._adapter, garmin._session.get_adapter(client.URL_BASE)
+        )
+        self.assertEqual(1, self.sessions.stats['logins'])
+        self.assertEqual(1, self.sessions.stats['warm_hits'])
+
+    def test_clients_share_no_state(self):
+        first = self._create()
+        second = self.sessions.create(self.stored[self.service.key])
+        session = second._session
+
+        first.login()
+
+        # The login is stored through the service first was created with.
+        self.assertEqual(
+            first.get_session_state(),
+            self.stored[self.service.key]['credentials']['session_state'],
+        )
+        self.assertIs(session, second._session)
+        self.assertIsNot(first._session, second._session)
+
+    def test_stored_login_replaces_warm_session(self):
+        garmin = self._create()
+        garmin.login()
+        # Another process logged in since.
+        self.stored[self.service.key]['credentials']['session_state'] = dict(
+            garmin.get_session_state(), cookies={'SESSIONID': 'other'}
+        )
+
+        garmin = self._create()
+        self.assertEqual({'SESSIONID': 'other'}, garmin._session.cookies.get_dict())
+        self.assertEqual(0, self.sessions.stats['warm_hits'])
+
+    def test_adopts_stored_session(self):
+        first = self._create()
+        other = SessionManager(clock=self._clock, sleep=self._sleep)
+        second = other.create(self.stored[self.service.key])
+
+        first.login()
+        second.login()
+
+        self.assertEqual(1, self.sessions.stats['logins'])
+        self.assertEqual(0, other.stats['logins'])
+        self.assertEqual(1, other.stats['logins_adopted'])
+        self.assertEqual(first.get_session_state(), second.get_session_state())
+
+    def test_login_waits_for_lock(self):
+        garmin = self._create()
+        lock = Entity(
+            ds_util.client.key('GarminLoginLock', 'garmin', parent=self.service.key)
+        )
+        lock.update(
+            {
+                'owner': 'someoneelse',
+                'expires_at': datetime.datetime.now(datetime.timezone.utc)
+                + datetime.timedelta(minutes=1),
+            }
+        )
+        self.stored[lock.key] = lock
+
+        self.assertRaises(client.Error, garmin.login)
+        self.assertEqual(0, self.sessions.stats['logins'])
+        self.assertLess(0, self.sessions.stats['lock_waits'])
+
+        # An expired lock is taken over.
+        lock['expires_at'] -= datetime.timedelta(minutes=2)
+        garmin.login()
+        self.assertEqual(1, self.sessions.stats['logins'])
+        self.assertNotIn(lock.key, self.stored)
+
+    def test_lock_reads_uncached_session(self):
+        reads = []
+        self.fake.mocks['get'].side_effect = lambda key: (
+            reads.append((key, bool(self.fake.in_transaction))) or self.fake.get(key)
+        )
+
+        with self.sessions.login_lock(self.service.key):
+            pass
+
+        self.assertIn((self.service.key, True), reads)
+        self.assertNotIn((self.service.key, False), reads)
+
+    def test_api_calls_counted(self):
+        garmin = self._create()
+        garmin.login()
+        with mock.patch.object(garmin._session, 'get') as get_mock:
+            get_mock.return_value.status_code = 200
+            get_mock.return_value.json.return_value = {'dateWeightList': []}
+            with mock.patch('curlify.to_curl'):
+                garmin.get_body_comp('2020-09-01')
+                garmin.get_body_comp('2020-09-02')
+
+        self.assertEqual(1, self.sessions.stats['logins'])
+        self.assertEqual(2, self.sessions.stats['api_calls'])
+
+
+def _authenticate(garmin):
+    garmin._session.cookies.update({'SESSIONID': 'session-%s' % (id(garmin),)})
+    garmin._preferences = {'displayName': 'user'}
+    garmin.profile = {'displayName': 'user'}
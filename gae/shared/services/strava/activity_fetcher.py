@@ -0,0 +1,69 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import concurrent.futures
+import itertools
+import logging
+
+from shared.services.strava import rate_limit
+
+
+DEFAULT_MAX_WORKERS = 8
+
+
+class ActivityFetcher(object):
+    """Fetches detailed activities in parallel, within the rate budget.
+
+    fetch yields each activity as soon as it arrives, so callers can store
+    them while the rest are in flight. At most max_workers requests are in
+    flight, and each waits for a token from budget first.
+    """
+
+    def __init__(self, client, max_workers=DEFAULT_MAX_WORKERS, budget=None):
+        self.client = client
+        self.max_workers = max_workers
+        self.budget = budget if budget is not None else rate_limit.budget
+
+    def fetch(self, activity_ids):
+        """Yields detailed activities for activity_ids, in completion order.
+
+        The first failed fetch is raised, after cancelling those not started.
+        """
+        activity_ids = iter(activity_ids)
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_workers
+        ) as executor:
+            pending = {
+                executor.submit(self._fetch, activity_id)
+                for activity_id in itertools.islice(activity_ids, self.max_workers)
+            }
+            try:
+                while pending:
+                    done, pending = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    for future in done:
+                        yield future.result()
+                    pending |= {
+                        executor.submit(self._fetch, activity_id)
+                        for activity_id in itertools.islice(activity_ids, len(done))
+                    }
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def _fetch(self, activity_id):
+        self.budget.acquire()
+        logging.debug('Fetching activity: %s', activity_id)
+        return self.client.get_activity(activity_id)
@@ -18,6 +18,7 @@ import time
 
 from shared.config import config
 from shared.datastore.service import Service
+from shared.services.strava import rate_limit
 
 import stravalib
 from stravalib import exc
@@ -30,7 +31,7 @@ class ClientWrapper(object):
         self._service = service
         self._client = stravalib.client.Client(
             access_token=service['credentials']['access_token'],
-            rate_limiter=(lambda x=None: None),
+            rate_limiter=rate_limit.budget.update,
         )
 
     def ensure_access(self):
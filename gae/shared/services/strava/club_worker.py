@@ -52,7 +52,8 @@ class ClubWorker(object):
             ds_util.client.delete_multi(
                 activity.key for activity in activity_query.fetch()
             )
-            for activity in self.client.get_club_activities(club.id):
-                activity_entity = Activity.to_entity(activity, parent=club.key)
-                ds_util.client.put(activity_entity)
+            ds_util.client.put_multi(
+                Activity.to_entity(activity, parent=club.key)
+                for activity in self.client.get_club_activities(club.id)
+            )
         return club
@@ -0,0 +1,150 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Collapses bursts of Strava webhook events for the same object.
+
+The first event for an (owner, object_type, object_id) is stored as a pending
+SubscriptionEvent and queues a task to run once the window has passed. Events
+that arrive before the task runs are merged into the pending event instead of
+queueing tasks of their own. The task deletes the pending event once it has
+processed it, so the next event starts a new window, or requeues it with
+retry if it fails. Pending events are kept by a pending_util.PendingTasks.
+"""
+
+import collections
+import datetime
+import logging
+import threading
+
+from google.cloud.datastore.entity import Entity
+
+from shared import ds_util
+from shared import pending_util
+from shared import task_util
+from shared.datastore.subscription import SubscriptionEvent
+
+
+COALESCE_WINDOW = datetime.timedelta(seconds=30)
+
+# How long after a failure an event is processed again, and how many times.
+RETRY_DELAY = datetime.timedelta(minutes=5)
+_MAX_RETRIES = 5
+
+# A pending event this old has lost its task.
+_STALE_AFTER = datetime.timedelta(minutes=10)
+
+# Process-wide counts of received, coalesced, enqueued, processed, requeued,
+# retried and abandoned events.
+stats = collections.Counter()
+_stats_lock = threading.Lock()
+
+
+def coalesce(service_key, event, window=COALESCE_WINDOW):
+    """Merges event into its object's pending event, queueing it if new.
+
+    Returns the pending event.
+    """
+    _count('received')
+    key = ds_util.client.key(
+        'SubscriptionEvent',
+        SubscriptionEvent.hash_name(
+            event['owner_id'], event['object_type'], event['object_id']
+        ),
+        parent=service_key,
+    )
+
+    def update(pending, queue):
+        if pending is None:
+            merged = _copy(key, event)
+            merged['coalesced'] = 1
+            return merged
+        # A stale event is still merged, so a pending delete wins.
+        return _merge(pending, event)
+
+    merged, _ = _pending.add(key, update, window)
+    return merged
+
+
+def get(event_key):
+    """Returns the pending event, or None if it's already been processed."""
+    event = ds_util.client.get(event_key)
+    if event is not None:
+        logging.info(
+            'StravaEvent: Executing %s coalesced events: %s',
+            event.get('coalesced', 1),
+            event_key,
+        )
+    return event
+
+
+def done(event, window=COALESCE_WINDOW):
+    """Deletes event, once processed, unless more were merged into it since.
+
+    Those merged while it was processed are left pending, and queued again.
+    """
+    _pending.done(event, window)
+
+
+def retry(event):
+    """Queues event again, after RETRY_DELAY, once it has failed to process.
+
+    After _MAX_RETRIES, it's left pending instead, until the next event for its
+    object finds it stale and queues it again. Returns whether it was queued.
+    """
+    return _pending.retry(event)
+
+
+def log_stats():
+    logging.info('StravaEvent coalescer: %s', dict(stats))
+
+
+def _merge(pending, event):
+    """Returns pending updated with event. Deletes win over anything else."""
+    merged = _copy(pending.key, pending)
+    merged['coalesced'] = pending.get('coalesced', 1) + 1
+
+    pending_time = pending.get('event_time', 0)
+    event_time = event.get('event_time', 0)
+    latest, earliest = (
+        (event, pending) if event_time >= pending_time else (pending, event)
+    )
+
+    merged['event_time'] = latest.get('event_time')
+    merged['updates'] = dict(earliest.get('updates') or {})
+    merged['updates'].update(latest.get('updates') or {})
+    if 'delete' in (pending.get('aspect_type'), event.get('aspect_type')):
+        merged['aspect_type'] = 'delete'
+    else:
+        merged['aspect_type'] = latest.get('aspect_type')
+    return merged
+
+
+def _copy(key, event):
+    entity = Entity(key, exclude_from_indexes=tuple(event.exclude_from_indexes))
+    entity.update(event)
+    return entity
+
+
+def _count(stat):
+    with _stats_lock:
+        stats[stat] += 1
+
+
+def _enqueue(pending, delay):
+    task_util.process_coalesced_event(pending.key.parent, pending.key, delay)
+
+
+_pending = pending_util.PendingTasks(
+    'StravaEvent', _enqueue, _STALE_AFTER, RETRY_DELAY, _MAX_RETRIES, _count
+)
@@ -0,0 +1,138 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Budgets Strava API requests against the app's rate limits.
+
+Strava limits requests per app in two windows: each quarter hour and each UTC
+day. Every response reports the app's usage and limits in X-RateLimit-Usage and
+X-RateLimit-Limit headers, which are authoritative since usage is shared with
+every other instance.
+"""
+
+import datetime
+import logging
+import threading
+import time
+
+from stravalib import exc
+from stravalib.util.limiter import get_rates_from_response_headers
+
+
+# Strava's defaults, used until a response tells us the app's real limits.
+DEFAULT_SHORT_LIMIT = 100
+DEFAULT_LONG_LIMIT = 1000
+
+SHORT_WINDOW_SECONDS = 15 * 60
+LONG_WINDOW_SECONDS = 24 * 60 * 60
+
+# Longest acquire will block for the next window before giving up.
+DEFAULT_MAX_WAIT_SECONDS = 60
+
+
+class RateBudget(object):
+    """A token bucket per window, refilled when the window rolls over.
+
+    acquire takes a token from both windows before a request, and update,
+    installed as the client's rate_limiter, reconciles the buckets with the
+    usage Strava reports after each response.
+    """
+
+    def __init__(
+        self,
+        short_limit=DEFAULT_SHORT_LIMIT,
+        long_limit=DEFAULT_LONG_LIMIT,
+        max_wait_seconds=DEFAULT_MAX_WAIT_SECONDS,
+        clock=time.time,
+    ):
+        self.short_limit = short_limit
+        self.long_limit = long_limit
+        self.max_wait_seconds = max_wait_seconds
+        self._clock = clock
+
+        self._condition = threading.Condition()
+        self._short_window = None
+        self._long_window = None
+        self._short_usage = 0
+        self._long_usage = 0
+
+    @property
+    def remaining(self):
+        """Returns (short, long) tokens left in the current windows."""
+        with self._condition:
+            self._roll_windows()
+            return (
+                max(0, self.short_limit - self._short_usage),
+                max(0, self.long_limit - self._long_usage),
+            )
+
+    def acquire(self):
+        """Takes a token, waiting up to max_wait_seconds for one."""
+        deadline = self._clock() + self.max_wait_seconds
+        with self._condition:
+            while True:
+                self._roll_windows()
+                if self._long_usage >= self.long_limit:
+                    wait = self._seconds_until(LONG_WINDOW_SECONDS)
+                    raise exc.RateLimitExceeded(
+                        'Daily rate limit of %s exceeded' % (self.long_limit,),
+                        limit=self.long_limit,
+                        timeout=wait,
+                    )
+                if self._short_usage < self.short_limit:
+                    self._short_usage += 1
+                    self._long_usage += 1
+                    return
+
+                wait = self._seconds_until(SHORT_WINDOW_SECONDS)
+                if self._clock() + wait > deadline:
+                    raise exc.RateLimitExceeded(
+                        'Rate limit of %s exceeded' % (self.short_limit,),
+                        limit=self.short_limit,
+                        timeout=wait,
+                    )
+                logging.info('Strava rate limited; waiting %.0fs', wait)
+                self._condition.wait(wait)
+
+    def update(self, response_headers=None):
+        """Reconciles usage and limits with a response's headers."""
+        rates = get_rates_from_response_headers(response_headers or {})
+        if rates is None:
+            return
+        with self._condition:
+            self._roll_windows()
+            self.short_limit = rates.short_limit
+            self.long_limit = rates.long_limit
+            # Our own count can be ahead of Strava's by requests in flight.
+            self._short_usage = max(self._short_usage, rates.short_usage)
+            self._long_usage = max(self._long_usage, rates.long_usage)
+            self._condition.notify_all()
+
+    def _roll_windows(self):
+        now = self._clock()
+        short_window = int(now // SHORT_WINDOW_SECONDS)
+        if short_window != self._short_window:
+            self._short_window = short_window
+            self._short_usage = 0
+        long_window = datetime.datetime.utcfromtimestamp(now).date()
+        if long_window != self._long_window:
+            self._long_window = long_window
+            self._long_usage = 0
+
+    def _seconds_until(self, window_seconds):
+        now = self._clock()
+        return window_seconds - now % window_seconds
+
+
+# Shared by every Strava client in the process.
+budget = RateBudget()
@@ -0,0 +1,60 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+import unittest
+
+from shared.services.strava.activity_fetcher import ActivityFetcher
+from shared.services.strava.rate_limit import RateBudget
+
+
+class FakeClient(object):
+    def __init__(self, fail_id=None):
+        self.fail_id = fail_id
+        self.running = 0
+        self.max_running = 0
+        self._lock = threading.Lock()
+
+    def get_activity(self, activity_id):
+        with self._lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.01)
+        with self._lock:
+            self.running -= 1
+        if activity_id == self.fail_id:
+            raise ValueError(activity_id)
+        return {'id': activity_id}
+
+
+class ActivityFetcherTest(unittest.TestCase):
+    def test_fetches_in_parallel(self):
+        client = FakeClient()
+        budget = RateBudget(short_limit=100, long_limit=100)
+        fetcher = ActivityFetcher(client, max_workers=4, budget=budget)
+
+        activities = list(fetcher.fetch(range(20)))
+
+        self.assertCountEqual(range(20), [a['id'] for a in activities])
+        self.assertLessEqual(client.max_running, 4)
+        self.assertGreater(client.max_running, 1)
+        self.assertEqual((80, 80), budget.remaining)
+
+    def test_raises_failure(self):
+        fetcher = ActivityFetcher(
+            FakeClient(fail_id=3), max_workers=2, budget=RateBudget()
+        )
+        with self.assertRaises(ValueError):
+            list(fetcher.fetch(range(10)))
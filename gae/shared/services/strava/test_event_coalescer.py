@@ -0,0 +1,167 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import unittest
+from unittest import mock
+
+from shared import ds_util
+from shared import testing_util
+from shared.datastore.subscription import SubscriptionEvent
+from shared.services.strava import event_coalescer
+
+
+class EventCoalescerTest(unittest.TestCase):
+    def setUp(self):
+        self.service_key = ds_util.client.key('Service', 'strava')
+        self.stored = testing_util.fake_datastore(self).stored
+        patcher = mock.patch('shared.task_util.process_coalesced_event')
+        self.task_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _event(self, aspect_type, event_time, object_id=2120517859, updates=None):
+        return SubscriptionEvent.to_entity(
+            {
+                'aspect_type': aspect_type,
+                'event_time': event_time,
+                'object_id': object_id,
+                'object_type': 'activity',
+                'owner_id': 35056021,
+                'subscription_id': 133263,
+                'updates': updates or {},
+            },
+            parent=self.service_key,
+        )
+
+    def test_coalesces_updates(self):
+        first = event_coalescer.coalesce(self.service_key, self._event('create', 1))
+        event_coalescer.coalesce(
+            self.service_key, self._event('update', 3, updates={'title': 'New'})
+        )
+        event_coalescer.coalesce(
+            self.service_key, self._event('update', 2, updates={'title': 'Old'})
+        )
+        event_coalescer.coalesce(
+            self.service_key, self._event('create', 1, object_id=1)
+        )
+
+        self.assertEqual(2, self.task_mock.call_count)
+        self.task_mock.assert_any_call(
+            self.service_key, first.key, event_coalescer.COALESCE_WINDOW
+        )
+
+        event = event_coalescer.get(first.key)
+        self.assertEqual(3, event['coalesced'])
+        self.assertEqual('update', event['aspect_type'])
+        self.assertEqual(3, event['event_time'])
+        self.assertEqual({'title': 'New'}, event['updates'])
+        event_coalescer.done(event)
+        self.assertIsNone(event_coalescer.get(first.key))
+
+    def test_delete_wins(self):
+        event_coalescer.coalesce(self.service_key, self._event('update', 1))
+        event_coalescer.coalesce(self.service_key, self._event('delete', 2))
+        pending = event_coalescer.coalesce(self.service_key, self._event('update', 3))
+        self.assertEqual('delete', pending['aspect_type'])
+        self.task_mock.assert_called_once()
+
+    def test_new_window_after_done(self):
+        pending = event_coalescer.coalesce(self.service_key, self._event('update', 1))
+        event_coalescer.done(event_coalescer.get(pending.key))
+        event_coalescer.coalesce(self.service_key, self._event('update', 2))
+        self.assertEqual(2, self.task_mock.call_count)
+
+    def test_pending_until_done(self):
+        pending = event_coalescer.coalesce(self.service_key, self._event('update', 1))
+        # A retried task finds the event it failed to process.
+        self.assertIsNotNone(event_coalescer.get(pending.key))
+        self.assertIsNotNone(event_coalescer.get(pending.key))
+
+    def test_done_requeues_merged(self):
+        pending = event_coalescer.coalesce(self.service_key, self._event('update', 1))
+        event = event_coalescer.get(pending.key)
+        # Merged while event was being processed.
+        event_coalescer.coalesce(
+            self.service_key, self._event('update', 2, updates={'title': 'New'})
+        )
+        event_coalescer.done(event)
+
+        self.assertEqual(2, self.task_mock.call_count)
+        pending = event_coalescer.get(pending.key)
+        self.assertEqual({'title': 'New'}, pending['updates'])
+        event_coalescer.done(pending)
+        self.assertIsNone(event_coalescer.get(pending.key))
+
+    def test_requeues_stale_pending(self):
+        pending = event_coalescer.coalesce(self.service_key, self._event('update', 1))
+        self.stored[pending.key]['enqueued_at'] -= datetime.timedelta(hours=1)
+        event_coalescer.coalesce(self.service_key, self._event('update', 2))
+        self.assertEqual(2, self.task_mock.call_count)
+
+    def test_delete_wins_over_stale(self):
+        pending = event_coalescer.coalesce(self.service_key, self._event('delete', 1))
+        self.stored[pending.key]['enqueued_at'] -= datetime.timedelta(hours=1)
+        pending = event_coalescer.coalesce(self.service_key, self._event('update', 2))
+        self.assertEqual('delete', pending['aspect_type'])
+        self.assertEqual(2, pending['coalesced'])
+        self.assertEqual(2, self.task_mock.call_count)
+
+    def test_retry_requeues_failed(self):
+        pending = event_coalescer.coalesce(self.service_key, self._event('update', 1))
+        event = event_coalescer.get(pending.key)
+        # Merged while event was failing to process.
+        event_coalescer.coalesce(self.service_key, self._event('update', 2))
+
+        self.assertTrue(event_coalescer.retry(event))
+        self.task_mock.assert_called_with(
+            self.service_key, pending.key, event_coalescer.RETRY_DELAY
+        )
+        event = event_coalescer.get(pending.key)
+        self.assertEqual(2, event['coalesced'])
+        self.assertEqual(1, event['retries'])
+
+        event_coalescer.done(event)
+        self.assertIsNone(event_coalescer.get(pending.key))
+        self.assertEqual(2, self.task_mock.call_count)
+
+    def test_retry_gives_up(self):
+        pending = event_coalescer.coalesce(self.service_key, self._event('update', 1))
+        for _ in range(event_coalescer._MAX_RETRIES):
+            self.assertTrue(event_coalescer.retry(pending))
+        self.assertFalse(event_coalescer.retry(pending))
+        self.assertEqual(1 + event_coalescer._MAX_RETRIES, self.task_mock.call_count)
+
+        # Left pending, for the next event to queue once it's stale.
+        self.stored[pending.key]['enqueued_at'] -= datetime.timedelta(hours=1)
+        pending = event_coalescer.coalesce(self.service_key, self._event('update', 2))
+        self.assertEqual(0, pending['retries'])
+        self.assertEqual(2 + event_coalescer._MAX_RETRIES, self.task_mock.call_count)
+
+    def test_failed_enqueue_requeued_by_next(self):
+        self.task_mock.side_effect = Exception('Failed')
+        self.assertRaises(
+            Exception,
+            event_coalescer.coalesce,
+            self.service_key,
+            self._event('update', 1),
+        )
+        (pending,) = self.stored.values()
+        self.assertIsNone(pending['enqueued_at'])
+
+        # Strava's retry queues it, rather than merging into it.
+        self.task_mock.side_effect = None
+        pending = event_coalescer.coalesce(self.service_key, self._event('update', 1))
+        self.assertEqual(2, self.task_mock.call_count)
+        self.assertEqual(2, pending['coalesced'])
+        self.assertIsNotNone(self.stored[pending.key]['enqueued_at'])
@@ -0,0 +1,70 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from stravalib import exc
+
+from shared.services.strava.rate_limit import RateBudget
+
+
+class FakeClock(object):
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class RateBudgetTest(unittest.TestCase):
+    def setUp(self):
+        # 2021-05-01T16:00:00Z, the start of a short window.
+        self.clock = FakeClock(1619884800)
+
+    def test_acquire_within_limits(self):
+        budget = RateBudget(short_limit=3, long_limit=10, clock=self.clock)
+        for _ in range(3):
+            budget.acquire()
+        self.assertEqual((0, 7), budget.remaining)
+
+    def test_short_window_refills(self):
+        budget = RateBudget(
+            short_limit=1, long_limit=10, max_wait_seconds=0, clock=self.clock
+        )
+        budget.acquire()
+        self.assertRaises(exc.RateLimitExceeded, budget.acquire)
+
+        self.clock.now += 15 * 60
+        budget.acquire()
+        self.assertEqual((0, 8), budget.remaining)
+
+    def test_daily_limit(self):
+        budget = RateBudget(short_limit=10, long_limit=1, clock=self.clock)
+        budget.acquire()
+        self.clock.now += 15 * 60
+        self.assertRaises(exc.RateLimitExceeded, budget.acquire)
+
+    def test_update_from_headers(self):
+        budget = RateBudget(clock=self.clock)
+        budget.update(
+            {'X-RateLimit-Usage': '595,2000', 'X-RateLimit-Limit': '600,30000'}
+        )
+        self.assertEqual((5, 28000), budget.remaining)
+
+        # Never trust headers that report less than we've already used.
+        budget.update({'X-RateLimit-Usage': '0,0', 'X-RateLimit-Limit': '600,30000'})
+        self.assertEqual((5, 28000), budget.remaining)
+
+        budget.update({})
+        self.assertEqual((5, 28000), budget.remaining)
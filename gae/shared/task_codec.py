@@ -0,0 +1,94 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Encodes task params Entities into versioned task payloads.
+
+A payload is a version byte followed by the serialized Entity protobuf, which
+is zlib compressed when that saves space. Payloads from before versioning are
+a bare protobuf. A serialized Entity never starts with a byte below 0x08 (it
+would be field number 0), so versions 1-7 can't be mistaken for one.
+
+The api and backend deploy separately, and workers that predate versioning
+can't decode versioned payloads, so versioning rolls out in two steps:
+
+1. Deploy every service with ENCODE_VERSION = VERSION_LEGACY, so all workers
+   can decode every version while still sending bare protobufs.
+2. Once no older workers are left, set ENCODE_VERSION = VERSION_PROTO_ZLIB and
+   deploy again.
+"""
+
+import zlib
+
+from google.cloud.datastore import helpers
+from google.cloud.datastore_v1.types import entity as entity_pb2
+
+
+VERSION_LEGACY = 0
+VERSION_PROTO = 1
+VERSION_PROTO_ZLIB = 2
+
+_MAX_VERSION = 7
+
+# Version written by encode. Workers decode every version; this stays
+# VERSION_LEGACY until they're all deployed, per the rollout above.
+ENCODE_VERSION = VERSION_LEGACY
+
+# Payloads smaller than this aren't worth compressing.
+COMPRESS_MIN_BYTES = 512
+
+
+def serialize_entity(entity):
+    """Converts an Entity object to a serialized proto string."""
+    if entity is None:
+        return None
+    return helpers.entity_to_protobuf(entity)._pb.SerializeToString()
+
+
+def deserialize_entity(pb_bytes):
+    """Converts a serialized proto string to an Entity object."""
+    if pb_bytes is None:
+        return None
+    entity = entity_pb2.Entity()
+    entity._pb.ParseFromString(pb_bytes)
+    return helpers.entity_from_protobuf(entity._pb)
+
+
+def encode(entity, version=None):
+    """Returns the payload bytes for entity."""
+    if entity is None:
+        return None
+    version = ENCODE_VERSION if version is None else version
+    pb_bytes = serialize_entity(entity)
+    if version == VERSION_LEGACY:
+        return pb_bytes
+    if version == VERSION_PROTO_ZLIB and len(pb_bytes) >= COMPRESS_MIN_BYTES:
+        compressed = zlib.compress(pb_bytes)
+        if len(compressed) < len(pb_bytes):
+            return bytes([VERSION_PROTO_ZLIB]) + compressed
+    return bytes([VERSION_PROTO]) + pb_bytes
+
+
+def decode(payload):
+    """Returns the Entity encoded in payload, from any version."""
+    if payload is None:
+        return None
+    if not payload or payload[0] > _MAX_VERSION:
+        return deserialize_entity(payload)
+
+    version = payload[0]
+    if version == VERSION_PROTO:
+        return deserialize_entity(payload[1:])
+    elif version == VERSION_PROTO_ZLIB:
+        return deserialize_entity(zlib.decompress(payload[1:]))
+    raise ValueError('Unknown task payload version: %s' % (version,))
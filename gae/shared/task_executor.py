@@ -0,0 +1,259 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Runs cloud tasks in process, for dev and tests.
+
+Install an executor with task_util.set_executor, then tasks queued through
+task_util are posted to the matching Flask app's test client from a pool of
+worker threads rather than sent to Cloud Tasks or back over http.
+"""
+
+import collections
+import contextlib
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from google.api_core.exceptions import AlreadyExists, ResourceExhausted
+
+
+# Worker threads per queue; see queues.sh for the queue names.
+DEFAULT_QUEUE_CONCURRENCY = {
+    'default': 1,
+    'events': 4,
+    'slack': 2,
+    'notifications': 1,
+    'backfill': 1,
+    'gmail': 2,
+    'livetrack': 2,
+}
+
+
+class InProcessTaskExecutor(object):
+    """Dispatches tasks to in-process Flask apps.
+
+    Args:
+        apps: {service: flask.Flask}, the apps that serve each
+            app_engine_routing service, e.g., {'backend': main.app}.
+        queue_concurrency: {queue: int}, overrides DEFAULT_QUEUE_CONCURRENCY.
+        max_queue_size: Max pending tasks per queue, 0 for unbounded. Once
+            full, submit raises ResourceExhausted.
+    """
+
+    def __init__(self, apps, queue_concurrency=None, max_queue_size=0):
+        self.apps = apps
+        self.queue_concurrency = dict(DEFAULT_QUEUE_CONCURRENCY)
+        self.queue_concurrency.update(queue_concurrency or {})
+        self.max_queue_size = max_queue_size
+        self.stats = collections.Counter()
+
+        self._lock = threading.Lock()
+        self._queues = {}
+        self._task_names = set()
+        self._local = threading.local()
+
+    def submit(self, parent, task, service):
+        """Accepts a task, like CloudTasksClient.create_task."""
+        name = task.get('name')
+        with self._lock:
+            if name is not None:
+                if name in self._task_names:
+                    self.stats['deduped'] += 1
+                    raise AlreadyExists('Task already exists: %s' % (name,))
+                self._task_names.add(name)
+
+        held = getattr(self._local, 'held', None)
+        if held is not None:
+            held.append((parent, task, service))
+            return task
+        try:
+            self._enqueue(parent, task, service)
+        except BaseException:
+            # It wasn't queued, so a retry can use its name.
+            self._forget([task])
+            raise
+        return task
+
+    @contextlib.contextmanager
+    def deferred(self):
+        """Holds tasks submitted on this thread until the context exits.
+
+        Tasks are dropped if the context raises, so tasks queued inside a
+        transaction only run once it commits. A TaskBatch flushed inside the
+        context submits on this thread, so its tasks are held too.
+        """
+        if getattr(self._local, 'held', None) is not None:
+            yield
+            return
+        held = self._local.held = []
+        try:
+            yield
+        except BaseException:
+            # Forget the dropped tasks' names, so a retry can queue them.
+            self._forget(task for _, task, _ in held)
+            raise
+        finally:
+            self._local.held = None
+        for i, (parent, task, service) in enumerate(held):
+            try:
+                self._enqueue(parent, task, service)
+            except BaseException:
+                self._forget(task for _, task, _ in held[i:])
+                raise
+
+    def join(self):
+        """Blocks until every queue is idle, including tasks they enqueue."""
+        while True:
+            with self._lock:
+                queues = list(self._queues.values())
+            for queue in queues:
+                queue.join()
+            with self._lock:
+                queues = list(self._queues.values())
+            if all(queue.idle() for queue in queues):
+                return
+
+    def shutdown(self):
+        with self._lock:
+            queues = list(self._queues.values())
+            self._queues = {}
+        for queue in queues:
+            queue.close()
+
+    def _enqueue(self, parent, task, service):
+        queue_name = parent.rsplit('/', 1)[-1]
+        with self._lock:
+            queue = self._queues.get(queue_name)
+            if queue is None:
+                queue = _TaskQueue(
+                    queue_name,
+                    self.queue_concurrency.get(queue_name, 1),
+                    self.max_queue_size,
+                    self._run,
+                )
+                self._queues[queue_name] = queue
+
+        eta = time.time()
+        if task.get('schedule_time') is not None:
+            eta = task['schedule_time'].ToMicroseconds() / 1000000
+        queue.put(eta, (queue_name, task, service))
+        self._count('queued')
+
+    def _forget(self, tasks):
+        with self._lock:
+            self._task_names.difference_update(
+                task['name'] for task in tasks if task.get('name')
+            )
+
+    def _run(self, item):
+        queue_name, task, service = item
+        request = task['app_engine_http_request']
+        app = self.apps.get(service)
+        if app is None:
+            logging.error('No app for service %s: %s', service, request['relative_uri'])
+            self._count('failed')
+            return
+
+        headers = {'X-AppEngine-QueueName': queue_name}
+        if task.get('name'):
+            headers['X-AppEngine-TaskName'] = task['name'].rsplit('/', 1)[-1]
+        try:
+            response = app.test_client().post(
+                request['relative_uri'], data=request.get('body'), headers=headers
+            )
+        except Exception:
+            logging.exception('Task failed: %s', request['relative_uri'])
+            self._count('failed')
+            return
+        logging.info(
+            'Executed task: %s response: %s', request['relative_uri'], response.status
+        )
+        self._count('executed' if response.status_code < 300 else 'failed')
+
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+
+class _TaskQueue(object):
+    """A schedule-time ordered queue drained by a fixed set of threads."""
+
+    def __init__(self, name, concurrency, max_size, run):
+        self.name = name
+        self._max_size = max_size
+        self._run = run
+
+        self._heap = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._unfinished = 0
+        self._closed = False
+
+        self._workers = [
+            threading.Thread(target=self._work, name='%s-%s' % (name, i), daemon=True)
+            for i in range(max(1, concurrency))
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def put(self, eta, item):
+        with self._condition:
+            if self._max_size and len(self._heap) >= self._max_size:
+                raise ResourceExhausted('Queue is full: %s' % (self.name,))
+            heapq.heappush(self._heap, (eta, next(self._sequence), item))
+            self._unfinished += 1
+            self._condition.notify_all()
+
+    def idle(self):
+        with self._condition:
+            return self._unfinished == 0
+
+    def join(self):
+        with self._condition:
+            while self._unfinished:
+                self._condition.wait()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        for worker in self._workers:
+            worker.join()
+
+    def _next(self):
+        with self._condition:
+            while not self._closed:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                delay = self._heap[0][0] - time.time()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                return heapq.heappop(self._heap)[2]
+            return None
+
+    def _work(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            try:
+                self._run(item)
+            finally:
+                with self._condition:
+                    self._unfinished -= 1
+                    self._condition.notify_all()
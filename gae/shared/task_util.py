@@ -14,22 +14,21 @@
 
 """Helpers for the cloud tasks queue."""
 
+import concurrent.futures
 import datetime
 import logging
+import threading
 
 import requests
 
 from google.cloud import tasks_v2
-from google.cloud.datastore import helpers
 from google.cloud.datastore.entity import Entity
 from google.cloud.datastore.key import Key
-from google.cloud.datastore_v1.types import entity as entity_pb2
-
-# from google.cloud.datastore_v1.proto import entity_pb2
-# from google.cloud.proto.datastore.v1 import entity_pb2
 from google.protobuf.timestamp_pb2 import Timestamp
 
 from shared import ds_util
+from shared import hash_util
+from shared import task_codec
 from shared.config import config
 from shared.datastore.service import Service
 
@@ -57,21 +56,15 @@ _livetrack_parent = _client.queue_path(
     config.project_id, config.tasks_location, 'livetrack'
 )
 
+# Upper bound on concurrent create_task calls made by a TaskBatch.
+_BATCH_MAX_WORKERS = 10
 
-def _serialize_entity(entity):
-    """Converts an Entity object to a serialized proto string."""
-    if entity is None:
-        return None
-    return helpers.entity_to_protobuf(entity)._pb.SerializeToString()
-
+# Holds the TaskBatch (if any) that _queue_task should defer tasks to.
+_batch_local = threading.local()
 
-def _deserialize_entity(pb_bytes):
-    """Converts a serialized proto string to an Entity object."""
-    if pb_bytes is None:
-        return None
-    entity = entity_pb2.Entity()
-    entity._pb.ParseFromString(pb_bytes)
-    return helpers.entity_from_protobuf(entity._pb)
+# When set, tasks are handed to this executor rather than Cloud Tasks or the
+# dev http servers. See set_executor.
+_executor = None
 
 
 def _queue_task(
@@ -102,24 +95,38 @@ def _queue_task(
         timestamp.FromDatetime(future_time)
         task['schedule_time'] = timestamp
 
-    converted_payload = None
     if entity is not None:
         # The API expects a payload of type bytes.
-        converted_payload = _serialize_entity(entity)
+        task['app_engine_http_request']['body'] = task_codec.encode(entity)
+
+    batch = getattr(_batch_local, 'batch', None)
+    if batch is not None:
+        batch.add(parent, task, service)
+        return None
+    return _create_task(parent, task, service)
 
-        # Add the payload to the request.
-        task['app_engine_http_request']['body'] = converted_payload
 
-    if config.is_dev:
-        logging.debug(
-            'Executing task for dev: %s',
-            task['app_engine_http_request']['relative_uri'],
+def set_executor(executor):
+    """Routes tasks to executor, e.g., a task_executor.InProcessTaskExecutor.
+
+    Pass None to go back to Cloud Tasks (or http self-posting, in dev).
+    """
+    global _executor
+    _executor = executor
+
+
+def _create_task(parent, task, service):
+    relative_uri = task['app_engine_http_request']['relative_uri']
+    if _executor is not None:
+        logging.debug('Submitting task to executor: %s', relative_uri)
+        return _executor.submit(parent, task, service)
+    elif config.is_dev:
+        logging.debug('Executing task for dev: %s', relative_uri)
+        return _post_task_for_dev(
+            task, service, relative_uri, task['app_engine_http_request'].get('body')
         )
-        return _post_task_for_dev(task, service, relative_uri, converted_payload)
     else:
-        logging.debug(
-            'Queueing task: %s', task['app_engine_http_request']['relative_uri']
-        )
+        logging.debug('Queueing task: %s', relative_uri)
         return _client.create_task(request={'parent': parent, 'task': task})
 
 
@@ -137,6 +144,84 @@ def _post_task_for_dev(task, service, relative_uri, converted_payload):
     return response
 
 
+class TaskBatch(object):
+    """Defers tasks queued within its context and creates them together.
+
+    Usage:
+        with task_util.TaskBatch():
+            for service in services:
+                task_util.sync_service(service)
+
+    On a clean exit, the collected tasks are created in parallel, at most
+    max_workers at a time, sharing the module's CloudTasksClient channel. If
+    any task fails to be created, the first error is raised once every other
+    task has been attempted. A TaskBatch entered while another is active on
+    the same thread joins the outer batch.
+    """
+
+    def __init__(self, max_workers=_BATCH_MAX_WORKERS):
+        self.max_workers = max_workers
+        self.tasks = []
+        self._outermost = False
+
+    def __enter__(self):
+        if getattr(_batch_local, 'batch', None) is None:
+            _batch_local.batch = self
+            self._outermost = True
+        return _batch_local.batch
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self._outermost:
+            return False
+        _batch_local.batch = None
+        self._outermost = False
+        if exc_type is None:
+            self.flush()
+        return False
+
+    def add(self, parent, task, service):
+        self.tasks.append((parent, task, service))
+
+    def flush(self):
+        """Creates all pending tasks, returning their results in order."""
+        tasks, self.tasks = self.tasks, []
+        if not tasks:
+            return []
+
+        logging.debug('TaskBatch: Creating %s tasks', len(tasks))
+        if _executor is not None:
+            # Submitting in process is cheap, and must happen on this thread
+            # for the executor to hold tasks deferred until a commit.
+            futures = [_run_now(_create_task, *task) for task in tasks]
+        else:
+            max_workers = min(self.max_workers, len(tasks))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+                futures = [pool.submit(_create_task, *task) for task in tasks]
+
+        error = None
+        for (parent, task, service), future in zip(tasks, futures):
+            if future.exception() is not None:
+                logging.error(
+                    'TaskBatch: Failed to create: %s: %s',
+                    task['app_engine_http_request']['relative_uri'],
+                    future.exception(),
+                )
+                error = error or future.exception()
+        if error is not None:
+            raise error
+        return [future.result() for future in futures]
+
+
+def _run_now(fn, *args):
+    """Calls fn, returning a finished future of its result or exception."""
+    future = concurrent.futures.Future()
+    try:
+        future.set_result(fn(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
 def _params_entity(**kwargs):
     params_entity = Entity(ds_util.client.key('TaskParams'))
     params_entity.update(**kwargs)
@@ -145,7 +230,7 @@ def _params_entity(**kwargs):
 
 def task_body_for_test(**kwargs):
     params_entity = _params_entity(**kwargs)
-    return _serialize_entity(params_entity)
+    return task_codec.encode(params_entity)
 
 
 def sync_club(club_id):
@@ -157,45 +242,53 @@ def sync_club(club_id):
     )
 
 
-def sync_service(service, force=False):
-    sync_services([service], force=force)
+def sync_service(service, force=False, deep=False):
+    sync_services([service], force=force, deep=deep)
 
 
-def sync_services(services, force=False):
+def sync_services(services, force=False, deep=False):
     def do():
-        for service in services:
-            if service['sync_state'].get('syncing') and force:
-                logging.debug('Forcing sync finished: %s', service.key)
-                Service.set_sync_finished(service, error='Forced sync')
-
-            if service['sync_state'].get('syncing'):
-                logging.debug(
-                    'Not enqueuing sync for %s; already started.', service.key
-                )
-                continue
-            Service.set_sync_enqueued(service)
-            task = {
-                'entity': _params_entity(service_key=service.key),
-                'relative_uri': '/services/%s/tasks/sync' % (service.key.name,),
-                'service': 'backend',
-            }
-            _queue_task(**task)
-            logging.debug('Added: %s', task)
+        with TaskBatch():
+            for service in services:
+                if service['sync_state'].get('syncing') and force:
+                    logging.debug('Forcing sync finished: %s', service.key)
+                    Service.set_sync_finished(service, error='Forced sync')
+
+                if service['sync_state'].get('syncing'):
+                    logging.debug(
+                        'Not enqueuing sync for %s; already started.', service.key
+                    )
+                    continue
+                Service.set_sync_enqueued(service)
+                task = {
+                    'entity': _params_entity(
+                        service_key=service.key, force=force, deep=deep
+                    ),
+                    'relative_uri': '/services/%s/tasks/sync' % (service.key.name,),
+                    'service': 'backend',
+                }
+                _queue_task(**task)
+                logging.debug('Added: %s', task)
 
     _maybe_transact(do)
 
 
 def get_payload(request):
     """Returns an Entity with the task's params."""
-    return _deserialize_entity(request.get_data())
+    return task_codec.decode(request.get_data())
 
 
 def _maybe_transact(fn, *args, **kwargs):
     # We have to fn this "fn" nonsense, because when on dev we fake tasks by
     # just triggering them via http, and the transaction hasn't written the
     # values yet, so the other server can't read them if they get processed
-    # before the transaction completes.
-    if config.is_dev:
+    # before the transaction completes. An executor can instead hold the tasks
+    # until the transaction commits.
+    if _executor is not None:
+        with _executor.deferred():
+            with ds_util.client.transaction():
+                fn(*args, **kwargs)
+    elif config.is_dev:
         fn(*args, **kwargs)
     else:
         with ds_util.client.transaction():
@@ -213,6 +306,28 @@ def process_event(service_key: Key, event):
     )
 
 
+def process_coalesced_event(
+    service_key: Key, event_key: Key, delay_timedelta: datetime.timedelta
+):
+    """Processes a pending event, once delay_timedelta has let others merge."""
+    return _queue_task(
+        entity=_params_entity(event_key=event_key),
+        relative_uri='/services/%s/tasks/event' % (service_key.name,),
+        service='backend',
+        parent=_events_parent,
+        delay_timedelta=delay_timedelta,
+    )
+
+
+def strava_tasks_athlete_fanout(service_key: Key):
+    return _queue_task(
+        entity=_params_entity(service_key=service_key),
+        relative_uri='/services/strava/tasks/athlete_fanout',
+        service='backend',
+        parent=_events_parent,
+    )
+
+
 def slack_tasks_event(event: Entity):
     return _queue_task(
         name=event.key.name,
@@ -241,6 +356,17 @@ def xsync_tasks_measure(user_key, measure):
     )
 
 
+def xsync_tasks_trainerroad(user_key: Key, delay_timedelta: datetime.timedelta):
+    """Writes the latest pending weight, once delay_timedelta has let others in."""
+    return _queue_task(
+        entity=_params_entity(user_key=user_key),
+        relative_uri='/xsync/tasks/trainerroad',
+        service='backend',
+        parent=_events_parent,
+        delay_timedelta=delay_timedelta,
+    )
+
+
 def xsync_tasks_backfill(
     source_key: Key, dest_key: Key, start: datetime.datetime, end: datetime.datetime
 ):
@@ -256,7 +382,7 @@ def xsync_tasks_backfill(
 
 def google_tasks_rides(user: Entity, data: dict):
     return _queue_task(
-        entity=_params_entity(user=user, data=data),
+        entity=_params_entity(user_key=user.key, data=data),
         relative_uri='/services/google/tasks/rides',
         service='backend',
         parent=_gmail_parent,
@@ -272,9 +398,33 @@ def garmin_tasks_livetrack(url, publish: bool = False):
     )
 
 
+def garmin_tasks_livetrack_poll(url, poll, delay_timedelta=None):
+    """Polls a LiveTrack; named by poll, so a retried poll isn't doubled."""
+    return _queue_task(
+        name='livetrack-poll-%s-%s' % (hash_util.hash_name(url), poll),
+        entity=_params_entity(url=url),
+        relative_uri='/services/garmin/tasks/livetrack_poll',
+        service='backend',
+        parent=_livetrack_parent,
+        delay_timedelta=delay_timedelta,
+    )
+
+
+def slack_tasks_unfurl_refresh(url, fetched_at):
+    """Crawls an unfurled page again; named by the stale crawl it replaces."""
+    return _queue_task(
+        name='unfurl-refresh-%s' % (hash_util.hash_name(url, fetched_at.isoformat()),),
+        entity=_params_entity(url=url),
+        relative_uri='/services/slack/tasks/unfurl_refresh',
+        service='backend',
+        parent=_slack_events_parent,
+    )
+
+
 def slack_tasks_livetrack(track: Entity):
+    """Posts a stored track; the task fetches it by key."""
     return _queue_task(
-        entity=_params_entity(track=track),
+        entity=_params_entity(track_key=track.key),
         relative_uri='/services/slack/tasks/livetrack',
         service='backend',
         parent=_livetrack_parent,
@@ -0,0 +1,258 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import unittest
+from unittest import mock
+
+from google.api_core.exceptions import Conflict
+from google.cloud.datastore.entity import Entity
+
+from shared import ds_util
+from shared import testing_util
+
+
+def _entity(kind, id_or_name, **kwargs):
+    entity = Entity(ds_util.client.key(kind, id_or_name))
+    entity.update(kwargs)
+    return entity
+
+
+class CachingClientTest(unittest.TestCase):
+    def setUp(self):
+        self.datastore = mock.Mock()
+        self.datastore.current_transaction = None
+        self.entities = {}
+        self.datastore.get.side_effect = lambda key: self.entities.get(key)
+        self.datastore.get_multi.side_effect = lambda keys: [
+            self.entities[k] for k in keys if k in self.entities
+        ]
+        self.client = ds_util.CachingClient(
+            self.datastore, process_cached_kinds={'Bot': 60}
+        )
+        self.client.begin_scope()
+
+    def tearDown(self):
+        self.client.end_scope()
+
+    def test_memoizes_within_scope(self):
+        user = _entity('User', 'someuser', name='Some User')
+        self.entities[user.key] = user
+
+        self.assertEqual('Some User', self.client.get(user.key)['name'])
+        self.assertEqual('Some User', self.client.get(user.key)['name'])
+        self.assertEqual(1, self.datastore.get.call_count)
+        self.assertEqual(1, self.client.stats['hits'])
+        self.assertEqual(1, self.client.stats['misses'])
+
+        stats = self.client.end_scope()
+        self.assertEqual(1, stats['hits'])
+        self.client.get(user.key)
+        self.client.get(user.key)
+        self.assertEqual(3, self.datastore.get.call_count)
+
+    def test_memoizes_missing(self):
+        key = ds_util.client.key('User', 'nobody')
+        self.assertIsNone(self.client.get(key))
+        self.assertIsNone(self.client.get(key))
+        self.assertEqual(1, self.datastore.get.call_count)
+
+    def test_returns_copies(self):
+        user = _entity('User', 'someuser', name='Some User')
+        self.entities[user.key] = user
+
+        self.client.get(user.key)['name'] = 'Changed'
+        self.assertEqual('Some User', self.client.get(user.key)['name'])
+
+    def test_get_multi(self):
+        user = _entity('User', 'someuser')
+        other = _entity('User', 'other')
+        missing = ds_util.client.key('User', 'nobody')
+        self.entities[user.key] = user
+        self.entities[other.key] = other
+
+        self.client.get(user.key)
+        result = self.client.get_multi([user.key, missing, other.key])
+        self.assertEqual([user.key, other.key], [e.key for e in result])
+        self.datastore.get_multi.assert_called_once_with([missing, other.key])
+
+    def test_writes_invalidate(self):
+        user = _entity('User', 'someuser', name='Some User')
+        self.entities[user.key] = user
+        self.client.get(user.key)
+
+        self.client.put(user)
+        self.client.get(user.key)
+        self.client.delete_multi([user.key])
+        self.client.get(user.key)
+        self.assertEqual(3, self.datastore.get.call_count)
+
+    def test_transaction_reads_datastore(self):
+        user = _entity('User', 'someuser')
+        self.entities[user.key] = user
+        self.client.get(user.key)
+
+        self.datastore.current_transaction = mock.Mock()
+        self.client.get(user.key)
+        self.assertEqual(2, self.datastore.get.call_count)
+
+    def test_process_cache(self):
+        bot = _entity('Bot', 'default', name='Bot')
+        self.entities[bot.key] = bot
+        self.client.get(bot.key)
+
+        self.client.end_scope()
+        self.client.begin_scope()
+        self.assertEqual('Bot', self.client.get(bot.key)['name'])
+        self.assertEqual(1, self.datastore.get.call_count)
+        self.assertEqual(1, self.client.stats['process_hits'])
+
+        self.client.put(bot)
+        self.client.end_scope()
+        self.client.begin_scope()
+        self.client.get(bot.key)
+        self.assertEqual(2, self.datastore.get.call_count)
+
+    def test_process_cache_skips_missing(self):
+        bot = _entity('Bot', 'default', name='Bot')
+        self.assertIsNone(self.client.get(bot.key))
+        self.assertIsNone(self.client.get(bot.key))
+        self.assertEqual(1, self.datastore.get.call_count)
+
+        # Created by another process, so this client never invalidated it.
+        self.entities[bot.key] = bot
+        self.client.end_scope()
+        self.client.begin_scope()
+        self.assertEqual('Bot', self.client.get(bot.key)['name'])
+        self.assertEqual(2, self.datastore.get.call_count)
+
+    @mock.patch('shared.cache_util.time.monotonic')
+    def test_process_cache_expires(self, monotonic_mock):
+        monotonic_mock.return_value = 1000
+        bot = _entity('Bot', 'default')
+        self.entities[bot.key] = bot
+        self.client.get(bot.key)
+
+        monotonic_mock.return_value = 1061
+        self.client.end_scope()
+        self.client.begin_scope()
+        self.client.get(bot.key)
+        self.assertEqual(2, self.datastore.get.call_count)
+
+    def test_delegates(self):
+        self.client.query(kind='User')
+        self.datastore.query.assert_called_once_with(kind='User')
+
+
+class TransactTest(unittest.TestCase):
+    def setUp(self):
+        self.datastore = testing_util.fake_datastore(self)
+
+    def test_retries_conflicts(self):
+        fn = mock.Mock(side_effect=[Conflict('Busy'), 'done'], __name__='fn')
+        self.assertEqual('done', ds_util.transact(fn, 1))
+        self.assertEqual([mock.call(1), mock.call(1)], fn.call_args_list)
+        self.assertEqual(2, self.datastore.mocks['transaction'].call_count)
+
+    def test_raises_last_conflict(self):
+        fn = mock.Mock(side_effect=Conflict('Busy'), __name__='fn')
+        self.assertRaises(Conflict, ds_util.transact, fn)
+        self.assertEqual(ds_util.TRANSACTION_ATTEMPTS, fn.call_count)
+
+
+class DatesTest(unittest.TestCase):
+    def test_utc(self):
+        naive = datetime.datetime(2021, 2, 3, 4, 5)
+        aware = naive.replace(tzinfo=datetime.timezone.utc)
+        self.assertEqual(aware, ds_util.utc(naive))
+        self.assertEqual(aware.tzinfo, ds_util.utc(naive).tzinfo)
+        self.assertIsNone(ds_util.utc(None))
+
+    def test_utc_naive(self):
+        naive = datetime.datetime(2021, 2, 3, 4, 5)
+        pacific = datetime.timezone(datetime.timedelta(hours=-8))
+        self.assertEqual(naive, ds_util.utc_naive(naive))
+        self.assertEqual(
+            naive,
+            ds_util.utc_naive(datetime.datetime(2021, 2, 2, 20, 5, tzinfo=pacific)),
+        )
+        self.assertIsNone(ds_util.utc_naive(naive.replace(tzinfo=pacific)).tzinfo)
+
+    def test_micros(self):
+        date = datetime.datetime(2021, 2, 3, 4, 5, 6, 7, tzinfo=datetime.timezone.utc)
+        micros = ds_util.to_micros(date)
+        self.assertEqual(int(date.timestamp()) * 1000000 + 7, micros)
+        self.assertEqual(micros, ds_util.to_micros(date.replace(tzinfo=None)))
+        self.assertEqual(date, ds_util.from_micros(micros))
+
+
+class BatchWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.datastore = mock.Mock()
+        self.datastore.current_transaction = None
+
+    def test_flushes_on_exit(self):
+        with ds_util.BatchWriter(self.datastore) as writer:
+            writer.put(_entity('Activity', 1))
+            writer.put(_entity('Activity', 2))
+            self.datastore.put_multi.assert_not_called()
+        self.datastore.put_multi.assert_called_once()
+        self.assertEqual(
+            [1, 2], [e.key.id for e in self.datastore.put_multi.call_args[0][0]]
+        )
+
+    def test_flushes_on_max_entities(self):
+        with ds_util.BatchWriter(self.datastore, max_entities=2) as writer:
+            writer.put_multi(_entity('Activity', i) for i in range(5))
+            self.assertEqual(2, self.datastore.put_multi.call_count)
+        self.assertEqual(3, self.datastore.put_multi.call_count)
+        self.assertEqual(3, writer.stats['flushes'])
+
+    def test_flushes_on_max_bytes(self):
+        with ds_util.BatchWriter(self.datastore, max_bytes=1000) as writer:
+            for i in range(3):
+                writer.put(_entity('Activity', i, description='x' * 400))
+        self.assertEqual(
+            [2, 1], [len(c[0][0]) for c in self.datastore.put_multi.call_args_list]
+        )
+
+    def test_replaces_buffered_key(self):
+        with ds_util.BatchWriter(self.datastore) as writer:
+            writer.put(_entity('Activity', 1, name='Old'))
+            writer.put(_entity('Activity', 1, name='New'))
+            writer.put(Entity(ds_util.client.key('Activity')))
+            writer.put(Entity(ds_util.client.key('Activity')))
+        entities = self.datastore.put_multi.call_args[0][0]
+        self.assertEqual(3, len(entities))
+        self.assertEqual('New', entities[0]['name'])
+
+    def test_error_outside_transaction_flushes(self):
+        with self.assertRaises(ValueError):
+            with ds_util.BatchWriter(self.datastore) as writer:
+                writer.put(_entity('Activity', 1))
+                raise ValueError()
+        self.datastore.put_multi.assert_called_once()
+
+    def test_in_transaction_raises(self):
+        self.datastore.current_transaction = mock.Mock()
+        with self.assertRaises(ValueError):
+            with ds_util.BatchWriter(self.datastore):
+                pass
+        self.datastore.put_multi.assert_not_called()
+
+    @mock.patch('shared.ds_util.client.put_multi')
+    def test_uses_ds_util_client(self, put_multi_mock):
+        with ds_util.BatchWriter() as writer:
+            writer.put(_entity('Activity', 1))
+        put_multi_mock.assert_called_once()
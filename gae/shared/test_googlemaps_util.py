@@ -0,0 +1,75 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from shared import testing_util
+from shared.googlemaps_util import ElevationCache
+
+
+POLYLINE = 'a~l~Fjk~uOwHJy@P'
+
+
+class FakeMapsClient(object):
+    def __init__(self):
+        self.calls = 0
+
+    def elevation_along_path(self, path, samples):
+        self.calls += 1
+        return [
+            {
+                'elevation': 10.0 * i,
+                'location': {'lat': 37.0 + i / 100, 'lng': -122.0},
+                'resolution': 4.7,
+            }
+            for i in range(samples)
+        ]
+
+
+class ElevationCacheTest(unittest.TestCase):
+    def setUp(self):
+        testing_util.fake_datastore(self)
+        self.maps = FakeMapsClient()
+
+    def test_caches_in_process(self):
+        cache = ElevationCache(self.maps)
+        first = cache.elevation_along_path(POLYLINE, 100)
+        second = cache.elevation_along_path(POLYLINE, 100)
+
+        self.assertEqual(first, second)
+        self.assertEqual(100, len(second))
+        self.assertEqual(1, self.maps.calls)
+        self.assertEqual(
+            {'misses': 1, 'hits': 1, 'maps_calls_avoided': 1}, dict(cache.stats)
+        )
+
+    def test_caches_in_datastore(self):
+        ElevationCache(self.maps).elevation_along_path(POLYLINE, 100)
+
+        cache = ElevationCache(self.maps)
+        elevations = cache.elevation_along_path(POLYLINE, 100)
+        self.assertEqual(10.0, elevations[1]['elevation'])
+        self.assertEqual(1, self.maps.calls)
+        self.assertEqual(1, cache.stats['datastore_hits'])
+
+    def test_keyed_by_samples(self):
+        cache = ElevationCache(self.maps)
+        cache.elevation_along_path(POLYLINE, 100)
+        self.assertEqual(50, len(cache.elevation_along_path(POLYLINE, 50)))
+        self.assertEqual(2, self.maps.calls)
+
+    def test_returns_copies(self):
+        cache = ElevationCache(self.maps)
+        cache.elevation_along_path(POLYLINE, 10)[0]['elevation'] = -1
+        self.assertEqual(0.0, cache.elevation_along_path(POLYLINE, 10)[0]['elevation'])
@@ -0,0 +1,100 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import datetime
+import unittest
+from unittest import mock
+
+from google.cloud.datastore.entity import Entity
+
+from shared import ds_util
+from shared import pending_util
+from shared import testing_util
+
+
+class PendingTasksTest(unittest.TestCase):
+    def setUp(self):
+        self.stored = testing_util.fake_datastore(self).stored
+        self.enqueue_mock = mock.Mock()
+        self.stats = collections.Counter()
+        self.pending = pending_util.PendingTasks(
+            'Test',
+            self.enqueue_mock,
+            stale_after=datetime.timedelta(minutes=10),
+            retry_delay=datetime.timedelta(minutes=5),
+            max_retries=2,
+            count_fn=lambda stat: self.stats.update([stat]),
+        )
+        self.key = ds_util.client.key('Pending', 'name')
+
+    def _add(self):
+        return self.pending.add(self.key, self._update, datetime.timedelta(seconds=30))
+
+    def _update(self, pending, queue):
+        if pending is None:
+            pending = Entity(self.key)
+            pending['coalesced'] = 0
+        pending['coalesced'] += 1
+        return pending
+
+    def test_queues_once(self):
+        entity, queued = self._add()
+        self.assertTrue(queued)
+        entity, queued = self._add()
+        self.assertFalse(queued)
+        self.assertEqual(2, entity['coalesced'])
+        self.enqueue_mock.assert_called_once()
+        self.assertEqual({'enqueued': 1, 'coalesced': 1}, self.stats)
+
+    def test_done_requeues_merged(self):
+        entity, _ = self._add()
+        self._add()
+        self.assertTrue(self.pending.done(entity, datetime.timedelta(seconds=30)))
+        self.assertEqual(2, self.enqueue_mock.call_count)
+
+        entity = self.stored[self.key]
+        self.assertFalse(self.pending.done(entity, datetime.timedelta(seconds=30)))
+        self.assertNotIn(self.key, self.stored)
+
+    def test_failed_enqueue_queued_by_next_add(self):
+        self.enqueue_mock.side_effect = Exception('Failed')
+        self.assertRaises(Exception, self._add)
+        self.assertIsNone(self.stored[self.key]['enqueued_at'])
+
+        self.enqueue_mock.side_effect = None
+        entity, queued = self._add()
+        self.assertTrue(queued)
+        self.assertEqual(2, entity['coalesced'])
+
+    def test_failed_requeue_queued_by_next_add(self):
+        entity, _ = self._add()
+        self.enqueue_mock.side_effect = Exception('Failed')
+        self.assertRaises(Exception, self.pending.retry, entity)
+
+        self.enqueue_mock.side_effect = None
+        _, queued = self._add()
+        self.assertTrue(queued)
+
+    def test_retry_gives_up(self):
+        entity, _ = self._add()
+        self.assertTrue(self.pending.retry(entity))
+        self.enqueue_mock.assert_called_with(
+            self.stored[self.key], datetime.timedelta(minutes=5)
+        )
+        self.assertTrue(self.pending.retry(entity))
+        self.assertFalse(self.pending.retry(entity))
+        self.assertEqual(3, self.enqueue_mock.call_count)
+        self.assertEqual(1, self.stats['abandoned'])
+        self.assertIn(self.key, self.stored)
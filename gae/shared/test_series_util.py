@@ -0,0 +1,89 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import unittest
+
+from shared import series_util
+
+
+class SeriesUtilTest(unittest.TestCase):
+    def setUp(self):
+        self.measures = [
+            _measure(2020, 9, 21, 7, weight=70.0, fat_ratio=20.0),
+            _measure(2020, 9, 21, 19, weight=72.0),
+            _measure(2020, 9, 27, 7, weight=71.0, fat_ratio=22.0),
+            _measure(2020, 9, 28, 7, weight=69.0),
+            _measure(2020, 10, 1, 7, weight=68.0),
+        ]
+
+    def test_project(self):
+        projected = series_util.project(self.measures[:1], ['weight'])
+        self.assertEqual(
+            [{'date': self.measures[0]['date'], 'weight': 70.0}], projected
+        )
+
+    def test_downsample_day(self):
+        days = series_util.downsample(self.measures, 'day')
+
+        self.assertEqual(4, len(days))
+        self.assertEqual(
+            {
+                'date': datetime.datetime(2020, 9, 21, tzinfo=datetime.timezone.utc),
+                'count': 2,
+                'weight': 71.0,
+                'weight_min': 70.0,
+                'weight_max': 72.0,
+                'weight_last': 72.0,
+                'fat_ratio': 20.0,
+                'fat_ratio_min': 20.0,
+                'fat_ratio_max': 20.0,
+                'fat_ratio_last': 20.0,
+            },
+            days[0],
+        )
+        self.assertNotIn('fat_ratio', days[-1])
+
+    def test_downsample_week(self):
+        weeks = series_util.downsample(self.measures, 'week', fields=['weight'])
+
+        self.assertEqual(
+            [
+                datetime.datetime(2020, 9, 21, tzinfo=datetime.timezone.utc),
+                datetime.datetime(2020, 9, 28, tzinfo=datetime.timezone.utc),
+            ],
+            [w['date'] for w in weeks],
+        )
+        self.assertEqual([3, 2], [w['count'] for w in weeks])
+        self.assertEqual([71.0, 68.5], [w['weight'] for w in weeks])
+        self.assertEqual([71.0, 68.0], [w['weight_last'] for w in weeks])
+        self.assertNotIn('fat_ratio', weeks[0])
+
+    def test_downsample_month(self):
+        months = series_util.downsample(self.measures, 'month')
+
+        self.assertEqual([4, 1], [m['count'] for m in months])
+        self.assertEqual(21.0, months[0]['fat_ratio'])
+        self.assertEqual(22.0, months[0]['fat_ratio_last'])
+
+    def test_downsample_unknown_resolution(self):
+        self.assertRaises(ValueError, series_util.downsample, self.measures, 'year')
+
+
+def _measure(year, month, day, hour, **values):
+    measure = {
+        'date': datetime.datetime(year, month, day, hour, tzinfo=datetime.timezone.utc)
+    }
+    measure.update(values)
+    return measure
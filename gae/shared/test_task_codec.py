@@ -0,0 +1,74 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from google.cloud.datastore.entity import Entity
+
+from shared import ds_util
+from shared import task_codec
+
+
+def _params(points=1):
+    params = Entity(ds_util.client.key('TaskParams'))
+    params['service_key'] = ds_util.client.key('Service', 'strava')
+    params['trackpoints'] = [
+        {'lat': 37.0 + i / 1000, 'lng': -122.0, 'speed': 5.5} for i in range(points)
+    ]
+    return params
+
+
+class TaskCodecTest(unittest.TestCase):
+    def test_round_trip(self):
+        for version in (
+            task_codec.VERSION_LEGACY,
+            task_codec.VERSION_PROTO,
+            task_codec.VERSION_PROTO_ZLIB,
+        ):
+            params = _params(points=100)
+            decoded = task_codec.decode(task_codec.encode(params, version=version))
+            self.assertEqual(params.key.flat_path, decoded.key.flat_path)
+            self.assertEqual(params['service_key'], decoded['service_key'])
+            self.assertEqual(
+                params['trackpoints'], [dict(p) for p in decoded['trackpoints']]
+            )
+
+    def test_encodes_legacy_by_default(self):
+        # Until every worker can decode versioned payloads.
+        self.assertEqual(
+            task_codec.serialize_entity(_params()), task_codec.encode(_params())
+        )
+
+    def test_version_byte(self):
+        version = task_codec.VERSION_PROTO_ZLIB
+        small = task_codec.encode(_params(points=1), version=version)
+        self.assertEqual(task_codec.VERSION_PROTO, small[0])
+
+        large = task_codec.encode(_params(points=100), version=version)
+        self.assertEqual(task_codec.VERSION_PROTO_ZLIB, large[0])
+        legacy = task_codec.serialize_entity(_params(points=100))
+        self.assertLess(len(large), len(legacy))
+
+    def test_decodes_legacy(self):
+        legacy = task_codec.serialize_entity(_params())
+        self.assertEqual(
+            _params()['service_key'], task_codec.decode(legacy)['service_key']
+        )
+
+    def test_decodes_empty(self):
+        self.assertIsNone(task_codec.decode(None))
+        self.assertEqual({}, dict(task_codec.decode(b'')))
+
+    def test_unknown_version(self):
+        self.assertRaises(ValueError, task_codec.decode, bytes([7]) + b'junk')
@@ -0,0 +1,160 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import threading
+import time
+import unittest
+
+import flask
+
+from google.api_core.exceptions import AlreadyExists, ResourceExhausted
+
+from shared import ds_util
+from shared import responses
+from shared import task_util
+from shared.task_executor import InProcessTaskExecutor
+
+
+class InProcessTaskExecutorTest(unittest.TestCase):
+    def setUp(self):
+        self.app = flask.Flask(__name__)
+        self.executed = []
+        self.running = 0
+        self.max_running = 0
+        lock = threading.Lock()
+
+        @self.app.route('/xsync/tasks/measure', methods=['POST'])
+        def measure():
+            with lock:
+                self.running += 1
+                self.max_running = max(self.max_running, self.running)
+            time.sleep(0.01)
+            params = task_util.get_payload(flask.request)
+            with lock:
+                self.executed.append(params['measure'])
+                self.running -= 1
+            return responses.OK
+
+        @self.app.route('/services/<name>/tasks/event', methods=['POST'])
+        def event(name):
+            params = task_util.get_payload(flask.request)
+            with lock:
+                self.executed.append(params['event'])
+            return responses.OK
+
+        self.executor = InProcessTaskExecutor(
+            {'backend': self.app}, queue_concurrency={'events': 2}
+        )
+        task_util.set_executor(self.executor)
+
+    def tearDown(self):
+        task_util.set_executor(None)
+        self.executor.shutdown()
+
+    def test_executes_in_process(self):
+        user_key = ds_util.client.key('User', 'someuser')
+        with task_util.TaskBatch():
+            for i in range(6):
+                task_util.xsync_tasks_measure(user_key, {'weight': i})
+        self.executor.join()
+
+        self.assertCountEqual(range(6), [m['weight'] for m in self.executed])
+        self.assertEqual(6, self.executor.stats['executed'])
+        self.assertLessEqual(self.max_running, 2)
+
+    def test_dedups_task_names(self):
+        service_key = ds_util.client.key('Service', 'strava')
+        event = ds_util.client.key('SubscriptionEvent', 'event', parent=service_key)
+        event_entity = task_util._params_entity()
+        event_entity.key = event
+
+        task_util.process_event(service_key, event_entity)
+        with self.assertRaises(AlreadyExists):
+            task_util.process_event(service_key, event_entity)
+        self.assertEqual(1, self.executor.stats['deduped'])
+
+    def test_failed_submit_frees_name(self):
+        self.executor.max_queue_size = 1
+
+        def queue(name):
+            task_util._queue_task(
+                name=name,
+                entity=task_util._params_entity(measure={'weight': name}),
+                relative_uri='/xsync/tasks/measure',
+                service='backend',
+                delay_timedelta=datetime.timedelta(milliseconds=100),
+            )
+
+        queue('measure-1')
+        with self.assertRaises(ResourceExhausted):
+            queue('measure-2')
+        self.executor.join()
+
+        queue('measure-2')
+        self.executor.join()
+        self.assertEqual(
+            ['measure-1', 'measure-2'], [m['weight'] for m in self.executed]
+        )
+
+    def test_honors_delay(self):
+        task_util._queue_task(
+            entity=task_util._params_entity(measure={'weight': 1}),
+            relative_uri='/xsync/tasks/measure',
+            service='backend',
+            delay_timedelta=datetime.timedelta(milliseconds=200),
+        )
+        time.sleep(0.05)
+        self.assertEqual([], self.executed)
+
+        self.executor.join()
+        self.assertEqual(1, len(self.executed))
+
+    def test_deferred_drops_on_error(self):
+        user_key = ds_util.client.key('User', 'someuser')
+        with self.assertRaises(ValueError):
+            with self.executor.deferred():
+                task_util.xsync_tasks_measure(user_key, {'weight': 1})
+                raise ValueError()
+        with self.executor.deferred():
+            task_util.xsync_tasks_measure(user_key, {'weight': 2})
+            self.assertEqual(0, self.executor.stats['queued'])
+        self.executor.join()
+
+        self.assertEqual([2], [m['weight'] for m in self.executed])
+
+    def test_deferred_holds_batches(self):
+        def queue():
+            with task_util.TaskBatch():
+                task_util._queue_task(
+                    name='measure-1',
+                    entity=task_util._params_entity(measure={'weight': 1}),
+                    relative_uri='/xsync/tasks/measure',
+                    service='backend',
+                )
+
+        with self.assertRaises(ValueError):
+            with self.executor.deferred():
+                queue()
+                self.assertEqual(0, self.executor.stats['queued'])
+                raise ValueError()
+
+        # The dropped task's name is free again, for the retry.
+        with self.executor.deferred():
+            queue()
+            self.assertEqual(0, self.executor.stats['queued'])
+        self.executor.join()
+
+        self.assertEqual(1, self.executor.stats['queued'])
+        self.assertEqual([1], [m['weight'] for m in self.executed])
@@ -0,0 +1,68 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+import unittest
+
+from shared import ds_util
+from shared import task_util
+from shared.config import config
+
+
+@mock.patch.object(config, 'is_dev', False)
+@mock.patch('shared.task_util._client')
+class TaskBatchTest(unittest.TestCase):
+    def test_defers_until_exit(self, client_mock):
+        user_key = ds_util.client.key('User', 'someuser')
+        with task_util.TaskBatch():
+            for i in range(5):
+                task_util.xsync_tasks_measure(user_key, {'weight': i})
+            client_mock.create_task.assert_not_called()
+        self.assertEqual(5, client_mock.create_task.call_count)
+
+    def test_nested_batch_joins_outer(self, client_mock):
+        user_key = ds_util.client.key('User', 'someuser')
+        with task_util.TaskBatch() as outer:
+            with task_util.TaskBatch() as inner:
+                task_util.xsync_tasks_measure(user_key, {'weight': 1})
+            self.assertIs(outer, inner)
+            client_mock.create_task.assert_not_called()
+            task_util.xsync_tasks_measure(user_key, {'weight': 2})
+        self.assertEqual(2, client_mock.create_task.call_count)
+
+    def test_raises_after_attempting_all(self, client_mock):
+        client_mock.create_task.side_effect = [
+            Exception('Failed'),
+            mock.DEFAULT,
+            mock.DEFAULT,
+        ]
+        user_key = ds_util.client.key('User', 'someuser')
+        with self.assertRaises(Exception):
+            with task_util.TaskBatch(max_workers=1):
+                for i in range(3):
+                    task_util.xsync_tasks_measure(user_key, {'weight': i})
+        self.assertEqual(3, client_mock.create_task.call_count)
+
+    def test_discards_on_error(self, client_mock):
+        user_key = ds_util.client.key('User', 'someuser')
+        with self.assertRaises(ValueError):
+            with task_util.TaskBatch():
+                task_util.xsync_tasks_measure(user_key, {'weight': 1})
+                raise ValueError()
+        client_mock.create_task.assert_not_called()
+
+    def test_no_batch_creates_immediately(self, client_mock):
+        user_key = ds_util.client.key('User', 'someuser')
+        task_util.xsync_tasks_measure(user_key, {'weight': 1})
+        client_mock.create_task.assert_called_once()
@@ -0,0 +1,62 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from shared import track_util
+
+
+class TrackUtilTest(unittest.TestCase):
+    def test_pack_round_trips(self):
+        trackpoints = [
+            _trackpoint(0, 37.7755345, -122.4425526, 50.5, 6.25, 140),
+            _trackpoint(1, 37.7755912, -122.4421003, None, 6.5, None),
+            _trackpoint(3, None, None, 52.0, None, 142),
+            _trackpoint(7, 37.7761234, -122.4409876, 53.25, 7.0, 143),
+        ]
+
+        self.assertEqual(trackpoints, track_util.unpack(track_util.pack(trackpoints)))
+
+    def test_pack_empty(self):
+        self.assertEqual([], track_util.unpack(track_util.pack([])))
+
+    def test_encode_polyline(self):
+        # Google's example.
+        points = [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]
+
+        self.assertEqual(
+            '_p~iF~ps|U_ulLnnqC_mqNvxq`@', track_util.encode_polyline(points)
+        )
+        self.assertEqual(
+            points, track_util.decode_polyline('_p~iF~ps|U_ulLnnqC_mqNvxq`@')
+        )
+        self.assertEqual([], track_util.decode_polyline(''))
+
+    def test_encode_polyline_appends(self):
+        points = [(37.77 + i / 1000, -122.44 - i / 3000) for i in range(20)]
+
+        appended = track_util.encode_polyline(points[:7]) + track_util.encode_polyline(
+            points[7:], previous=points[6]
+        )
+        self.assertEqual(track_util.encode_polyline(points), appended)
+
+
+def _trackpoint(seconds, lat, lon, altitude, speed, heart_rate):
+    return {
+        'dateTime': '2021-04-11T15:00:%02d.000Z' % (seconds,),
+        'position': {'lat': lat, 'lon': lon},
+        'altitude': altitude,
+        'speed': speed,
+        'fitnessPointData': {'heartRateBeatsPerMin': heart_rate},
+    }
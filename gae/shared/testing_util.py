@@ -0,0 +1,87 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Test helpers shared by the services."""
+
+import contextlib
+import copy
+
+import mock
+
+from shared import ds_util
+
+
+class FakeDatastore(object):
+    """An in-memory Datastore, standing in for ds_util.client in tests.
+
+    Entities are copied as they're put and got, as a real Datastore would
+    serialize them. Transactions isolate nothing, but in_transaction counts
+    those entered. Each patched method is a Mock, in mocks, for asserting on
+    its calls.
+    """
+
+    METHODS = (
+        'get',
+        'get_multi',
+        'put',
+        'put_multi',
+        'delete',
+        'delete_multi',
+        'transaction',
+    )
+
+    def __init__(self):
+        self.stored = {}
+        self.mocks = {}
+        self.in_transaction = 0
+
+    def get(self, key, **kwargs):
+        return copy.deepcopy(self.stored.get(key))
+
+    def get_multi(self, keys, **kwargs):
+        return [copy.deepcopy(self.stored[k]) for k in keys if k in self.stored]
+
+    def put(self, entity, **kwargs):
+        self.stored[entity.key] = copy.deepcopy(entity)
+
+    def put_multi(self, entities, **kwargs):
+        for entity in entities:
+            self.put(entity)
+
+    def delete(self, key, **kwargs):
+        self.stored.pop(key, None)
+
+    def delete_multi(self, keys, **kwargs):
+        for key in keys:
+            self.delete(key)
+
+    @contextlib.contextmanager
+    def transaction(self, **kwargs):
+        self.in_transaction += 1
+        try:
+            yield
+        finally:
+            self.in_transaction -= 1
+
+
+def fake_datastore(test_case):
+    """Patches ds_util.client with a FakeDatastore until test_case ends."""
+    fake = FakeDatastore()
+    for name in FakeDatastore.METHODS:
+        patcher = mock.patch.object(
+            ds_util.client, name, side_effect=getattr(fake, name)
+        )
+        fake.mocks[name] = patcher.start()
+        test_case.addCleanup(patcher.stop)
+    return fake
@@ -0,0 +1,198 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Packs LiveTrack trackpoints into compact columns, and encodes polylines."""
+
+import datetime
+import zlib
+
+import dateutil.parser
+import numpy as np
+
+
+# Packed columns, and the little-endian dtype each is stored as.
+COLUMNS = (
+    ('millis', '<i8'),
+    ('lat', '<i4'),
+    ('lon', '<i4'),
+    ('altitude', '<f4'),
+    ('speed', '<f4'),
+    ('heart_rate', '<u2'),
+)
+
+# Positions are stored as ints of this many degrees; about 1cm.
+POSITION_SCALE = 10**7
+
+# Google's polylines hold five decimal places.
+POLYLINE_PRECISION = 5
+
+
+def pack(trackpoints):
+    """Packs trackpoints, in Garmin's format, into a dict of columns.
+
+    Times and positions are delta-encoded ints, altitude and speed are
+    float32s, NaN when missing, and heart rate is a uint16, 0 when missing.
+    Each column is zlib-compressed bytes; missing_position lists the indexes
+    of points without one, whose lat and lon repeat the previous point's.
+    """
+    count = len(trackpoints)
+    positions = [p.get('position') or {} for p in trackpoints]
+    lat = _floats(p.get('lat') for p in positions)
+    lon = _floats(p.get('lon') for p in positions)
+    missing = np.flatnonzero(np.isnan(lat) | np.isnan(lon))
+    columns = {
+        'millis': np.fromiter(
+            (millis(p) for p in trackpoints), dtype=np.int64, count=count
+        ),
+        'lat': _scale(_fill(lat)),
+        'lon': _scale(_fill(lon)),
+        'altitude': _floats(p.get('altitude') for p in trackpoints),
+        'speed': _floats(p.get('speed') for p in trackpoints),
+        'heart_rate': np.fromiter(
+            (
+                (p.get('fitnessPointData') or {}).get('heartRateBeatsPerMin') or 0
+                for p in trackpoints
+            ),
+            dtype=np.uint16,
+            count=count,
+        ),
+    }
+    packed = {'count': count, 'missing_position': missing.tolist()}
+    for name, dtype in COLUMNS:
+        values = columns[name]
+        if name in ('millis', 'lat', 'lon'):
+            values = np.diff(values, prepend=0)
+        packed[name] = zlib.compress(values.astype(dtype).tobytes())
+    return packed
+
+
+def unpack(packed):
+    """Returns the trackpoints, in Garmin's format, that pack packed."""
+    columns = {
+        name: np.frombuffer(zlib.decompress(packed[name]), dtype=dtype)
+        for name, dtype in COLUMNS
+    }
+    for name in ('millis', 'lat', 'lon'):
+        columns[name] = np.cumsum(columns[name], dtype=np.int64)
+    # As LiveTrack formats them, e.g., 2021-04-11T15:00:09.000Z.
+    dates = np.datetime_as_string(
+        columns['millis'].astype('datetime64[ms]'), timezone='UTC'
+    ).tolist()
+    lat = (columns['lat'] / POSITION_SCALE).tolist()
+    lon = (columns['lon'] / POSITION_SCALE).tolist()
+    for i in packed.get('missing_position') or ():
+        lat[i] = lon[i] = None
+    altitude = _optional(columns['altitude'])
+    speed = _optional(columns['speed'])
+    heart_rate = [int(h) or None for h in columns['heart_rate']]
+
+    return [
+        {
+            'dateTime': dates[i],
+            'position': {'lat': lat[i], 'lon': lon[i]},
+            'altitude': altitude[i],
+            'speed': speed[i],
+            'fitnessPointData': {'heartRateBeatsPerMin': heart_rate[i]},
+        }
+        for i in range(packed['count'])
+    ]
+
+
+def positions(trackpoints):
+    """Returns the (lat, lon) of each of trackpoints that has a position."""
+    return [
+        (p['position']['lat'], p['position']['lon'])
+        for p in trackpoints
+        if (p.get('position') or {}).get('lat') is not None
+        and p['position'].get('lon') is not None
+    ]
+
+
+def encode_polyline(points, previous=None):
+    """Encodes (lat, lon) points as a Google encoded polyline.
+
+    Pass the last point of an earlier polyline as previous to get a
+    polyline that continues it when appended.
+    """
+    if not points:
+        return ''
+    scaled = np.round(np.asarray(points, dtype=np.float64) * 10**POLYLINE_PRECISION)
+    origin = np.round(
+        np.asarray(previous or (0, 0), dtype=np.float64) * 10**POLYLINE_PRECISION
+    )
+    deltas = np.diff(scaled, axis=0, prepend=[origin]).astype(np.int64).ravel()
+    # Zig-zag, so small negative deltas are small too.
+    values = np.where(deltas < 0, ~(deltas << 1), deltas << 1).tolist()
+
+    chars = []
+    for value in values:
+        while value >= 0x20:
+            chars.append(chr((0x20 | (value & 0x1F)) + 63))
+            value >>= 5
+        chars.append(chr(value + 63))
+    return ''.join(chars)
+
+
+def decode_polyline(polyline):
+    """Returns the (lat, lon) points of a Google encoded polyline."""
+    values = []
+    value = shift = 0
+    for char in polyline:
+        chunk = ord(char) - 63
+        value |= (chunk & 0x1F) << shift
+        shift += 5
+        if chunk < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value = shift = 0
+    coordinates = np.cumsum(np.asarray(values, dtype=np.int64).reshape(-1, 2), axis=0)
+    points = (coordinates / 10**POLYLINE_PRECISION).round(POLYLINE_PRECISION)
+    return [tuple(point) for point in points.tolist()]
+
+
+def millis(trackpoint):
+    """A LiveTrack trackpoint's time, in millis since the epoch."""
+    text = trackpoint['dateTime']
+    try:
+        # Much faster than dateutil, for the ISO 8601 LiveTrack sends.
+        date = datetime.datetime.fromisoformat(
+            text[:-1] + '+00:00' if text.endswith('Z') else text
+        )
+    except ValueError:
+        date = dateutil.parser.parse(text)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return round(date.timestamp() * 1000)
+
+
+def _floats(values):
+    return np.array(
+        [np.nan if v is None else v for v in values], dtype=np.float64
+    ).reshape(-1)
+
+
+def _fill(values):
+    """Carries each value forward over the NaNs after it, then 0."""
+    present = ~np.isnan(values)
+    index = np.where(present, np.arange(len(values)), 0)
+    np.maximum.accumulate(index, out=index)
+    filled = values[index]
+    return np.where(np.isnan(filled), 0, filled)
+
+
+def _scale(values):
+    return np.round(values * POSITION_SCALE).astype(np.int64)
+
+
+def _optional(values):
+    return [None if np.isnan(v) else float(v) for v in values]